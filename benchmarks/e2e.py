@@ -0,0 +1,266 @@
+"""
+End-to-end benchmark: synthetic Telegram updates are posted to the app of flask_app.create_app() through
+the Flask test client, outbound Bot API requests go to the local Telegram stub. Every vault size runs in its
+own process with a fresh temporary database.
+
+The workload mixes inline queries typed letter by letter, empty inline queries, media saves, deletes and
+bursts of /start from new users. Latency percentiles and throughput are reported per kind of update, along
+with direct timings of Media.search_page and Media.search_by_description and the slowest statements.
+
+Run from the repository root: python -m benchmarks.e2e --sizes 100,10000,100000 --output e2e.json
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+VAULT_USER = 1
+TOKEN = "123:stub"
+SECRET = "benchmark"
+SYLLABLES = ("ka", "to", "mi", "ne", "ra", "lo", "su", "pe", "di", "an", "or", "el", "us", "ba", "ki", "mo", "te",
+             "vi", "gu", "sha", "ly", "po", "re", "zu", "fi", "do", "ha", "ji", "we", "ny")
+
+
+def percentile(sorted_values: list, p: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies: list, elapsed: float = None) -> dict:
+    values = sorted(latencies)
+    total = sum(values)
+    return {
+        "count": len(values),
+        "mean_ms": total / len(values) * 1000 if values else 0.0,
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": values[-1] * 1000 if values else 0.0,
+        "per_second": len(values) / (elapsed if elapsed is not None else total) if values and (elapsed or total) else 0.0,
+    }
+
+
+class Workload:
+    """Generates a reproducible vault and stream of updates."""
+    def __init__(self, seed: int, vocabulary_size: int = 3000):
+        self.random = random.Random(seed)
+        words = set()
+        while len(words) < vocabulary_size:
+            words.add("".join(self.random.choices(SYLLABLES, k=self.random.randint(2, 4))))
+        self.words = sorted(words)
+        self.random.shuffle(self.words)
+        # Zipf-like frequencies, a few words are in many descriptions
+        weights = [1 / (rank + 1) ** 1.1 for rank in range(len(self.words))]
+        self.cum_weights = list(itertools.accumulate(weights))
+        self.update_id = 0
+        self.next_user = 1000
+        self.descriptions = []
+
+    def description(self) -> str:
+        return " ".join(self.random.choices(self.words, cum_weights=self.cum_weights, k=self.random.randint(2, 6)))
+
+    def vault(self, size: int):
+        media_types = ("photo", "gif", "video", "sticker", "document", "audio", "voice", "article")
+        for i in range(size):
+            description = self.description()
+            self.descriptions.append(description)
+            yield {"user_id": VAULT_USER, "media_type": media_types[i % len(media_types)], "file_id": f"bench-{i}",
+                   "caption": None, "description": description}
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"user{user_id}",
+                "language_code": "en"}
+
+    def message(self, user_id: int, **content) -> dict:
+        self.update_id += 1
+        return {"update_id": self.update_id, "message": {
+            "message_id": self.update_id, "date": int(time.time()), "from": self._user(user_id),
+            "chat": {"id": user_id, "type": "private"}, **content}}
+
+    def inline_query(self, user_id: int, query: str) -> dict:
+        self.update_id += 1
+        return {"update_id": self.update_id, "inline_query": {
+            "id": str(self.update_id), "from": self._user(user_id), "query": query, "offset": ""}}
+
+    def photo(self, user_id: int, file_id: str) -> dict:
+        return self.message(user_id, photo=[{"file_id": file_id, "file_unique_id": file_id, "width": 90,
+                                             "height": 90}])
+
+    def typing(self) -> list[str]:
+        """Queries sent while a user types a few words of an existing description."""
+        words = self.random.choice(self.descriptions).split()
+        text = " ".join(words[:self.random.randint(1, min(3, len(words)))])
+        return [text[:i] for i in range(1, len(text) + 1) if not text[:i].endswith(" ")]
+
+    def sessions(self):
+        """Yields (kind, update) of interleaved user sessions forever."""
+        saved = 0
+        while True:
+            roll = self.random.random()
+            if roll < 0.70:
+                for query in self.typing():
+                    yield "inline_query", self.inline_query(VAULT_USER, query)
+            elif roll < 0.78:
+                yield "inline_query_empty", self.inline_query(VAULT_USER, "")
+            elif roll < 0.90:
+                saved += 1
+                yield "save_media", self.photo(VAULT_USER, f"new-{saved}")
+                yield "save_description", self.message(VAULT_USER, text=self.description())
+            elif roll < 0.97:
+                yield "delete_command", self.message(VAULT_USER, text="/delete")
+                victim = self.random.randrange(len(self.descriptions))
+                yield "delete_media", self.photo(VAULT_USER, f"bench-{victim}")
+                yield "delete_done", self.message(VAULT_USER, text="/done")
+            else:
+                for _ in range(20):
+                    self.next_user += 1
+                    yield "start", self.message(self.next_user, text="/start")
+
+
+def run_worker(size: int, operations: int, seed: int, latency: float, search_samples: int) -> dict:
+    """Runs the benchmark for one vault size. Expects environment prepared by run_size."""
+    from telegram_stub import TelegramStub
+
+    stub = TelegramStub(latency=latency)
+    os.environ["TELEGRAM_API_URL"] = stub.start()
+
+    import logging
+    import database as db
+    from cache import inline_cache
+    import metrics
+    from bot._handlers import LIMIT, normalize_text
+
+    workload = Workload(seed)
+    started = time.perf_counter()
+    db.Users.migrate()
+    db.Media.migrate()
+    db.States.migrate()
+    db.Media.import_rows(workload.vault(size))
+    populate_time = time.perf_counter() - started
+
+    import flask_app
+    app = flask_app.create_app()
+    for handler in logging.getLogger("main_logger").handlers:
+        if type(handler) is logging.StreamHandler:
+            handler.setLevel(logging.WARNING)  # keep the console quiet, the log file is still written
+
+    client = app.test_client()
+    url = f"/{SECRET}"
+    latencies = {}
+    sessions = workload.sessions()
+    for _ in range(min(50, operations)):  # warm-up: caches, pool, prepared statements
+        client.post(url, json=next(sessions)[1])
+
+    started = time.perf_counter()
+    for _ in range(operations):
+        kind, update = next(sessions)
+        request_started = time.perf_counter()
+        response = client.post(url, json=update)
+        latencies.setdefault(kind, []).append(time.perf_counter() - request_started)
+        if response.status_code != 200:
+            raise RuntimeError(f"{kind} update answered with {response.status_code}")
+    elapsed = time.perf_counter() - started
+
+    queries = [normalize_text(query) for _ in range(search_samples) for query in workload.typing()[-1:]]
+    for name, search in (("search_page", lambda q: db.Media.search_page(VAULT_USER, q, limit=LIMIT)),
+                         ("search_by_description",
+                          lambda q: db.Media.search_by_description(VAULT_USER, q, limit=LIMIT, offset=0))):
+        for query in queries:
+            query_started = time.perf_counter()
+            search(query)
+            latencies.setdefault(f"db.{name}", []).append(time.perf_counter() - query_started)
+
+    statements = sorted(((labels[0], count, total) for labels, (count, total) in
+                         metrics.QUERY_DURATION.snapshot().items()), key=lambda item: item[2], reverse=True)
+    stub.stop()
+    return {
+        "vault_size": size,
+        "populate_seconds": populate_time,
+        "updates": operations,
+        "updates_per_second": operations / elapsed,
+        "latency": {kind: summarize(values) for kind, values in sorted(latencies.items())},
+        "all_updates": summarize([value for kind, values in latencies.items() if not kind.startswith("db.")
+                                  for value in values], elapsed),
+        "slowest_statements": [{"statement": statement, "count": count, "total_ms": total * 1000,
+                                "mean_ms": total / count * 1000} for statement, count, total in statements[:10]],
+        "inline_cache": inline_cache.stats(),
+    }
+
+
+def run_size(size: int, args) -> dict:
+    """Runs the worker for one vault size in a fresh process and temporary home directory."""
+    with tempfile.TemporaryDirectory(prefix="inline-vault-bench-") as home:
+        os.makedirs(os.path.join(home, "mysite"))
+        env = dict(os.environ, HOME=home, DATABASE_PATH=os.path.join(home, "bench.db"), TELEGRAM_CLIENT="async",
+                   TELEGRAM_TOKEN=TOKEN, SECRET=SECRET, SITE_URL="https://bench.invalid/", PROXY_URL="",
+                   WEBHOOK_MODE="sync")
+        command = [sys.executable, "-m", "benchmarks.e2e", "--worker", "--size", str(size), "--operations",
+                   str(args.operations), "--seed", str(args.seed), "--latency", str(args.latency),
+                   "--search-samples", str(args.search_samples)]
+        result = subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True,
+                                check=True)
+        return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def git_revision() -> str or None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="100,10000,100000", help="comma-separated vault sizes")
+    parser.add_argument("--operations", type=int, default=2000, help="updates posted per vault size")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency", type=float, default=0.0, help="simulated Bot API round-trip in seconds")
+    parser.add_argument("--search-samples", type=int, default=200, help="direct search calls per search function")
+    parser.add_argument("--output", default="e2e.json", help="JSON file the results are written to")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.size, args.operations, args.seed, args.latency, args.search_samples)))
+        return
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "operations": args.operations,
+        "seed": args.seed,
+        "results": [],
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        result = run_size(size, args)
+        report["results"].append(result)
+
+        print(f"vault of {size} items: {result['updates_per_second']:.0f} updates/s "
+              f"(populated in {result['populate_seconds']:.1f}s)")
+        for kind, stats in result["latency"].items():
+            print(f"  {kind:<24} n={stats['count']:<5} p50={stats['p50_ms']:7.2f}ms p95={stats['p95_ms']:7.2f}ms "
+                  f"p99={stats['p99_ms']:7.2f}ms")
+
+    with open(args.output, "w", encoding="utf-8") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
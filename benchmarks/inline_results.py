@@ -0,0 +1,92 @@
+"""
+Compares serializing a page of inline query results the previous way (a telepot namedtuple per row,
+serialized by telepot) with assembling precomputed fragments.
+
+Run from the repository root: python -m benchmarks.inline_results --results 50 --repeat 2000
+"""
+import argparse
+import json
+import timeit
+import warnings
+
+from telepot import _rectify
+from telepot.namedtuple import InlineQueryResultCachedAudio, InlineQueryResultCachedDocument, \
+    InlineQueryResultCachedGif, InlineQueryResultCachedPhoto, InlineQueryResultCachedSticker, \
+    InlineQueryResultCachedVideo, InlineQueryResultCachedVoice, InlineQueryResultArticle, InputTextMessageContent
+
+from inline_results import assemble_results, build_fragment
+
+MEDIA_TYPES = ("gif", "audio", "document", "photo", "sticker", "video", "voice", "article")
+
+
+def legacy_results(fetched):
+    """The previous build_inline_results of bot/_handlers.py."""
+    results = []
+    for user_id, media_type, file_id, caption, media_id, description in fetched:
+        match media_type:
+            case "gif":
+                results.append(InlineQueryResultCachedGif(id=str(media_id), gif_file_id=file_id, title=description,
+                                                          caption=caption))
+            case "audio":
+                results.append(InlineQueryResultCachedAudio(id=str(media_id), audio_file_id=file_id,
+                                                            title=description, caption=caption))
+            case "document":
+                results.append(InlineQueryResultCachedDocument(id=str(media_id), document_file_id=file_id,
+                                                               title=description, caption=caption))
+            case "photo":
+                results.append(InlineQueryResultCachedPhoto(id=str(media_id), photo_file_id=file_id,
+                                                            title=description, caption=caption))
+            case "sticker":
+                results.append(InlineQueryResultCachedSticker(id=str(media_id), sticker_file_id=file_id,
+                                                              title=description))
+            case "video":
+                results.append(InlineQueryResultCachedVideo(id=str(media_id), video_file_id=file_id,
+                                                            title=description, caption=caption))
+            case "voice":
+                results.append(InlineQueryResultCachedVoice(id=str(media_id), voice_file_id=file_id,
+                                                            title=description, caption=caption))
+            case "article":
+                results.append(InlineQueryResultArticle(id=str(media_id), title='Text',
+                                                        input_message_content=InputTextMessageContent(
+                                                            message_text=file_id),
+                                                        description=description))
+    return results
+
+
+def make_rows(count: int) -> list:
+    rows = []
+    for i in range(count):
+        media_type = MEDIA_TYPES[i % len(MEDIA_TYPES)]
+        caption = f"caption {i}" if i % 3 else None
+        rows.append((1, media_type, f"AgACAgIAAxkBAAI{i:08d}-file-id", caption, 1000 + i,
+                     f"funny cat meme number {i}"))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--results", type=int, default=50, help="results per page")
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")  # telepot warns about fields its namedtuples don't have
+
+    rows = make_rows(args.results)
+    stored = [(row[4], build_fragment(row[1], row[2], row[3], row[5])) for row in rows]  # done when media is saved
+
+    def legacy():
+        return _rectify({"results": legacy_results(rows)})["results"]
+
+    def precomputed():
+        return assemble_results(stored)
+
+    assert json.loads(legacy()) == json.loads(precomputed()), "serialized results differ"
+
+    legacy_time = timeit.timeit(legacy, number=args.repeat) / args.repeat
+    precomputed_time = timeit.timeit(precomputed, number=args.repeat) / args.repeat
+    print(f"{args.results} results per page")
+    print(f"namedtuples + telepot: {legacy_time * 1e6:8.1f} us/page")
+    print(f"stored fragments:      {precomputed_time * 1e6:8.1f} us/page   x{legacy_time / precomputed_time:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Times looking up and deleting a single item by file_id, as check_description and the delete state do,
+while the vault of the user and the shared media_fts table grow. Media.find and Media.delete_by_file_id
+are compared with the generic Media.get (joined select) and Media.delete (IN subquery on media_fts).
+
+Run from the repository root: python -m benchmarks.point_lookups --sizes 1000,10000,100000
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+home = tempfile.mkdtemp(prefix="inline-vault-bench-")
+os.makedirs(os.path.join(home, "mysite"))
+os.environ["HOME"] = home
+os.environ["DATABASE_PATH"] = os.path.join(home, "point_lookups.db")
+
+import database as db  # noqa: E402, the database path is read on import
+
+USER = 1
+OTHER_USERS = 50  # half of the items belong to other users, they only grow the shared tables
+
+
+def rows(start: int, stop: int):
+    for i in range(start, stop):
+        yield {"user_id": USER if i % 2 else 2 + i % OTHER_USERS, "media_type": "photo", "file_id": f"file-{i}",
+               "caption": None, "description": f"funny cat meme number {i}"}
+
+
+def mean_us(timings: list) -> float:
+    return sum(timings) / len(timings) * 1e6
+
+
+def measure(file_ids: list) -> dict:
+    results = {"get": [], "find": [], "delete": [], "delete_by_file_id": []}
+    for file_id in file_ids:
+        started = time.perf_counter()
+        legacy = db.Media.get({"user_id": USER, "file_id": file_id}, include_column_names=True).get("description")
+        results["get"].append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        record = db.Media.find(USER, file_id)
+        results["find"].append(time.perf_counter() - started)
+        assert record.description == legacy
+
+        # both deletes remove the item, it's saved again outside the timed part
+        for name, delete in (("delete", lambda: db.Media.delete({"user_id": USER, "file_id": file_id})),
+                             ("delete_by_file_id", lambda: db.Media.delete_by_file_id(USER, file_id))):
+            started = time.perf_counter()
+            assert delete()
+            results[name].append(time.perf_counter() - started)
+            db.Media.add({"user_id": USER, "media_type": record.media_type, "file_id": file_id,
+                          "caption": record.caption, "description": record.description})
+    return {name: mean_us(timings) for name, timings in results.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma-separated numbers of items in total")
+    parser.add_argument("--samples", type=int, default=300, help="items looked up and deleted per size")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    db.Users.migrate()
+    db.Media.migrate()
+    random.seed(args.seed)
+
+    print(f"{'items':>8} {'get':>9} {'find':>9} {'delete':>9} {'delete_by_file_id':>18}   (us/call)")
+    populated = 0
+    for size in (int(size) for size in args.sizes.split(",")):
+        db.Media.import_rows(rows(populated, size))
+        populated = size
+        file_ids = [f"file-{i}" for i in random.sample(range(1, size, 2), min(args.samples, size // 2))]
+        result = measure(file_ids)
+        print(f"{size:>8} {result['get']:>9.1f} {result['find']:>9.1f} {result['delete']:>9.1f} "
+              f"{result['delete_by_file_id']:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
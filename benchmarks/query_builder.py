@@ -0,0 +1,165 @@
+"""
+Compares the generic query builder of Database, which compiles a statement once per table, operation and
+columns, with the previous one that validated the columns and formatted the SQL on every call and built
+named rows by index. Both run the same statements through Database.execute_query on a temporary database,
+then the statement building alone is timed, as executing the statement dominates the full calls.
+
+Run from the repository root: python -m benchmarks.query_builder --calls 20000
+"""
+import argparse
+import os
+import tempfile
+import timeit
+
+home = tempfile.mkdtemp(prefix="inline-vault-bench-")
+os.makedirs(os.path.join(home, "mysite"))
+os.environ["HOME"] = home
+os.environ["DATABASE_PATH"] = os.path.join(home, "query_builder.db")
+
+import database as db  # noqa: E402, the database path is read on import
+
+USER = 1
+
+
+def legacy_validate(cls, conditions):
+    invalid_columns = [col for col in conditions if col not in cls.columns]
+    if invalid_columns:
+        raise ValueError(f"Invalid column(s): {', '.join(invalid_columns)}")
+
+
+def legacy_add(cls, data, replace=False):
+    legacy_validate(cls, data)
+    columns = ', '.join(data.keys())
+    placeholders = ', '.join('?' * len(data))
+    if replace:
+        query = f"INSERT OR REPLACE INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
+    else:
+        query = f"INSERT INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
+    cursor = cls.execute_query(query, data.values())
+    return cursor.rowcount > 0, cursor.lastrowid
+
+
+def legacy_select(cls, conditions=None, limit=None, offset=None, order_by=None, sort_direction='ASC',
+                  custom_select=None):
+    query = custom_select if custom_select else f"SELECT * FROM {cls.table_name}"
+    params = []
+    if conditions:
+        legacy_validate(cls, conditions)
+        where_clause = ' AND '.join([f"{cls.table_name}.{key} = ?" for key in conditions.keys()])
+        query += f" WHERE {where_clause}"
+        params.extend(conditions.values())
+    if order_by:
+        if order_by not in cls.columns:
+            raise ValueError(f"Invalid column for ordering: {order_by}")
+        if sort_direction.upper() not in ['ASC', 'DESC']:
+            raise ValueError("Sort direction must be either 'ASC' or 'DESC'")
+        query += f" ORDER BY {cls.table_name}.{order_by} {sort_direction.upper()}"
+    if limit:
+        query += " LIMIT ?"
+        params.append(limit)
+    if offset:
+        query += " OFFSET ?"
+        params.append(offset)
+    return query, params
+
+
+def legacy_get(cls, conditions=None, limit=None, offset=None, order_by=None, sort_direction='ASC',
+               include_column_names=False, custom_select=None):
+    rows = cls.execute_query(*legacy_select(cls, conditions, limit, offset, order_by, sort_direction, custom_select))
+    if include_column_names:
+        rows = [{cls.columns[i]: row[i] for i in range(len(row))} for row in rows]
+        if not rows:
+            return {}
+    if len(rows) == 1:
+        return rows[0]
+    return rows
+
+
+def legacy_count_where(cls, conditions):
+    legacy_validate(cls, conditions)
+    where_clause = ' AND '.join([f"{key} = ?" for key in conditions])
+    result = cls.execute_query(f"SELECT COUNT(*) FROM {cls.table_name} WHERE {where_clause}", conditions.values())
+    return result[0][0] if result else 0
+
+
+def legacy_set(cls, conditions, new_values):
+    legacy_validate(cls, conditions)
+    legacy_validate(cls, new_values)
+    set_clause = ', '.join(f"{key} = ?" for key in new_values)
+    where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
+    query = f"UPDATE {cls.table_name} SET {set_clause} WHERE {where_clause}"
+    return cls.execute_query(query, (*new_values.values(), *conditions.values())).rowcount > 0
+
+
+def legacy_delete(cls, conditions):
+    legacy_validate(cls, conditions)
+    where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
+    return cls.execute_query(f"DELETE FROM {cls.table_name} WHERE {where_clause}",
+                             tuple(conditions.values())).rowcount > 0
+
+
+# (name, legacy call, current call), the calls the handlers make most
+CASES = [
+    ("Temp.add replace",
+     lambda: legacy_add(db.Temp, {"user_id": USER, "key": "state", "value": "waiting"}, replace=True)[0],
+     lambda: db.Temp.add({"user_id": USER, "key": "state", "value": "waiting"})[0]),  # rowid changes on replace
+    ("Temp.get named",
+     lambda: legacy_get(db.Temp, {"user_id": USER, "key": "state"}, include_column_names=True),
+     lambda: db.Temp.get({"user_id": USER, "key": "state"}, include_column_names=True)),
+    ("Temp.set",
+     lambda: legacy_set(db.Temp, {"user_id": USER, "key": "state"}, {"value": "done"}),
+     lambda: db.Temp.set({"user_id": USER, "key": "state"}, {"value": "done"})),
+    ("Temp.delete missing",
+     lambda: legacy_delete(db.Temp, {"user_id": USER, "key": "missing"}),
+     lambda: db.Temp.delete({"user_id": USER, "key": "missing"})),
+    ("Media.get named",
+     lambda: legacy_get(db.Media, {"user_id": USER, "file_id": "file-7"}, include_column_names=True,
+                        custom_select=db.Media.joined_select),
+     lambda: db.Media.get({"user_id": USER, "file_id": "file-7"}, include_column_names=True)),
+    ("Media.get page",
+     lambda: legacy_get(db.Media, {"user_id": USER}, limit=50, offset=50, order_by="media_id",
+                        include_column_names=True, custom_select=db.Media.joined_select),
+     lambda: db.Media.get({"user_id": USER}, limit=50, offset=50, order_by="media_id", include_column_names=True)),
+    ("Media.count_where",
+     lambda: legacy_count_where(db.Media, {"user_id": USER, "media_type": "photo"}),
+     lambda: db.Media.count_where({"user_id": USER, "media_type": "photo"})),
+]
+
+
+def best_time(call, calls: int) -> float:
+    """Seconds per call, best of five runs."""
+    return min(timeit.repeat(call, number=calls, repeat=5)) / calls
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=20_000)
+    parser.add_argument("--media", type=int, default=500, help="media items of the benchmark user")
+    args = parser.parse_args()
+
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Temp.create_table()
+    db.Users.add({"user_id": USER, "username": "bench"}, replace=True)
+    db.Media.import_rows({"user_id": USER, "media_type": ("photo", "gif", "video")[i % 3], "file_id": f"file-{i}",
+                          "caption": None, "description": f"funny cat meme number {i}"} for i in range(args.media))
+    db.Temp.add({"user_id": USER, "key": "state", "value": "waiting"})
+
+    for name, legacy, current in CASES:
+        assert legacy() == current(), f"{name}: results differ"
+        legacy_time = best_time(legacy, args.calls)
+        current_time = best_time(current, args.calls)
+        print(f"{name:<20} legacy {legacy_time * 1e6:7.2f} us/call   cached {current_time * 1e6:7.2f} us/call   "
+              f"x{legacy_time / current_time:.2f}")
+
+    conditions = {"user_id": USER, "file_id": "file-7"}
+    legacy = best_time(lambda: legacy_select(db.Media, conditions, 50, 50, "media_id", "ASC", db.Media.joined_select),
+                       args.calls * 10)
+    current = best_time(lambda: db.Media._statement("select", tuple(conditions), "media_id", "ASC", True, True,
+                                                    db.Media.joined_select), args.calls * 10)
+    print(f"{'Media.get statement':<20} legacy {legacy * 1e6:7.2f} us/call   cached {current * 1e6:7.2f} us/call   "
+          f"x{legacy / current:.2f}")
+
+
+if __name__ == "__main__":
+    main()
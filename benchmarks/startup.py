@@ -0,0 +1,108 @@
+"""
+Measures cold starts of web workers: several fresh processes start at once, like the workers of a WSGI server,
+and each imports flask_app, builds the app with create_app() and handles a first /start update. Reported are
+the time of every phase and whether importing and building the app created files (logs, database files).
+Webhook registration, which every worker used to make on import, is timed separately as manage.py set-webhook
+does it. Bot API requests go to the local stub, --latency simulates the round-trip to Telegram.
+
+Run from the repository root: python -m benchmarks.startup --workers 1,4,8 --latency 0.2
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.e2e import SECRET, TOKEN, Workload, summarize
+from telegram_stub import TelegramStub
+
+
+def created_files() -> list[str]:
+    return sorted(os.listdir(os.path.join(os.environ["HOME"], "mysite")))
+
+
+def run_worker(user_id: int) -> dict:
+    """Starts like a web worker. Expects the environment prepared by main, nothing of the bot is imported yet."""
+    update = Workload(user_id).message(user_id, text="/start")
+    started = time.perf_counter()
+    import flask_app
+    imported = time.perf_counter()
+    files = {"import": created_files()}
+    app = flask_app.create_app()
+    created = time.perf_counter()
+    files["create_app"] = created_files()
+
+    response = app.test_client().post(f"/{SECRET}", json=update)
+    if response.status_code != 200:
+        raise RuntimeError(f"/start answered with {response.status_code}")
+    answered = time.perf_counter()
+    return {"import": imported - started, "create_app": created - imported, "first_update": answered - created,
+            "files": files}
+
+
+def start_workers(count: int, env: dict) -> tuple[float, list[dict]]:
+    """Starts count workers at once, returns the time until all of them answered and their reports."""
+    started = time.perf_counter()
+    processes = [subprocess.Popen([sys.executable, "-m", "benchmarks.startup", "--worker", "--user", str(1000 + i)],
+                                  env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+                 for i in range(count)]
+    reports = []
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"worker exited with {process.returncode}")
+        reports.append(json.loads(output.strip().splitlines()[-1]))
+    return time.perf_counter() - started, reports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,4,8", help="comma-separated numbers of workers started at once")
+    parser.add_argument("--latency", type=float, default=0.2, help="simulated Bot API round-trip in seconds")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--user", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.user)))
+        return
+
+    home = tempfile.mkdtemp(prefix="inline-vault-bench-")
+    os.makedirs(os.path.join(home, "mysite"))
+    stub = TelegramStub(latency=args.latency)
+    env = dict(os.environ, HOME=home, DATABASE_PATH=os.path.join(home, "startup.db"), TELEGRAM_CLIENT="async",
+               TELEGRAM_API_URL=stub.start(), TELEGRAM_TOKEN=TOKEN, SECRET=SECRET, SITE_URL="https://bench.invalid/",
+               PROXY_URL="", WEBHOOK_MODE="sync")
+    os.environ.update(env)
+    import database as db  # the database path is read on import
+    db.Users.migrate()
+    db.Media.migrate()
+    db.States.migrate()
+
+    import flask_app
+    started = time.perf_counter()
+    flask_app.set_webhook()
+    print(f"webhook registration (manage.py set-webhook, once per deployment): "
+          f"{(time.perf_counter() - started) * 1000:.0f}ms")
+
+    for count in (int(count) for count in args.workers.split(",")):
+        # workers share the database, a fresh home shows which files the startup creates
+        worker_home = tempfile.mkdtemp(prefix="inline-vault-bench-")
+        os.makedirs(os.path.join(worker_home, "mysite"))
+        elapsed, reports = start_workers(count, dict(env, HOME=worker_home))
+        phases = {phase: summarize([report[phase] for report in reports])
+                  for phase in ("import", "create_app", "first_update")}
+        print(f"{count} workers: all answered in {elapsed * 1000:.0f}ms")
+        for phase, stats in phases.items():
+            line = f"  {phase:<12} p50={stats['p50_ms']:7.1f}ms max={stats['max_ms']:7.1f}ms"
+            if phase in reports[0]["files"]:
+                created = sorted({name for report in reports for name in report["files"][phase]})
+                line += f"  files after it: {', '.join(created) or 'none'}"
+            print(line)
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
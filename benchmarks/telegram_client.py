@@ -0,0 +1,63 @@
+"""
+Compares blocking telepot calls with the async client against the local Telegram stub.
+
+Run from the repository root: python -m benchmarks.telegram_client --requests 500 --latency 0.02
+"""
+import argparse
+import time
+
+import telepot
+import telepot.api
+
+from bot._api import AsyncTelegramClient
+from telegram_stub import TelegramStub
+
+TOKEN = "123:stub"
+
+
+def bench_telepot(stub: TelegramStub, requests: int) -> float:
+    telepot.api._methodurl = lambda req, **user_kw: f"{stub.url}/bot{req[0]}/{req[1]}"
+    bot = telepot.Bot(TOKEN)
+    started = time.perf_counter()
+    for i in range(requests):
+        bot.sendMessage(i, "benchmark")
+    return time.perf_counter() - started
+
+
+def bench_async(stub: TelegramStub, requests: int, max_connections: int) -> tuple[float, dict]:
+    client = AsyncTelegramClient(TOKEN, api_url=stub.url, max_connections=max_connections)
+    client.start()
+    started = time.perf_counter()
+    futures = [client.request("sendMessage", chat_id=i, text="benchmark") for i in range(requests)]
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - started
+    stats = client.stats()
+    client.close()
+    return elapsed, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.02, help="simulated API round-trip in seconds")
+    parser.add_argument("--max-connections", type=int, default=20)
+    args = parser.parse_args()
+
+    stub = TelegramStub(latency=args.latency)
+    stub.start()
+    try:
+        telepot_time = bench_telepot(stub, args.requests)
+        async_time, stats = bench_async(stub, args.requests, args.max_connections)
+    finally:
+        stub.stop()
+
+    print(f"telepot: {args.requests / telepot_time:8.1f} req/s ({telepot_time:.2f}s)")
+    print(f"async:   {args.requests / async_time:8.1f} req/s ({async_time:.2f}s)")
+    for method, counters in stats.items():
+        print(f"  {method}: count={counters['count']} avg={counters['avg'] * 1000:.1f}ms "
+              f"max={counters['max'] * 1000:.1f}ms retries={counters['retries']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Measures the per-call cost of translate() against the previous implementation, which rebuilt the whole
+translations dict literal and resolved the language on every call.
+
+Run from the repository root: python -m benchmarks.translations --calls 200000
+"""
+import argparse
+import timeit
+
+from translations import TRANSLATIONS, translate
+
+# the previous translate(), with the same dict literal built inside the function on every call
+LEGACY_SOURCE = f'''
+def legacy_translate(lang, key, values=None):
+    translations = {TRANSLATIONS!r}
+    lang = "uk" if lang == "ru" else lang
+    lang = lang if lang in ("en", "uk", "pl") else "en"
+    translation = translations[lang][key]
+    if values:
+        return translation.format(**values)
+    return translation
+'''
+namespace = {}
+exec(LEGACY_SOURCE, namespace)
+legacy_translate = namespace["legacy_translate"]
+
+CASES = [
+    ("plain", ("uk", "deleted")),
+    ("fallback", ("ru", "not found")),
+    ("unknown language", ("de", "open")),
+    ("template", ("pl", "described by", {"description": "cat funny meme"})),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=200_000)
+    args = parser.parse_args()
+
+    for name, call_args in CASES:
+        assert translate(*call_args) == legacy_translate(*call_args)
+        legacy = timeit.timeit(lambda: legacy_translate(*call_args), number=args.calls)
+        current = timeit.timeit(lambda: translate(*call_args), number=args.calls)
+        print(f"{name:<17} legacy {legacy / args.calls * 1e9:7.0f} ns/call   "
+              f"catalog {current / args.calls * 1e9:7.0f} ns/call   x{legacy / current:.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Compares the search modes of Media.search_page on a vault of 100k items: whole words in media_fts,
+fragments from the middle of words in media_trigram, "auto" mode falling back to trigrams for such
+fragments, and the same fragments matched with a LIKE scan. Fragments of frequent words let the scan stop
+early at the page limit, fragments of rare words and fragments no description contains make it read the
+whole vault. Query plans show that the trigram search is served by its index.
+
+Run from the repository root: python -m benchmarks.trigram_search --size 100000
+"""
+import argparse
+import os
+import random
+import sqlite3
+import string
+import tempfile
+import time
+
+home = tempfile.mkdtemp(prefix="inline-vault-bench-")
+os.makedirs(os.path.join(home, "mysite"))
+os.environ["HOME"] = home
+os.environ["DATABASE_PATH"] = os.path.join(home, "trigram_search.db")
+
+import database as db  # noqa: E402, the database path is read on import
+from benchmarks.e2e import VAULT_USER, Workload, summarize  # noqa: E402
+from bot._handlers import LIMIT  # noqa: E402
+
+LIKE_QUERY = """
+    SELECT media.user_id, media.media_type, media.file_id, media.caption, media.media_id, media_fts.description,
+        media.inline_result
+    FROM media
+    JOIN media_fts ON media_fts.rowid = media.media_id
+    WHERE media.user_id = ? AND media_fts.description LIKE ?
+    ORDER BY media.media_id DESC
+    LIMIT ?
+"""
+
+
+def fragment(word: str, rng: random.Random) -> str:
+    """A piece of at least 3 characters that doesn't start the word, so token search can't find it."""
+    length = rng.randint(3, max(3, len(word) - 1))
+    start = rng.randint(1, len(word) - length) if len(word) > length else 0
+    return word[start:start + length]
+
+
+def time_calls(call, queries: list) -> list:
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        call(query)
+        timings.append(time.perf_counter() - started)
+    return timings
+
+
+def plan(query: str, params: tuple) -> str:
+    with sqlite3.connect(db.Media.pool(VAULT_USER).db_path) as connection:
+        rows = connection.execute("EXPLAIN QUERY PLAN " + query, params).fetchall()
+    return "; ".join(row[-1] for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=100_000, help="items in the vault")
+    parser.add_argument("--queries", type=int, default=300, help="queries per mode")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    if not db.TRIGRAM_SEARCH:
+        raise SystemExit(f"Trigram search is disabled or not supported by SQLite {db.sqlite3.sqlite_version}")
+
+    workload = Workload(args.seed)
+    db.Users.migrate()
+    db.Media.migrate()
+    started = time.perf_counter()
+    db.Media.import_rows(workload.vault(args.size))
+    print(f"{args.size} items imported in {time.perf_counter() - started:.1f}s")
+
+    rng = random.Random(args.seed)
+    tokens = [workload.typing()[-1] for _ in range(args.queries)]
+    frequent = [fragment(rng.choice(rng.choice(workload.descriptions).split()), rng) for _ in range(args.queries)]
+    rare = [fragment(rng.choice(workload.words[-len(workload.words) // 3:]), rng) for _ in range(args.queries)]
+    missing = ["".join(rng.choices("qxjz" + string.digits, k=4)) for _ in range(args.queries)]
+
+    def search(mode):
+        return lambda q: db.Media.search_page(VAULT_USER, q, LIMIT, mode=mode)[0]
+
+    def like(q):
+        return db.Media.execute_query(LIKE_QUERY, (VAULT_USER, f"%{q}%", LIMIT + 1))
+
+    cases = [
+        ("token", "typed words", tokens, search("token")),
+        ("auto", "typed words", tokens, search("auto")),
+        ("token", "frequent fragments", frequent, search("token")),
+    ]
+    for queries_name, queries in (("frequent fragments", frequent), ("rare fragments", rare),
+                                  ("missing fragments", missing)):
+        cases += [("trigram", queries_name, queries, search("trigram")),
+                  ("auto", queries_name, queries, search("auto")),
+                  ("LIKE scan", queries_name, queries, like)]
+
+    for mode, queries_name, queries, call in cases:
+        found = sum(bool(call(query)) for query in queries[:50])
+        stats = summarize(time_calls(call, queries))
+        print(f"{mode:<9} {queries_name:<18} p50={stats['p50_ms']:7.2f}ms p95={stats['p95_ms']:7.2f}ms "
+              f"mean={stats['mean_ms']:7.2f}ms  found {found}/50")
+
+    trigram_query = """
+        SELECT media.media_id FROM media_trigram JOIN media ON media.media_id = media_trigram.rowid
+        WHERE media_trigram.description MATCH ? AND media_trigram.user_id = ?
+        ORDER BY media_trigram.rank, media_trigram.rowid LIMIT 51
+    """
+    print("trigram plan:", plan(trigram_query, (db.Media.trigram_expression(rare[0]), VAULT_USER)))
+    print("LIKE plan:   ", plan(LIKE_QUERY, (VAULT_USER, f"%{rare[0]}%", LIMIT + 1)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""
+Compares the two write modes of the database under concurrent saves: "direct", where every thread commits
+its own transaction and waits for the lock, and "queue", where the writer thread merges pending writes into
+one transaction. Threads save media like the save handler does (Media.add and the conversation state).
+In the second round another connection holds the write lock for a while, as a migration batch or another
+process would, to show which saves are lost.
+
+Run from the repository root: python -m benchmarks.write_queue --threads 1,4,16 --saves 200 --hold 6
+Commits don't wait for the disk with SQLITE_SYNCHRONOUS=NORMAL, set it to FULL to include fsync in the timings.
+"""
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+home = tempfile.mkdtemp(prefix="inline-vault-bench-")
+os.makedirs(os.path.join(home, "mysite"))
+os.environ["HOME"] = home
+os.environ["DATABASE_PATH"] = os.path.join(home, "write_queue.db")
+
+import database as db  # noqa: E402, the database path is read on import
+from benchmarks.e2e import summarize  # noqa: E402
+
+FIRST_USER = 1000
+
+
+def save(user_id: int, file_id: str) -> bool:
+    """The queries of saving a photo with its description."""
+    added, _ = db.Media.add({"user_id": user_id, "media_type": "photo", "file_id": file_id, "caption": None,
+                             "description": f"funny cat meme {file_id}"})
+    return added and db.States.save({user_id: {"action": "waiting_for_media"}})
+
+
+def hold_lock(seconds: float, started: threading.Event) -> None:
+    """Keeps the write lock of the database busy, like a long transaction of another process."""
+    connection = sqlite3.connect(db.Database.connection.db_path, isolation_level=None)
+    connection.execute("BEGIN IMMEDIATE;")
+    started.set()
+    time.sleep(seconds)
+    connection.execute("COMMIT;")
+    connection.close()
+
+
+def run(mode: str, threads: int, saves: int, hold: float, run_id: str) -> dict:
+    db.WRITE_MODE = mode
+    latencies = [[] for _ in range(threads)]
+    lost = [0] * threads
+
+    def worker(index: int) -> None:
+        user_id = FIRST_USER + index
+        for i in range(saves):
+            started = time.perf_counter()
+            try:
+                saved = save(user_id, f"{run_id}-{index}-{i}")
+            except sqlite3.Error:
+                saved = False
+            latencies[index].append(time.perf_counter() - started)
+            lost[index] += not saved
+
+    holder_started = threading.Event()
+    holder = threading.Thread(target=hold_lock, args=(hold, holder_started)) if hold else None
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    commits = db.Database.transaction_stats()["commits"]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    if holder is not None:
+        time.sleep(0.05)  # the holder takes the lock while saves are going on
+        holder.start()
+        holder_started.wait()
+    for thread in workers + ([holder] if holder else []):
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    commits = db.Database.transaction_stats()["commits"] - commits
+    stats = summarize([value for values in latencies for value in values], elapsed)
+    return {"saves_per_second": stats["per_second"], "p50_ms": stats["p50_ms"], "p99_ms": stats["p99_ms"],
+            "lost": sum(lost), "saves_per_commit": threads * saves / commits if commits else 1.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--threads", default="1,4,16", help="comma-separated numbers of concurrent threads")
+    parser.add_argument("--saves", type=int, default=200, help="saves per thread")
+    parser.add_argument("--hold", type=float, default=6.0,
+                        help="seconds another connection holds the lock in the second round, 0 skips it")
+    args = parser.parse_args()
+
+    db.Users.migrate()
+    db.Media.migrate()
+    db.States.migrate()
+    max_threads = max(int(threads) for threads in args.threads.split(","))
+    db.Users.add_bulk([{"user_id": FIRST_USER + i, "username": f"bench{i}"} for i in range(max_threads)])
+
+    rounds = [("no lock holder", 0.0)] + ([(f"lock held {args.hold:g}s", args.hold)] if args.hold else [])
+    for round_name, hold in rounds:
+        print(round_name)
+        for threads in (int(threads) for threads in args.threads.split(",")):
+            for mode in ("direct", "queue"):
+                result = run(mode, threads, args.saves, hold, f"{mode}-{threads}-{hold:g}")
+                print(f"  {mode:<6} {threads:>3} threads {result['saves_per_second']:8.0f} saves/s "
+                      f"p50={result['p50_ms']:7.2f}ms p99={result['p99_ms']:8.2f}ms lost {result['lost']:>4}  "
+                      f"{result['saves_per_commit']:5.1f} saves/commit")
+
+
+if __name__ == "__main__":
+    main()
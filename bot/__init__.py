@@ -1,21 +1,43 @@
-import database as db
 import telepot
-from logger import setup_logger, thread_local, set_show_debug
+from logger import setup_logger, begin_update, flush_debug_log
 from translations import translate
 import json
+import os
+import time
+import metrics
+from ._api import AsyncTelegramClient, API_URL
+from ._broadcast import BroadcastEngine
+from ._dispatcher import UpdateDispatcher  # noqa: F401, re-exported for flask_app
 
 
 logger = setup_logger(__name__)
 
+TELEGRAM_CLIENT = os.getenv("TELEGRAM_CLIENT", "telepot")  # "async" sends requests through AsyncTelegramClient
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", API_URL)
+
+
+class LazyJson:
+    """Pretty prints an object as JSON only when a log record with it is actually formatted."""
+    __slots__ = ("obj",)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=4, default=str)
+
 
 class Bot:
     from ._handlers import handle_message, handle_inline_query, media_input_handler, handle_new_media_input, \
         handle_text_input, save_media, check_description, handle_chat_member_status
 
-    def __init__(self, token):
+    def __init__(self, token, proxy=None):
         logger.info('Initializing bot...')
         self.bot = telepot.Bot(token)
         self.users_data = {}
+        self.api = None
+        if TELEGRAM_CLIENT == "async":
+            self.api = AsyncTelegramClient(token, api_url=TELEGRAM_API_URL, proxy=proxy)
 
     def __del__(self):
         logger.info('Deleting bot...')
@@ -23,6 +45,47 @@ class Bot:
     def __getattr__(self, name):
         return getattr(self.bot, name)
 
+    def call_api(self, method, wait=True, order_key=None, **params):
+        """
+        Calls a Bot API method through the async client if it's enabled, otherwise through telepot.
+
+        :param method: Bot API method
+        :param wait: whether to wait for the result. Otherwise a future is returned and failures are only logged.
+            Calls through telepot always wait
+        :param order_key: requests with the same key are sent in the order they were made
+        :return: API result or concurrent.futures.Future of it
+        """
+        if self.api is None:
+            started = time.perf_counter()
+            try:
+                return getattr(self.bot, method)(**params)
+            except Exception:
+                metrics.TELEGRAM_ERRORS.inc(method)
+                raise
+            finally:
+                metrics.TELEGRAM_DURATION.observe(time.perf_counter() - started, method)
+        if wait:
+            return self.api.request(method, order_key=order_key, **params).result()
+
+        def log_failure(f):
+            if not f.cancelled() and f.exception():
+                logger.error(f"{method} failed: {f.exception()}")
+
+        future = self.api.request(method, order_key=order_key, **params)
+        future.add_done_callback(log_failure)
+        return future
+
+    def sendMessage(self, chat_id, text, **kwargs):
+        return self.call_api("sendMessage", chat_id=chat_id, text=text, **kwargs)
+
+    def answerInlineQuery(self, inline_query_id, results, **kwargs):
+        # nothing depends on the answer, so the handler doesn't wait for the round-trip
+        return self.call_api("answerInlineQuery", wait=False, inline_query_id=inline_query_id, results=results,
+                             **kwargs)
+
+    def setWebhook(self, url=None, **kwargs):
+        return self.call_api("setWebhook", url=url, **kwargs)
+
     def deliver_message(self, user, text, reply_to_msg_id=None, reply_markup=None):
         """Deliver a message to a user with optional cancel button and reply markup."""
         if reply_markup:
@@ -30,20 +93,27 @@ class Bot:
         else:
             final_reply_markup = {'remove_keyboard': True}
 
-        response = self.sendMessage(user, text, reply_to_message_id=reply_to_msg_id, reply_markup=final_reply_markup)
+        # the async client doesn't wait for the round-trip, messages to one user still go out in order
+        response = self.call_api("sendMessage", wait=False, order_key=user, chat_id=user, text=text,
+                                 reply_to_message_id=reply_to_msg_id, reply_markup=final_reply_markup)
 
-        logger.debug("Sent message: {}".format(json.dumps(response, indent=4)))
+        if self.api is None:
+            logger.debug("Sent message: %s", LazyJson(response))
 
     def broadcast(self, text: str, reply_markup=None, exceptions=None):
         logger.info("Broadcasting message: {}".format(text))
-        exceptions = exceptions or []
-        logger.info(f"Found {len(exceptions)} exceptions")
-        users = db.Users.execute_query("SELECT user_id FROM users;")
-        for user in users:
-            if user[0] in exceptions:
-                continue
-            self.deliver_message(user[0], text, reply_markup=reply_markup)
-        logger.info(f"Sent to {len(users)} users")
+        broadcast_id = BroadcastEngine.create(text, reply_markup, exceptions)
+        return self.resume_broadcast(broadcast_id)
+
+    def resume_broadcast(self, broadcast_id: int):
+        """Sends a saved broadcast to users it hasn't reached yet. Returns its report."""
+        def send(user, text, reply_markup):
+            self.call_api("sendMessage", chat_id=user, text=text,
+                          reply_markup=reply_markup or {'remove_keyboard': True})
+
+        report = BroadcastEngine(send).run(broadcast_id)
+        logger.info(f"Sent to {report['sent']} users, failed for {report['failed']}")
+        return report
 
     @staticmethod
     def get_user(update):
@@ -64,8 +134,11 @@ class Bot:
     def handle_update(self, update):
         user = None
         lang = None
+        update_type = next((key for key in update if key != "update_id"), "unknown")
+        started = time.perf_counter()
+        begin_update()
         try:
-            logger.debug('Received update: {}'.format(json.dumps(update, indent=4)))  # pretty print logs
+            logger.debug("Received update: %s", LazyJson(update))  # pretty printed only if flushed
 
             user, lang = self.get_user(update)
 
@@ -79,17 +152,9 @@ class Bot:
                 self.handle_chat_member_status(user, lang, update)
 
         except Exception as e:
-            set_show_debug(True)
-
-            # Flush debug logs for this update
-            if hasattr(thread_local, "debug_log_stack"):
-                logger.debug("Debug log stack before crash:")
-                while thread_local.debug_log_stack:
-                    logger.debug(thread_local.debug_log_stack.pop(0))  # Log and remove each debug entry
-                del thread_local.debug_log_stack  # Clear the stack
-
+            metrics.UPDATE_FAILURES.inc(update_type)
+            flush_debug_log()  # debug logs of this update
             logger.critical(f"Couldn't process update: {e}", exc_info=True)
-            set_show_debug(False)
 
             if user and lang:
                 try:
@@ -98,3 +163,6 @@ class Bot:
                     logger.critical(f"Couldn't notify user {user} about error: {e_}")
                 else:
                     logger.info(f"User {user} notified about error")
+
+        finally:
+            metrics.UPDATE_DURATION.observe(time.perf_counter() - started, update_type)
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import re
+import threading
+import time
+
+from telepot import exception
+
+from logger import setup_logger
+import metrics
+
+logger = setup_logger(__name__)
+
+API_URL = "https://api.telegram.org"
+MAX_CONNECTIONS = 20  # keep-alive connections to the API
+MAX_RETRIES = 3  # retries after 429 Too Many Requests
+REQUEST_TIMEOUT = 30  # seconds
+
+
+def _jsonable(value):
+    """Converts telepot namedtuples to dicts and drops None fields, the way telepot serializes them."""
+    if isinstance(value, list):
+        return [_jsonable(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items() if v is not None}
+    if isinstance(value, tuple) and hasattr(value, '_asdict'):
+        return {k: _jsonable(v) for k, v in value._asdict().items() if v is not None}
+    return value
+
+
+def _form_fields(params: dict) -> dict:
+    """Flattens request parameters into form fields, objects are sent JSON-serialized."""
+    fields = {}
+    for key, value in params.items():
+        if value is None:
+            continue
+        value = _jsonable(value)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, separators=(',', ':'))
+        elif isinstance(value, bool):
+            value = "true" if value else "false"
+        fields[key] = str(value)
+    return fields
+
+
+def _telegram_error(data: dict) -> exception.TelegramError:
+    """Builds the same exception telepot would raise for an unsuccessful response."""
+    description, error_code = data.get("description", ""), data.get("error_code")
+    for error_class in exception.TelegramError.__subclasses__():
+        if any(re.search(pattern, description, re.IGNORECASE) for pattern in error_class.DESCRIPTION_PATTERNS):
+            return error_class(description, error_code, data)
+    return exception.TelegramError(description, error_code, data)
+
+
+class AsyncTelegramClient:
+    """
+    Telegram Bot API client running an asyncio event loop on a background thread. Requests from any thread
+    are sent concurrently over a pool of keep-alive connections. Responses with 429 are retried after
+    the retry_after the API asks for. Latency is recorded per API method.
+    """
+    def __init__(self, token: str, api_url: str = API_URL, proxy: str = None, max_connections: int = MAX_CONNECTIONS,
+                 timeout: float = REQUEST_TIMEOUT):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+        self.proxy = proxy
+        self.max_connections = max_connections
+        self.timeout = timeout
+
+        self._loop = None
+        self._thread = None
+        self._session = None
+        self._lock = threading.Lock()
+        self._stats = {}  # method -> dict of counters
+        self._tails = {}  # order key -> task of the last request with that key, only touched on the loop thread
+
+    def start(self) -> None:
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name="telegram-api", daemon=True)
+            self._thread.start()
+        logger.info(f"Telegram API client started for {self.api_url}")
+
+    def close(self) -> None:
+        with self._lock:
+            loop, self._loop = self._loop, None
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result(self.timeout)
+            self._session = None
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join(self.timeout)
+        loop.close()
+
+    def request(self, method: str, order_key=None, **params):
+        """
+        Sends a request without waiting for the response.
+
+        :param method: Bot API method
+        :param order_key: requests with the same key (e.g. chat id) are sent one after another in submission order
+        :return: concurrent.futures.Future resolving to the API result
+        """
+        if self._loop is None:
+            self.start()
+        coroutine = self._request(method, params)
+        if order_key is not None:
+            coroutine = self._ordered(order_key, coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def call(self, method: str, **params):
+        """Sends a request and waits for its result."""
+        return self.request(method, **params).result()
+
+    def stats(self) -> dict:
+        """Returns request counters and latency (in seconds) by API method."""
+        with self._lock:
+            stats = {}
+            for method, counters in self._stats.items():
+                stats[method] = dict(counters, avg=counters["total"] / counters["count"] if counters["count"] else 0.0)
+            return stats
+
+    async def _get_session(self):
+        if self._session is None:
+            import aiohttp  # optional dependency, only needed when the async client is enabled
+
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def _ordered(self, key, coroutine):
+        """Waits for the previous request with the same key before sending this one."""
+        task = asyncio.current_task()
+        previous = self._tails.get(key)
+        self._tails[key] = task
+        try:
+            if previous is not None:
+                await asyncio.wait([previous])
+            return await coroutine
+        finally:
+            if self._tails.get(key) is task:
+                del self._tails[key]
+
+    async def _request(self, method: str, params: dict):
+        session = await self._get_session()
+        url = f"{self.api_url}/bot{self.token}/{method}"
+        fields = _form_fields(params)
+
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                async with session.post(url, data=fields, proxy=self.proxy) as response:
+                    status = response.status
+                    data = await response.json(content_type=None)
+            except Exception:
+                self._record(method, time.monotonic() - started, error=True)
+                raise
+            self._record(method, time.monotonic() - started, error=not data.get("ok"))
+
+            if data.get("ok"):
+                return data["result"]
+
+            if (status == 429 or data.get("error_code") == 429) and attempt < MAX_RETRIES:
+                retry_after = data.get("parameters", {}).get("retry_after", 1)
+                attempt += 1
+                self._record_retry(method)
+                logger.warning(f"{method} was rate limited, retrying in {retry_after}s. Attempt {attempt}/{MAX_RETRIES}")
+                await asyncio.sleep(retry_after)
+                continue
+
+            raise _telegram_error(data)
+
+    def _counters(self, method: str) -> dict:
+        return self._stats.setdefault(method, {"count": 0, "errors": 0, "retries": 0, "total": 0.0, "max": 0.0})
+
+    def _record(self, method: str, elapsed: float, error: bool) -> None:
+        metrics.TELEGRAM_DURATION.observe(elapsed, method)
+        if error:
+            metrics.TELEGRAM_ERRORS.inc(method)
+        with self._lock:
+            counters = self._counters(method)
+            counters["count"] += 1
+            counters["errors"] += error
+            counters["total"] += elapsed
+            counters["max"] = max(counters["max"], elapsed)
+
+    def _record_retry(self, method: str) -> None:
+        metrics.TELEGRAM_RETRIES.inc(method)
+        with self._lock:
+            self._counters(method)["retries"] += 1
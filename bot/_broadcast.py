@@ -0,0 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import threading
+import time
+
+from telepot import exception
+
+import database as db
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+RATE = 25  # messages per second, Telegram allows about 30 to different chats
+SENDERS = 8
+BATCH_SIZE = 100  # users per checkpoint, at most one batch is sent again after a crash
+MAX_RETRIES = 3  # retries of a single message after 429 Too Many Requests
+
+
+class TokenBucket:
+    """Thread-safe token bucket, acquire() blocks until a token is available."""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class BroadcastEngine:
+    """
+    Sends a message to every user. Users are read from the users table in batches ordered by user_id and
+    messages are sent by a pool of senders sharing one rate limiter. After every batch the last user_id and
+    the failures are saved, so an interrupted broadcast resumes where it stopped.
+    """
+    def __init__(self, send, rate: float = RATE, senders: int = SENDERS, batch_size: int = BATCH_SIZE):
+        """
+        :param send: callable(user_id, text, reply_markup) delivering one message, raises on failure
+        """
+        self.send = send
+        self.bucket = TokenBucket(rate)
+        self.senders = senders
+        self.batch_size = batch_size
+
+    @staticmethod
+    def create(text: str, reply_markup=None, exceptions=None) -> int:
+        """Saves a new broadcast and returns its id."""
+        status, broadcast_id = db.Broadcasts.add({
+            "text": text,
+            "reply_markup": json.dumps(reply_markup) if reply_markup else None,
+            "exceptions": json.dumps(list(exceptions or [])),
+        })
+        if not status:
+            raise RuntimeError("Couldn't save broadcast")
+        logger.info(f"Created broadcast {broadcast_id}: {text}")
+        return broadcast_id
+
+    @staticmethod
+    def report(broadcast_id: int) -> dict:
+        return db.Broadcasts.get({"broadcast_id": broadcast_id}, include_column_names=True)
+
+    def run(self, broadcast_id: int) -> dict:
+        """Sends a new broadcast or resumes an interrupted one. Returns its report."""
+        broadcast = self.report(broadcast_id)
+        if not broadcast:
+            raise ValueError(f"Broadcast {broadcast_id} not found")
+        if broadcast["status"] == "done":
+            logger.info(f"Broadcast {broadcast_id} is already done")
+            return broadcast
+
+        text = broadcast["text"]
+        reply_markup = json.loads(broadcast["reply_markup"]) if broadcast["reply_markup"] else None
+        exceptions = set(json.loads(broadcast["exceptions"] or "[]"))
+        last_user_id = broadcast["last_user_id"]
+        logger.info(f"Running broadcast {broadcast_id} from user {last_user_id}, {len(exceptions)} exceptions")
+        db.Broadcasts.set({"broadcast_id": broadcast_id}, {"status": "running"})
+
+        started = time.monotonic()
+        total_sent = total_failed = 0
+        with ThreadPoolExecutor(max_workers=self.senders, thread_name_prefix="broadcast") as pool:
+            while True:
+                users = db.Users.get_ids_after(last_user_id, self.batch_size)
+                if not users:
+                    break
+
+                recipients = [user for user in users if user not in exceptions]
+                errors = list(pool.map(lambda user: self._deliver(user, text, reply_markup), recipients))
+                failures = [{"broadcast_id": broadcast_id, "user_id": user, "error": error}
+                            for user, error in zip(recipients, errors) if error is not None]
+                sent, failed = len(recipients) - len(failures), len(failures)
+                last_user_id = users[-1]
+                with db.Database.transaction():
+                    if failures:
+                        db.BroadcastFailures.add_bulk(failures)
+                    db.Broadcasts.record_progress(broadcast_id, last_user_id, sent, failed)
+
+                total_sent += sent
+                total_failed += failed
+                elapsed = time.monotonic() - started
+                logger.info(f"Broadcast {broadcast_id}: {total_sent} sent, {total_failed} failed, "
+                            f"{(total_sent + total_failed) / elapsed:.1f} msg/s")
+
+        db.Broadcasts.set({"broadcast_id": broadcast_id}, {"status": "done"})
+        logger.info(f"Broadcast {broadcast_id} done in {time.monotonic() - started:.1f}s")
+        return self.report(broadcast_id)
+
+    def _deliver(self, user: int, text: str, reply_markup) -> str or None:
+        """Sends one message, returns error description if it failed."""
+        for attempt in range(MAX_RETRIES + 1):
+            self.bucket.acquire()
+            try:
+                self.send(user, text, reply_markup)
+                return None
+            except exception.TooManyRequestsError as e:
+                retry_after = e.json.get("parameters", {}).get("retry_after", 1)
+                logger.warning(f"Broadcast was rate limited, retrying in {retry_after}s")
+                time.sleep(retry_after)
+            except exception.TelegramError as e:
+                return e.description  # e.g. user blocked the bot
+            except Exception as e:
+                logger.error(f"Couldn't deliver broadcast to {user}: {e}")
+                return str(e)
+        return "Too many requests"
@@ -0,0 +1,114 @@
+import queue
+import threading
+import time
+
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+WORKERS = 4
+QUEUE_SIZE = 1000  # per worker
+STOP_TIMEOUT = 10  # seconds to drain queues on shutdown
+
+
+class UpdateDispatcher:
+    """
+    Processes updates on a pool of worker threads. Updates are sharded by user, every worker has its own queue,
+    so updates of one user are processed by the same worker in the order they were submitted. This keeps
+    the conversation state machine consistent while different users are served in parallel. The order holds
+    within one dispatcher only: updates delivered concurrently may be submitted in any order.
+    """
+    def __init__(self, handler, key, workers: int = WORKERS, queue_size: int = QUEUE_SIZE):
+        """
+        :param handler: callable processing a single update
+        :param key: callable returning the user an update belongs to, may raise KeyError
+        :param workers: number of worker threads
+        :param queue_size: maximum number of pending updates per worker
+        """
+        self.handler = handler
+        self.key = key
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = []
+        self._lock = threading.Lock()
+        self._counters_lock = threading.Lock()  # counters are updated by all workers and request threads
+
+        self.processed = 0
+        self.rejected = 0
+        self.failed = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self.threads:
+                return
+            for i, worker_queue in enumerate(self.queues):
+                thread = threading.Thread(target=self._worker, args=(worker_queue,), name=f"update-worker-{i}",
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        logger.info(f"Update dispatcher started with {len(self.queues)} workers")
+
+    def submit(self, update: dict) -> bool:
+        """
+        Enqueues update for processing.
+
+        :param update: Telegram update
+        :return: False if the worker's queue is full and the update was rejected
+        """
+        if not self.threads:
+            self.start()
+
+        try:
+            user = self.key(update)
+        except KeyError:
+            user = update.get("update_id", 0)  # no user to keep order for
+
+        worker_queue = self.queues[hash(user) % len(self.queues)]
+        try:
+            worker_queue.put_nowait((time.monotonic(), update))
+        except queue.Full:
+            with self._counters_lock:
+                self.rejected += 1
+            logger.warning(f"Update queue is full, rejected update {update.get('update_id')} of user {user}")
+            return False
+        return True
+
+    def stop(self, timeout: float = STOP_TIMEOUT) -> None:
+        """Lets workers finish pending updates and stops them."""
+        with self._lock:
+            threads, self.threads = self.threads, []
+        for worker_queue in self.queues:
+            worker_queue.put(None)
+        deadline = time.monotonic() + timeout
+        for thread in threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+        logger.info("Update dispatcher stopped")
+
+    def stats(self) -> dict:
+        with self._counters_lock:
+            return {
+                "workers": len(self.queues),
+                "queued": [worker_queue.qsize() for worker_queue in self.queues],
+                "processed": self.processed,
+                "rejected": self.rejected,
+                "failed": self.failed,
+            }
+
+    def _worker(self, worker_queue: queue.Queue) -> None:
+        while True:
+            item = worker_queue.get()
+            if item is None:
+                worker_queue.task_done()
+                break
+
+            enqueued_at, update = item
+            try:
+                logger.debug(f"Update {update.get('update_id')} waited {time.monotonic() - enqueued_at:.3f}s in queue")
+                self.handler(update)
+                with self._counters_lock:
+                    self.processed += 1
+            except Exception as e:
+                with self._counters_lock:
+                    self.failed += 1
+                logger.critical(f"Worker failed to process update: {e}", exc_info=True)
+            finally:
+                worker_queue.task_done()
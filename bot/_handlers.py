@@ -1,9 +1,10 @@
-from telepot.namedtuple import InlineQueryResultCachedAudio, InlineQueryResultCachedDocument, \
-    InlineQueryResultCachedGif, InlineQueryResultCachedPhoto, InlineQueryResultCachedSticker, \
-    InlineQueryResultCachedVideo, InlineQueryResultCachedVoice, InlineQueryResultArticle, InputTextMessageContent
 from telepot.namedtuple import InlineKeyboardMarkup, InlineKeyboardButton
 import database as db
+from inline_results import assemble_results, build_fragment
+from cache import inline_cache
+from state import state_store
 from logger import setup_logger
+import metrics
 import string
 from translations import translate
 
@@ -13,6 +14,7 @@ LIMIT = 50
 CACHETIME = 10
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def handle_message(self, user, lang, update):
     message = update.get("message", {})
     if "text" in update["message"]:
@@ -33,21 +35,21 @@ def handle_message(self, user, lang, update):
                 logger.info(f"New user added: {username}")
             self.deliver_message(user, translate(lang, "start"), reply_markup=keyboard)
         elif text.startswith("/description"):
-            db.Temp.add({"user_id": user, "key": "status", "value": "check description"})
+            state_store.update(user, {"status": "check description"})
             self.deliver_message(user, translate(lang, "check description"))
             logger.debug(f"User {user} changed status to check description")
         elif text.startswith("/delete"):
-            db.Temp.add({"user_id": user, "key": "status", "value": "delete"})
+            state_store.update(user, {"status": "delete"})
             self.deliver_message(user, translate(lang, "delete"))
             logger.debug(f"User {user} changed status to delete")
         elif text.startswith("/cancel"):
-            db.Temp.delete({"user_id": user})
+            state_store.clear(user)
             self.deliver_message(user, translate(lang, "cancelled"))
-            logger.debug(f"User {user} cleared temp")
+            logger.debug(f"User {user} cleared state")
         elif text.startswith("/done"):
-            db.Temp.delete({"user_id": user})
+            state_store.clear(user)
             self.deliver_message(user, translate(lang, "finish deleting"))
-            logger.debug(f"User {user} cleared temp")
+            logger.debug(f"User {user} cleared state")
         else:
             self.handle_text_input(user, lang, update)
 
@@ -58,16 +60,19 @@ def handle_message(self, user, lang, update):
         logger.warning(f"Couldn't recognize update: {update}")
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def check_description(self, user, lang, file_id):
-    description = db.Media.get({"user_id": user, "file_id": file_id}, include_column_names=True).get("description", None)
+    record = db.Media.find(user, file_id)
+    description = record.description if record else None
     if not description:
         self.deliver_message(user, translate(lang, "not found"))
     else:
         self.deliver_message(user, translate(lang, "described by", {"description": description}))
-    db.Temp.delete({"user_id": user})  # cleanup
-    logger.debug(f"User {user} cleared temp")
+    state_store.clear(user)  # cleanup
+    logger.debug(f"User {user} cleared state")
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def save_media(self, user, lang, description, media_type, file_id, caption):
     if db.Media.add({"user_id": user, "media_type": media_type, "file_id": file_id, "description": description,
                      "caption": caption})[0]:
@@ -77,19 +82,19 @@ def save_media(self, user, lang, description, media_type, file_id, caption):
         self.deliver_message(user, translate(lang, "duplicate"))
         self.check_description(user, lang, file_id)
 
-    db.Temp.delete({"user_id": user})  # cleanup
-    logger.debug(f"User {user} cleared temp")
+    state_store.clear(user)  # cleanup
+    logger.debug(f"User {user} cleared state")
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def handle_text_input(self, user, lang, update):
     text = update["message"]["text"]
-    match db.Temp.get({"user_id": user, "key": "status"}, include_column_names=True).get("value", None):  # status
+    state = state_store.get(user)
+    match state.get("status"):
         case "description":
-            temp_data = db.Temp.get({"user_id": user}, include_column_names=True)
-            temp_dict = {item["key"]: item["value"] for item in temp_data}  # combine all key-value pairs in one dict
-            media_type = temp_dict.get("media_type")
-            file_id = temp_dict.get("file_id")
-            caption = temp_dict.get("caption", None)
+            media_type = state.get("media_type")
+            file_id = state.get("file_id")
+            caption = state.get("caption", None)
             description = normalize_text(text)
             self.save_media(user, lang, description, media_type, file_id, caption)
 
@@ -100,7 +105,7 @@ def handle_text_input(self, user, lang, update):
             self.check_description(user, lang, text)
 
         case "delete":
-            if db.Media.delete({"user_id": user, "file_id": text}):
+            if db.Media.delete_by_file_id(user, text):
                 self.deliver_message(user, translate(lang, "deleted"))
                 logger.info(f"User {user} deleted {text}")
             else:
@@ -110,29 +115,31 @@ def handle_text_input(self, user, lang, update):
             raise ValueError("Unsupported status")
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def media_input_handler(self, user, lang, update):
     message = update.get('message', {})
     caption = message.get('caption', None)
 
     media_type, file_id = extract_media_info(message)
 
-    match db.Temp.get({"user_id": user, "key": "status"}, include_column_names=True).get("value", None):
+    state = state_store.get(user)
+    match state.get("status"):
         case None:
             self.handle_new_media_input(user, lang, media_type, file_id, caption)
 
         case "description":
-            if db.Temp.get({"user_id": user, "key": "media_type"}, include_column_names=True)["value"] != "article":
+            if state["media_type"] != "article":
                 self.handle_new_media_input(user, lang, media_type, file_id, caption)
             else:  # description was sent before the main media, usually by forwarding
                 # text of the message is stored in file_id
-                description = normalize_text(db.Temp.get({"user_id": user, "key": "file_id"}, include_column_names=True)["value"])
+                description = normalize_text(state["file_id"])
                 self.save_media(user, lang, description, media_type, file_id, caption)
 
         case "check description":
             self.check_description(user, lang, file_id)
 
         case "delete":
-            if db.Media.delete({"user_id": user, "file_id": file_id}):
+            if db.Media.delete_by_file_id(user, file_id):
                 self.deliver_message(user, translate(lang, "deleted"))
                 logger.info(f"User {user} deleted {file_id}")
             else:
@@ -177,36 +184,38 @@ def extract_media_info(message):
     return media_type, file_id
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def handle_new_media_input(self, user, lang, media_type, file_id, caption=None):
-    data = [{"user_id": user, "key": "media_type", "value": media_type},
-            {"user_id": user, "key": "file_id", "value": file_id},
-            {"user_id": user, "key": "status", "value": "description"}]  # set status to description
+    state = {"media_type": media_type, "file_id": file_id, "status": "description"}  # set status to description
 
     if caption:
-        data.append({"user_id": user, "key": "caption", "value": caption})
+        state["caption"] = caption
 
-    db.Temp.add_bulk(data)
+    state_store.replace(user, state)
     logger.debug(f"User {user} sent: media_type={media_type}, file_id={file_id}")
     logger.debug(f"User {user} changed status to description")
     self.deliver_message(user, translate(lang, "describe"))
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def handle_inline_query(self, user, lang, update):
     query_id = update["inline_query"]["id"]
     query_text = normalize_text(update["inline_query"]["query"])
-    offset = update["inline_query"]["offset"]
-    offset = int(offset) if offset != "" else 0
+    offset = update["inline_query"]["offset"]  # page token of the previous answer, "" for the first page
 
     logger.info(f"Incoming inline query: user={user}, lang={lang}, offset={offset}, text=\"{query_text}\"")
 
-    fetched, total = db.Media.search_by_description(user, query_text, limit=LIMIT, offset=offset)
-    next_offset = offset + LIMIT
-    if next_offset > total:
-        next_offset = ""
+    generation = inline_cache.current_generation(user, db.MediaGenerations.current)  # changes made meanwhile bump it
+    cached = inline_cache.get(user, query_text, offset, generation)
+    if cached is not None:
+        results, next_offset = cached
+        logger.debug(f"Inline cache hit: user={user}, offset={offset}, text=\"{query_text}\"")
     else:
-        next_offset = str(next_offset)
+        fetched, next_offset = db.Media.search_page(user, query_text, limit=LIMIT, page_token=offset)
+        results = build_inline_results(fetched)
+        inline_cache.set(user, query_text, offset, (results, next_offset), generation)
 
-    if not fetched:
+    if not results:
         key = "empty" if query_text else "no records"
 
         self.answerInlineQuery(
@@ -218,71 +227,6 @@ def handle_inline_query(self, user, lang, update):
             switch_pm_parameter="default"
         )
     else:
-        results = []
-
-        for element in fetched:
-            user_id, media_type, file_id, caption, media_id, description = element
-
-            match media_type:
-                case "gif":
-                    results.append(InlineQueryResultCachedGif(
-                        id=str(media_id),
-                        gif_file_id=file_id,
-                        title=description,
-                        caption=caption
-                    ))
-                case "audio":
-                    results.append(InlineQueryResultCachedAudio(
-                        id=str(media_id),
-                        audio_file_id=file_id,
-                        title=description,
-                        caption=caption
-                    ))
-                case "document":
-                    results.append(InlineQueryResultCachedDocument(
-                        id=str(media_id),
-                        document_file_id=file_id,
-                        title=description,
-                        caption=caption
-                    ))
-                case "photo":
-                    results.append(InlineQueryResultCachedPhoto(
-                        id=str(media_id),
-                        photo_file_id=file_id,
-                        title=description,
-                        caption=caption
-                    ))
-                case "sticker":
-                    results.append(InlineQueryResultCachedSticker(
-                        id=str(media_id),
-                        sticker_file_id=file_id,
-                        title=description,
-                    ))
-                case "video":
-                    results.append(InlineQueryResultCachedVideo(
-                        id=str(media_id),
-                        video_file_id=file_id,
-                        title=description,
-                        caption=caption
-                    ))
-                case "voice":
-                    results.append(InlineQueryResultCachedVoice(
-                        id=str(media_id),
-                        voice_file_id=file_id,
-                        title=description,
-                        caption=caption
-                    ))
-
-                case "article":
-                    results.append(InlineQueryResultArticle(
-                        id=str(media_id),
-                        title='Text',
-                        input_message_content=InputTextMessageContent(
-                            message_text=file_id
-                        ),
-                        description=description
-                    ))
-
         self.answerInlineQuery(
             query_id,
             results,
@@ -294,6 +238,19 @@ def handle_inline_query(self, user, lang, update):
         )
 
 
+def build_inline_results(fetched):
+    """
+    Assembles the results parameter of answerInlineQuery from fetched media rows.
+    Rows without a precomputed inline result (not migrated yet) are serialized on the fly.
+
+    :return: JSON array text, "" if there are no results
+    """
+    return assemble_results(
+        (media_id, inline_result or build_fragment(media_type, file_id, caption, description))
+        for user_id, media_type, file_id, caption, media_id, description, inline_result in fetched
+    )
+
+
 def normalize_text(text):
     text = text.lower()
     text = text.translate(str.maketrans("", "", string.punctuation))  # remove punctuation
@@ -302,14 +259,19 @@ def normalize_text(text):
     return text
 
 
+@metrics.timed(metrics.HANDLER_DURATION)
 def handle_chat_member_status(self, user, lang, update):
     old_status = update["my_chat_member"]["old_chat_member"]["status"]
     new_status = update["my_chat_member"]["new_chat_member"]["status"]
 
     if old_status == "member" and new_status == "kicked":
         logger.info(f"User {user} has blocked the bot")
-        db.Media.delete({"user_id": user})  # tables with fts don't support references, so it has to be separately
-        db.Users.delete({"user_id": user})  # temp data is linked to user_id and will be deleted too
+        state_store.forget(user)  # before deleting, so a running write-behind flush can't save the state again
+        with db.Database.transaction():
+            db.Media.delete({"user_id": user})  # tables with fts don't support references, so it has to be separately
+            db.States.delete({"user_id": user})  # references to users don't cross shard files
+            db.Users.delete({"user_id": user})
+        inline_cache.invalidate(user)
         logger.info(f"All records of {user} have been deleted")
     elif old_status == "kicked" and new_status == "member":
         logger.info(f"User {user} has unblocked the bot")
@@ -0,0 +1,140 @@
+from collections import OrderedDict
+import threading
+import time
+
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+INLINE_CACHE_SIZE = 2048
+INLINE_CACHE_TTL = 5  # seconds, bounds staleness that generations don't track, e.g. a search setting changed
+INLINE_GENERATION_TTL = 1.0  # seconds a generation read from the database is reused, changes of other processes
+
+
+class InlineQueryCache:
+    """
+    Bounded LRU cache with TTL for ready-to-send inline query answers.
+
+    Entries are keyed by (user_id, normalized query, offset) and additionally indexed by user,
+    so that all entries of a single user can be dropped as soon as their vault changes.
+    invalidate only reaches the cache of the current process, so every entry is also tagged with
+    the generation of user's media it was computed at (see database.MediaGenerations) and served
+    only while the generation is unchanged. Generations are reused for generation_ttl seconds, so
+    repeated queries don't read them from the database every time.
+    """
+    def __init__(self, maxsize: int = INLINE_CACHE_SIZE, ttl: float = INLINE_CACHE_TTL,
+                 generation_ttl: float = INLINE_GENERATION_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation_ttl = generation_ttl
+        self._entries = OrderedDict()  # key -> (expires_at, generation, value)
+        self._user_keys = {}  # user_id -> set of keys
+        self._generations = {}  # user_id -> (expires_at, generation)
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.stale = 0
+        self.generation_reads = 0
+
+    def get(self, user_id: int, query: str, offset: str, generation: int = 0):
+        """Returns cached value or None if there is no fresh entry of the generation for the key."""
+        key = (user_id, query, offset)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            expires_at, entry_generation, value = entry
+            if expires_at < time.monotonic() or entry_generation != generation:
+                self._remove(key)
+                self.stale += entry_generation != generation
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def current_generation(self, user_id: int, load) -> int:
+        """
+        Returns the generation of user's media, read with load(user_id) unless it was read recently.
+        Must be called before computing a value to store.
+        """
+        now = time.monotonic()
+        with self._lock:
+            remembered = self._generations.get(user_id)
+            if remembered is not None and remembered[0] >= now:
+                return remembered[1]
+            invalidations = self.invalidations
+
+        generation = load(user_id)
+        with self._lock:
+            self.generation_reads += 1
+            if self.invalidations != invalidations:  # may have been read before the change, don't reuse it
+                return generation
+            if len(self._generations) >= self.maxsize:
+                self._generations = {user: item for user, item in self._generations.items() if item[0] >= now}
+            self._generations[user_id] = (now + self.generation_ttl, generation)
+        return generation
+
+    def set(self, user_id: int, query: str, offset: str, value, generation: int = 0) -> None:
+        """
+        Stores value computed at the generation, which must be read before computing it: if the media changed
+        meanwhile, the entry is tagged with an old generation and never served.
+        """
+        key = (user_id, query, offset)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self._entries[key] = (time.monotonic() + self.ttl, generation, value)
+            self._user_keys.setdefault(user_id, set()).add(key)
+
+            while len(self._entries) > self.maxsize:
+                oldest_key = next(iter(self._entries))
+                self._remove(oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, user_id: int = None) -> None:
+        """Drops all entries of the user. Drops everything if user_id is None."""
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+                self._user_keys.clear()
+                self._generations.clear()
+            else:
+                for key in self._user_keys.pop(user_id, ()):
+                    self._entries.pop(key, None)
+                self._generations.pop(user_id, None)  # changed by this process, read it again
+            self.invalidations += 1
+        logger.debug(f"Inline cache invalidated for user {user_id}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "stale": self.stale,
+                "generation_reads": self.generation_reads,
+            }
+
+    def _remove(self, key) -> None:
+        """Removes a single entry. Must be called with the lock held."""
+        self._entries.pop(key, None)
+        user_keys = self._user_keys.get(key[0])
+        if user_keys is not None:
+            user_keys.discard(key)
+            if not user_keys:
+                del self._user_keys[key[0]]
+
+
+inline_cache = InlineQueryCache()
@@ -1,28 +1,637 @@
 import sqlite3
 import os
+import queue
 import time
-
-from logger import setup_logger
+import base64
+import itertools
+import json
+import re
+import struct
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from contextlib import ExitStack, contextmanager, nullcontext
+from typing import NamedTuple
+
+from logger import setup_logger, setup_slow_query_logger
+from cache import inline_cache
+import metrics
+from inline_results import build_fragment
 
 MAX_RETRIES = 3
 INITIAL_DELAY = 0.5
 
+# connection pool and pragmas, can be tuned through environment variables
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 8))
+SQLITE_POOL_TIMEOUT = float(os.getenv("SQLITE_POOL_TIMEOUT", 10))  # seconds to wait for a free connection
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")  # NORMAL is durable enough in WAL mode
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -16000))  # pages, or KiB if negative
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+DATABASE_PATH = os.getenv("DATABASE_PATH", "data.db")  # relative paths are resolved against ~/mysite
+# database files the per-user tables are spread over by user_id, users and broadcasts stay in DATABASE_PATH
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 1))
+
+WRITE_MODE = os.getenv("WRITE_MODE", "queue")  # "direct" commits every write on the thread that makes it
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 256))  # queued writes merged into one transaction at most
+WRITE_RETRY_MAX_DELAY = 2.0  # seconds, longest pause of the writer while another process holds the lock
+WRITE_TIMEOUT = float(os.getenv("WRITE_TIMEOUT", 15))  # seconds a write waits for the lock before it fails
+QUEUED_STATEMENT = re.compile(r"\s*(INSERT|UPDATE|DELETE|REPLACE)\b", re.IGNORECASE)  # executed by the writer
+
+SLOW_QUERY_THRESHOLD = float(os.getenv("SLOW_QUERY_THRESHOLD", 0.1))  # seconds, statements over it are logged
+
+STATEMENT_CACHE_SIZE = 512  # statements compiled by the generic query builder
+FETCH_BATCH_SIZE = 500  # rows fetched at once when iterating over results
+IMPORT_CHUNK_SIZE = 1000  # rows inserted per transaction by Media.import_rows
+
+FTS_MIGRATION_BATCH_SIZE = 1000
+FTS_MIGRATION_PAUSE = 0.05  # seconds between batches, lets other writers take the lock
+
+# rowid of media_fts is media_id, prefix indexes serve the trailing "term*" of search queries
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING fts5(
+    description,
+    user_id UNINDEXED,
+    prefix = '2 3'
+);
+"""
+
+# substring search, every three characters of a description are a token, requires SQLite 3.34
+TRIGRAM_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS {table_name} USING fts5(
+    description,
+    user_id UNINDEXED,
+    tokenize = 'trigram'
+);
+"""
+TRIGRAM_SEARCH = os.getenv("TRIGRAM_SEARCH", "1") != "0" and sqlite3.sqlite_version_info >= (3, 34, 0)
+TRIGRAM_MIN_LENGTH = 3  # shorter terms can't match any trigram
+SEARCH_MODE = os.getenv("SEARCH_MODE", "auto")  # token, trigram, or auto: trigram when token search finds nothing
+
+RANKED_TOKEN_PREFIX = "r"  # page token of a description search: last (rank, media_id)
+TRIGRAM_TOKEN_PREFIX = "t"  # page token of a trigram search: last (rank, media_id)
+LISTING_TOKEN_PREFIX = "l"  # page token of the empty-query listing: last media_id
+
+# per-user tables in separate shard files can't reference users, which stays in the global file
+USERS_FOREIGN_KEY = re.compile(r"FOREIGN KEY \(user_id\) REFERENCES users\(user_id\) ON DELETE CASCADE\s*,"
+                               r"|,\s*FOREIGN KEY \(user_id\) REFERENCES users\(user_id\) ON DELETE CASCADE")
+
 logger = setup_logger(__name__)
+slow_query_logger = setup_slow_query_logger()
+
+
+def database_file(name: str) -> str:
+    """Returns the absolute path of a database file, relative names are resolved against ~/mysite."""
+    return os.path.join(os.path.expanduser("~/mysite"), os.path.expanduser(name))
+
+
+def shard_path(index: int, shard_count: int = SHARD_COUNT) -> str:
+    """Returns the name of a shard file, e.g. data.shard0.db. A single shard is the global database file."""
+    if shard_count == 1:
+        return DATABASE_PATH
+    root, extension = os.path.splitext(DATABASE_PATH)
+    return f"{root}.shard{index}{extension or '.db'}"
+
+
+def shard_index(user_id: int, shard_count: int = SHARD_COUNT) -> int:
+    """Returns the shard the rows of a user are stored in."""
+    return int(user_id) % shard_count
+
+
+def encode_page_token(media_id: int, rank: float = None, mode: str = "token") -> str:
+    """
+    Encodes the position of the last returned row into an opaque page token, which fits
+    into Telegram's 64-byte next_offset.
+
+    :param media_id: media_id of the last returned row
+    :param rank: FTS rank of the last returned row, None for the empty-query listing
+    :param mode: "token" or "trigram", the search the next pages continue with
+    :return: page token
+    """
+    if rank is None:
+        prefix, payload = LISTING_TOKEN_PREFIX, struct.pack(">q", media_id)
+    else:
+        prefix = TRIGRAM_TOKEN_PREFIX if mode == "trigram" else RANKED_TOKEN_PREFIX
+        payload = struct.pack(">dq", rank, media_id)
+    return prefix + base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def decode_page_token(token: str) -> tuple[float or None, int, str or None]:
+    """
+    Decodes a page token created by encode_page_token.
+
+    :param token: page token
+    :return: tuple of (rank, media_id, mode), rank and mode are None for the empty-query listing
+    """
+    prefix, payload = token[:1], token[1:]
+    try:
+        payload = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+        if prefix == LISTING_TOKEN_PREFIX:
+            return None, struct.unpack(">q", payload)[0], None
+        if prefix in (RANKED_TOKEN_PREFIX, TRIGRAM_TOKEN_PREFIX):
+            return *struct.unpack(">dq", payload), "trigram" if prefix == TRIGRAM_TOKEN_PREFIX else "token"
+    except (ValueError, struct.error):
+        pass
+    raise ValueError(f"Invalid page token: {token}")
+
+
+class MediaRecord(NamedTuple):
+    """A media item with its description, as returned by Media.find."""
+    media_id: int
+    user_id: int
+    media_type: str
+    file_id: str
+    caption: str or None
+    description: str or None
+
+
+class QueryStats:
+    """
+    Aggregates execution time per statement template. Statements slower than the threshold are written to
+    the slow query log, the first slow execution of a template also with its EXPLAIN QUERY PLAN.
+    """
+    def __init__(self, threshold: float = SLOW_QUERY_THRESHOLD):
+        self.threshold = threshold
+        self._stats = {}  # template -> [count, total, max, slow]
+        self._explained = set()
+        self._lock = threading.Lock()
+
+    def record(self, connection: sqlite3.Connection, query: str, params, multiple: bool, elapsed: float) -> None:
+        template = metrics.statement_template(query)
+        metrics.QUERY_DURATION.observe(elapsed, template)
+
+        slow = elapsed >= self.threshold
+        with self._lock:
+            stats = self._stats.get(template)
+            if stats is None:
+                stats = self._stats[template] = [0, 0.0, 0.0, 0]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            if not slow:
+                return
+            stats[3] += 1
+            explain = template not in self._explained
+            self._explained.add(template)
+
+        message = f"{elapsed * 1000:.1f}ms {template}"
+        if explain:
+            message += "\n" + self.explain(connection, query, params, multiple)
+        slow_query_logger.info(message)
+
+    @staticmethod
+    def explain(connection: sqlite3.Connection, query: str, params, multiple: bool) -> str:
+        """Returns EXPLAIN QUERY PLAN of the statement as an indented tree."""
+        if multiple:
+            params = next(iter(params), ()) if isinstance(params, (list, tuple)) else ()  # plan of the first row
+        try:
+            rows = connection.execute(f"EXPLAIN QUERY PLAN {query}", tuple(params)).fetchall()
+        except sqlite3.Error as e:
+            return f"    plan unavailable: {e}"
+        depth = {0: 0}
+        lines = []
+        for node_id, parent_id, _, detail in rows:
+            depth[node_id] = depth.get(parent_id, 0) + 1
+            lines.append("    " * depth[node_id] + detail)
+        return "\n".join(lines) if lines else "    no plan"
+
+    def snapshot(self, reset: bool = False) -> list[dict]:
+        """Returns stats of every template, the ones with the most total time first."""
+        with self._lock:
+            items = list(self._stats.items())
+            if reset:
+                self._stats.clear()
+                self._explained.clear()
+        return sorted(({"statement": template, "count": count, "total": total, "avg": total / count, "max": maximum,
+                        "slow": slow} for template, (count, total, maximum, slow) in items),
+                      key=lambda stats: stats["total"], reverse=True)
+
+    def dump(self, reset: bool = False) -> list[dict]:
+        """Writes stats to the slow query log and returns them."""
+        snapshot = self.snapshot(reset)
+        lines = [f"{stats['count']:>8} {stats['total'] * 1000:>10.1f}ms total {stats['avg'] * 1000:>8.2f}ms avg "
+                 f"{stats['max'] * 1000:>8.1f}ms max {stats['slow']:>6} slow  {stats['statement']}"
+                 for stats in snapshot]
+        slow_query_logger.info("Statement stats:\n" + "\n".join(lines))
+        return snapshot
+
+
+query_stats = QueryStats()
+
+
+class PoolTimeout(sqlite3.OperationalError):
+    """No connection of the pool became free within SQLITE_POOL_TIMEOUT."""
 
 
 class Connection:
-    def __init__(self, database_name, timeout):
-        db_path = os.path.expanduser(f"~/mysite/{database_name}")
-        logger.info(f"Connecting to database at {db_path}...")
-        self.connection = sqlite3.connect(db_path, timeout=timeout)
-        self.connection.execute('PRAGMA foreign_keys=ON')
+    """
+    Pool of SQLite connections to one database file. Connections are opened lazily in WAL mode, so readers
+    don't block on the writer, and by every process for itself, so a pool created before a fork still works.
+    A thread leases a connection with lease(), nested leases of the same thread reuse it. Attribute access
+    is delegated to the connection leased by the current thread.
+    """
+    def __init__(self, database_name, timeout, pool_size: int = SQLITE_POOL_SIZE, synchronous: str = SQLITE_SYNCHRONOUS,
+                 mmap_size: int = SQLITE_MMAP_SIZE, cache_size: int = SQLITE_CACHE_SIZE,
+                 temp_store: str = SQLITE_TEMP_STORE, busy_timeout: int = None):
+        self.db_path = database_file(database_name)
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.pragmas = {
+            "journal_mode": "WAL",
+            "synchronous": synchronous,
+            "mmap_size": mmap_size,
+            "cache_size": cache_size,
+            "temp_store": temp_store,
+            "busy_timeout": busy_timeout if busy_timeout is not None else int(timeout * 1000),
+            "foreign_keys": "ON",
+        }
+
+        self._idle = []  # used as a stack, so the most recently used connection with a warm cache is reused first
+        self._opened = 0
+        self._in_use = 0
+        self._condition = threading.Condition()
+        self._local = threading.local()
+        self._pid = os.getpid()  # SQLite connections mustn't be used across fork, see acquire
+        self._inherited = []
+
+        self.peak_in_use = 0
+        self.acquires = 0
+        self.waits = 0
+        self.wait_time = 0.0
+
+        self.writer = Writer(self)  # its thread is started by the first queued write
 
     def __del__(self):
-        logger.info("Disconnecting from database...")
-        self.connection.close()
+        self.close()
 
     def __getattr__(self, name):
-        return getattr(self.connection, name)
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            raise AttributeError(f"'{name}': current thread hasn't leased a connection")
+        return getattr(connection, name)
+
+    def _open(self) -> sqlite3.Connection:
+        logger.info(f"Connecting to database at {self.db_path}...")
+        # autocommit mode, statements outside of Database.transaction() blocks are committed right away
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False,
+                                     isolation_level=None)
+        for pragma, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {pragma}={value}")
+        return connection
+
+    def acquire(self) -> sqlite3.Connection:
+        """Takes a connection from the pool, opening a new one if the pool isn't full yet."""
+        with self._condition:
+            if self._pid != os.getpid():
+                self._forget_inherited()
+            self.acquires += 1
+            if not self._idle and self._opened >= self.pool_size:
+                self.waits += 1
+                started = time.monotonic()
+                if not self._condition.wait_for(lambda: self._idle, timeout=SQLITE_POOL_TIMEOUT):
+                    raise PoolTimeout(f"No free connection in the pool of {self.pool_size}")
+                self.wait_time += time.monotonic() - started
+
+            self._in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self._in_use)
+            if self._idle:
+                return self._idle.pop()
+            self._opened += 1
+
+        try:
+            return self._open()
+        except sqlite3.Error:
+            with self._condition:
+                self._opened -= 1
+                self._in_use -= 1
+                self._condition.notify()
+            raise
+
+    def _forget_inherited(self) -> None:
+        """
+        Starts an empty pool in a forked process. Connections of the parent are kept referenced but never used,
+        closing them could release locks the parent holds. Must be called with the condition held.
+        """
+        self._inherited += self._idle
+        self._idle = []
+        self._opened = 0
+        self._in_use = 0
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        """Returns a connection to the pool."""
+        if connection.in_transaction:
+            logger.warning("Connection returned to the pool inside a transaction, rolling back")
+            connection.rollback()
+        with self._condition:
+            self._in_use -= 1
+            self._idle.append(connection)
+            self._condition.notify()
+
+    @contextmanager
+    def lease(self):
+        """Leases a connection to the current thread for the duration of the block."""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:  # nested lease
+            self._local.depth += 1
+            try:
+                yield connection
+            finally:
+                self._local.depth -= 1
+            return
+
+        connection = self.acquire()
+        self._local.connection = connection
+        self._local.depth = 1
+        try:
+            yield connection
+        finally:
+            self._local.connection = None
+            self._local.depth = 0
+            self.release(connection)
+
+    @contextmanager
+    def borrow(self, connection: sqlite3.Connection):
+        """Uses a connection leased by another thread, which waits meanwhile, as the lease of the current thread."""
+        previous = getattr(self._local, "connection", None), getattr(self._local, "depth", 0)
+        self._local.connection = connection
+        self._local.depth = 1
+        try:
+            yield connection
+        finally:
+            self._local.connection, self._local.depth = previous
+
+    @property
+    def transaction_depth(self) -> int:
+        """Number of nested Database.transaction() blocks open in the current thread."""
+        return getattr(self._local, "transaction_depth", 0)
+
+    @transaction_depth.setter
+    def transaction_depth(self, value: int) -> None:
+        self._local.transaction_depth = value
+
+    @property
+    def commit_callbacks(self) -> list:
+        """Callbacks to run after the current thread's transaction commits."""
+        if not hasattr(self._local, "commit_callbacks"):
+            self._local.commit_callbacks = []
+        return self._local.commit_callbacks
+
+    @property
+    def transaction_statements(self) -> int:
+        """Number of statements executed in the current thread's transaction."""
+        return getattr(self._local, "transaction_statements", 0)
+
+    @transaction_statements.setter
+    def transaction_statements(self, value: int) -> None:
+        self._local.transaction_statements = value
+
+    def stats(self) -> dict:
+        """Reports pool utilisation."""
+        with self._condition:
+            return {
+                "pool_size": self.pool_size,
+                "opened": self._opened,
+                "in_use": self._in_use,
+                "idle": len(self._idle),
+                "peak_in_use": self.peak_in_use,
+                "utilisation": self._in_use / self.pool_size,
+                "acquires": self.acquires,
+                "waits": self.waits,
+                "wait_time": self.wait_time,
+            }
+
+    def close(self) -> None:
+        """Closes idle connections. Leased ones are closed when they are garbage collected."""
+        with self._condition:
+            idle, self._idle = self._idle, []
+            self._opened -= len(idle)
+        if idle:
+            logger.info("Disconnecting from database...")
+        for connection in idle:
+            connection.close()
+
+
+class _BlockFailed(Exception):
+    """Rolls back the work of a transaction block that raised in the thread the writer lent its connection to."""
+
+
+class Writer:
+    """
+    Single writer of a database file. Writes of all threads are queued and executed by one thread, which merges
+    whatever is pending into one transaction (group commit). Every write runs in a savepoint, so a failing one
+    is rolled back alone, and its future is resolved once the transaction is committed. While another process
+    holds the lock, the writer waits and retries for up to WRITE_TIMEOUT, then fails the pending writes.
+    A write whose caller stopped waiting before its transaction began is cancelled and never executed.
+
+    A Database.transaction() block can't be moved to the writer thread, so the writer lends its connection
+    to the thread of the block instead and waits until the block ends.
+    """
+    def __init__(self, pool: Connection, batch_size: int = WRITE_BATCH_SIZE):
+        self.pool = pool
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.connection = None  # of the transaction in progress
+        self._thread = None
+        self._pid = None  # a process forked after the start has to start its own thread
+        self._lock = threading.Lock()
+
+        self.writes = 0
+        self.failed = 0
+        self.commits = 0
+        self.max_batch = 0
+        self.lock_retries = 0
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name=f"db-writer-{os.path.basename(self.pool.db_path)}",
+                                            daemon=True)
+            self._thread.start()
+        logger.info(f"Database writer of {self.pool.db_path} started")
+
+    def submit(self, work) -> Future:
+        """
+        Queues a write.
+
+        :param work: callable executing queries, called in the writer thread inside the shared transaction
+        :return: Future resolving to the result of work after the commit, or to its exception
+        """
+        if self._pid != os.getpid():
+            self.start()
+        future = Future()
+        self.queue.put((work, future))
+        return future
+
+    @contextmanager
+    def lend(self):
+        """
+        Runs the block in the current thread as one write of the next transaction, on the connection of the writer.
+        Leaves the block once it's committed, then runs the on_commit callbacks of the block.
+
+        :return: context manager yielding the connection of the transaction
+        """
+        granted = Future()
+        returned = threading.Event()
+        outcome = {"statements": 0, "failed": False}
+
+        def work():
+            granted.set_result(self.connection)
+            returned.wait()
+            self.pool.transaction_statements += outcome["statements"]
+            if outcome["failed"]:
+                raise _BlockFailed()
+
+        def failed(future):  # the writer couldn't begin the transaction, both are resolved in the writer thread
+            if not granted.done() and not future.cancelled():
+                granted.set_exception(future.exception())
+
+        committed = self.submit(work)
+        committed.add_done_callback(failed)
+        pool = self.pool
+        with pool.borrow(self._wait(committed, granted)) as connection:
+            pool.transaction_depth = 1  # nested blocks become savepoints, queries join the transaction
+            pool.transaction_statements = 0
+            try:
+                yield connection
+            except BaseException:
+                outcome["failed"] = True
+                pool.commit_callbacks.clear()
+                Database._record_transaction(pool.transaction_statements, rolled_back=True)
+                raise
+            finally:
+                outcome["statements"] = pool.transaction_statements
+                pool.transaction_depth = 0
+                returned.set()
+
+        try:
+            committed.result()
+        finally:
+            callbacks = pool.commit_callbacks[:]
+            pool.commit_callbacks.clear()  # of a rolled back transaction, they mustn't run with the next one
+        for callback in callbacks:
+            callback()
+
+    def wait(self, future: Future):
+        """
+        Returns the result of a submitted write. Gives up once WRITE_TIMEOUT passes while the write is queued,
+        a write that is already executing is bounded by the deadline of the writer.
+
+        :raise sqlite3.OperationalError: if the write timed out
+        """
+        return self._wait(future, future)
+
+    @staticmethod
+    def _wait(submitted: Future, result: Future):
+        """Waits for result of the write submitted, cancelling the write if it doesn't begin in time."""
+        try:
+            return result.result(timeout=WRITE_TIMEOUT)
+        except FutureTimeout:
+            if submitted.cancel():
+                raise sqlite3.OperationalError(f"database is locked, write not started within {WRITE_TIMEOUT}s")
+        return result.result()
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "writes": self.writes,
+            "failed": self.failed,
+            "commits": self.commits,
+            "max_batch": self.max_batch,
+            "lock_retries": self.lock_retries,
+        }
+
+    def _run(self) -> None:
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                logger.critical(f"Writer couldn't commit {len(batch)} writes: {e}", exc_info=True)
+                self.failed += len(batch)
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _commit(self, batch: list) -> None:
+        """Executes the batch in one transaction, resolves the futures after the commit."""
+        pool = self.pool
+        results = []
+        with pool.lease() as connection:
+            self._execute_locked(connection, "BEGIN IMMEDIATE;", len(batch))
+            batch[:] = [(work, future) for work, future in batch if future.set_running_or_notify_cancel()]
+            self.connection = connection
+            pool.transaction_depth = 1
+            pool.transaction_statements = 0
+            try:
+                for work, future in batch:
+                    connection.execute("SAVEPOINT write;")
+                    registered = len(pool.commit_callbacks)
+                    try:
+                        results.append((work(), None))
+                    except Exception as e:
+                        connection.execute("ROLLBACK TO write;")
+                        del pool.commit_callbacks[registered:]  # of the rolled back write
+                        results.append((None, e))
+                    connection.execute("RELEASE write;")
+
+                started = time.perf_counter()
+                self._execute_locked(connection, "COMMIT;", len(batch))
+                commit_time = time.perf_counter() - started
+            except BaseException:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK;")
+                pool.commit_callbacks.clear()
+                Database._record_transaction(pool.transaction_statements, rolled_back=True)
+                raise
+            finally:
+                self.connection = None
+                pool.transaction_depth = 0
+
+        Database._record_transaction(pool.transaction_statements, commit_time=commit_time)
+        self.commits += 1
+        self.writes += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        callbacks = pool.commit_callbacks[:]  # of writes executed in this thread
+        pool.commit_callbacks.clear()
+        for callback in callbacks:
+            callback()
+
+        for (work, future), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                self.failed += 1
+                future.set_exception(error)
+
+    def _execute_locked(self, connection: sqlite3.Connection, statement: str, pending: int) -> None:
+        """Executes statement, waiting while the database is locked by another process, at most WRITE_TIMEOUT."""
+        deadline = time.monotonic() + WRITE_TIMEOUT
+        attempt = 0
+        while True:
+            try:
+                connection.execute(statement)
+                return
+            except sqlite3.OperationalError as e:
+                if "database is locked" not in str(e):
+                    raise
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise sqlite3.OperationalError(f"database is locked, writer gave up after {WRITE_TIMEOUT}s")
+                delay = min(INITIAL_DELAY * 2 ** attempt, WRITE_RETRY_MAX_DELAY, remaining)
+                logger.warning(f"Database is locked, writer retries in {delay}s, {pending} writes pending")
+                metrics.LOCK_RETRIES.inc()
+                self.lock_retries += 1
+                time.sleep(delay)
+                attempt += 1
 
 
 class CursorError:
@@ -62,94 +671,401 @@ class Database:
     table_name = ""
     create_table_query = ""
     columns = ()
+    column_set = frozenset()  # set by __init_subclass__ for fast validation
+    sharded = False  # rows of per-user tables live in the shard of their user_id
+
+    connection = Connection(DATABASE_PATH, timeout=5)  # global store
+    shards = [connection] if SHARD_COUNT == 1 else [Connection(shard_path(i), timeout=5) for i in range(SHARD_COUNT)]
+
+    _pinned = threading.local()  # shard used by sharded tables of the current thread, see pinned()
+    _statements = {}  # (table class, operation, *key) -> SQL, see _statement
+    _transaction_lock = threading.Lock()
+    _transaction_stats = {"commits": 0, "rollbacks": 0, "statements": 0, "max_statements": 0,
+                          "commit_time": 0.0, "max_commit_time": 0.0}
 
-    connection = Connection('data.db', timeout=5)
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.column_set = frozenset(cls.columns)
 
     @classmethod
-    def execute_query(cls, query: str, params: list or tuple = (), multiple: bool = False, retrying: bool = False):
-        """Executes a given SQLite query with optional parameters. Returns number of affected rows or fetched data"""
-        logger.debug(f"Executing query: {query, params}")
-        connection = cls.connection
-        cursor = connection.cursor()
+    def pool(cls, shard_key: int = None) -> Connection:
+        """
+        Returns the connection pool of the table: the global store, or for sharded tables the shard of shard_key
+        (user_id), else the shard pinned to the current thread.
+        """
+        if not cls.sharded:
+            return Database.connection
+        if shard_key is not None:
+            return Database.shards[shard_index(shard_key, len(Database.shards))]
+        pinned = getattr(Database._pinned, "pool", None)
+        if pinned is not None:
+            return pinned
+        if len(Database.shards) == 1:
+            return Database.shards[0]
+        raise ValueError(f"Table {cls.table_name} is sharded by user_id, no shard_key given")
 
-        retry = False
-        attempt = 0
-        while attempt < MAX_RETRIES:
-            # execute query
-            try:
-                if params:
-                    if multiple:
-                        logger.debug("Executing multiple")
-                        cursor.executemany(query, params)
-                    else:
-                        logger.debug("Executing single")
-                        cursor.execute(query, tuple(params))
-                else:
-                    logger.debug("Executing with no parameters")
-                    cursor.execute(query)
+    @classmethod
+    def routed(cls, shard_key: int = None) -> bool:
+        """Whether pool(shard_key) knows the shard, otherwise a query has to run on every shard."""
+        return (not cls.sharded or shard_key is not None or len(Database.shards) == 1
+                or getattr(Database._pinned, "pool", None) is not None)
+
+    @staticmethod
+    @contextmanager
+    def pinned(pool: Connection):
+        """Routes queries of sharded tables without shard_key in the current thread to pool within the block."""
+        previous = getattr(Database._pinned, "pool", None)
+        Database._pinned.pool = pool
+        try:
+            yield pool
+        finally:
+            Database._pinned.pool = previous
+
+    @classmethod
+    def each_shard(cls):
+        """Pins every shard of the table in turn, for queries that aren't limited to one user."""
+        for pool in (Database.shards if cls.sharded else [Database.connection]):
+            with cls.pinned(pool):
+                yield pool
+
+    @classmethod
+    def shards_of(cls, user_ids) -> dict:
+        """Groups user_ids by the pool of their shard."""
+        groups = {}
+        for user_id in user_ids:
+            groups.setdefault(cls.pool(user_id), []).append(user_id)
+        return groups
+
+    @classmethod
+    def schema(cls, query: str) -> str:
+        """Adapts CREATE statement of the table to the file it's executed in."""
+        if cls.sharded and cls.pool() is not Database.connection:
+            return USERS_FOREIGN_KEY.sub("", query)
+        return query
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        """Reports utilisation of all connection pools, summed, along with connections in use per shard."""
+        pools = [Database.connection] + [pool for pool in Database.shards if pool is not Database.connection]
+        stats = {}
+        for pool in pools:
+            for key, value in pool.stats().items():
+                stats[key] = stats.get(key, 0) + value
+        stats["utilisation"] = stats["in_use"] / stats["pool_size"]
+        if len(Database.shards) > 1:
+            stats["shard_in_use"] = [pool.stats()["in_use"] for pool in Database.shards]
+        return stats
+
+    @classmethod
+    @contextmanager
+    def transaction(cls, shard_key: int = None):
+        """
+        Unit of work: queries executed in the block are committed together when it ends, or rolled back
+        if it raises. Nested blocks become savepoints, so an inner block can fail without aborting the outer one.
+        All classmethods of Database join the transaction of the current thread automatically.
+        A transaction covers one database file, on sharded tables the shard of shard_key (user_id), which is
+        pinned to the thread within the block. In the queue write mode the block joins the next group commit
+        of the file's writer, transactions of the global store may contain ones of shards, not the other way round.
+
+        :return: context manager yielding the connection of the transaction
+        """
+        pool = cls.pool(shard_key)
+        if WRITE_MODE == "queue" and pool.transaction_depth == 0:
+            with pool.writer.lend() as connection, (cls.pinned(pool) if cls.sharded else nullcontext()):
+                yield connection
+            return
+
+        with pool.lease() as connection, (cls.pinned(pool) if cls.sharded else nullcontext()):
+            depth = pool.transaction_depth
+            if depth == 0:
+                connection.execute("BEGIN IMMEDIATE;")  # take the write lock now instead of failing midway
+                pool.transaction_statements = 0
+            else:
+                connection.execute(f"SAVEPOINT sp{depth};")
+            pool.transaction_depth = depth + 1
+            registered = len(pool.commit_callbacks)
 
-                if not query.strip().upper().startswith("SELECT"):
-                    connection.commit()
-                    logger.debug(f"Query executed successfully")
-                    return cursor
+            try:
+                yield connection
+            except BaseException:
+                pool.transaction_depth = depth
+                if depth == 0:
+                    connection.execute("ROLLBACK;")
+                    pool.commit_callbacks.clear()
+                    cls._record_transaction(pool.transaction_statements, rolled_back=True)
                 else:
-                    results = cursor.fetchall()  # Return results for SELECT statements
-                    logger.debug(f"Query executed successfully. Results: {results}")
-                    return results
+                    connection.execute(f"ROLLBACK TO sp{depth};")
+                    connection.execute(f"RELEASE sp{depth};")
+                    del pool.commit_callbacks[registered:]  # of the rolled back savepoint
+                raise
+
+            pool.transaction_depth = depth
+            if depth == 0:
+                started = time.perf_counter()
+                connection.execute("COMMIT;")
+                cls._record_transaction(pool.transaction_statements, commit_time=time.perf_counter() - started)
+                callbacks = pool.commit_callbacks[:]
+                pool.commit_callbacks.clear()
+                for callback in callbacks:
+                    callback()
+            else:
+                connection.execute(f"RELEASE sp{depth};")
 
-            # handle errors
-            except sqlite3.OperationalError as e:
-                error_message = str(e)
+    @classmethod
+    def on_commit(cls, callback, shard_key: int = None) -> None:
+        """Runs callback after the current transaction commits, or right away outside of a transaction."""
+        pool = cls.pool(shard_key) if cls.routed(shard_key) else None
+        if pool is not None and pool.transaction_depth:
+            pool.commit_callbacks.append(callback)
+        else:
+            callback()
 
-                if "database is locked" in error_message:
-                    logger.warning(f"Database is locked, retrying... Attempt {attempt + 1}/{MAX_RETRIES}")
-                    time.sleep(INITIAL_DELAY * (2 ** attempt))
-                    attempt += 1
-                    retry = True
-                    continue
+    @classmethod
+    def writer_stats(cls) -> dict:
+        """Reports queued writes and group commits of the writers of all database files, summed."""
+        pools = [Database.connection] + [pool for pool in Database.shards if pool is not Database.connection]
+        stats = {}
+        for pool in pools:
+            for key, value in pool.writer.stats().items():
+                stats[key] = max(stats.get(key, 0), value) if key == "max_batch" else stats.get(key, 0) + value
+        stats["avg_batch"] = stats["writes"] / stats["commits"] if stats["commits"] else 0.0
+        return stats
 
-                elif "no such table" in error_message and not retrying:
-                    logger.warning(f"Table not found: {cls.table_name}. Attempting to create the table...")
-                    try:
-                        cls.create_table()  # Attempt to create the table
-                        logger.info("Table created successfully. Retrying the original query...")
-                    except sqlite3.Error as create_e:
-                        logger.critical(f"Failed to create table: {create_e}", exc_info=True)
-                        return CursorError()
+    @classmethod
+    def transaction_stats(cls) -> dict:
+        """Returns number of commits, their latency (in seconds) and statements per transaction."""
+        with Database._transaction_lock:
+            stats = dict(Database._transaction_stats)
+        commits = stats["commits"]
+        stats["avg_statements"] = stats["statements"] / commits if commits else 0.0
+        stats["avg_commit_time"] = stats["commit_time"] / commits if commits else 0.0
+        return stats
+
+    @staticmethod
+    def _record_transaction(statements: int, commit_time: float = 0.0, rolled_back: bool = False) -> None:
+        with Database._transaction_lock:
+            stats = Database._transaction_stats
+            if rolled_back:
+                stats["rollbacks"] += 1
+                return
+            stats["commits"] += 1
+            stats["statements"] += statements
+            stats["max_statements"] = max(stats["max_statements"], statements)
+            stats["commit_time"] += commit_time
+            stats["max_commit_time"] = max(stats["max_commit_time"], commit_time)
+        logger.debug("Committed %d statements in %.2fms", statements, commit_time * 1000)
 
-                    # Retry the original query after creating the table
-                    return cls.execute_query(query, params, multiple, retrying=True)
+    @classmethod
+    def execute_query(cls, query: str, params: list or tuple = (), multiple: bool = False, retrying: bool = False,
+                      shard_key: int = None):
+        """
+        Executes a given SQLite query with optional parameters. Returns number of affected rows or fetched data.
+        Queries of sharded tables run on the shard of shard_key (user_id), or the one pinned to the thread.
+        In the queue write mode, writes outside of a transaction are executed by the writer of the database file.
+        """
+        logger.debug("Executing query: %s, params: %s", query, params)  # formatted only when logged
+        pool = cls.pool(shard_key)
+        if WRITE_MODE == "queue" and pool.transaction_depth == 0 and QUEUED_STATEMENT.match(query):
+            def write():
+                with cls.pinned(pool) if cls.sharded else nullcontext():
+                    return cls.execute_query(query, params, multiple, retrying)
 
+            try:
+                return pool.writer.wait(pool.writer.submit(write))
+            except sqlite3.Error as e:
+                if "database is locked" in str(e):  # same as running out of retries in direct mode
+                    metrics.QUERY_ERRORS.inc("locked")
+                    logger.error(f"Max retries exceeded: {e}")
                 else:
-                    logger.exception(f"OperationalError: {error_message}")
+                    metrics.QUERY_ERRORS.inc(type(e).__name__)
+                    logger.error(f"Queued write failed: {e}")
+                return CursorError()
 
-            except sqlite3.IntegrityError as e:
-                logger.warning(f"IntegrityError: {str(e)}")
-                return CursorError()  # Handle duplicate entries and other integrity issues
+        with ExitStack() as stack:
+            try:
+                connection = stack.enter_context(pool.lease())
+            except PoolTimeout as e:
+                metrics.QUERY_ERRORS.inc("pool_timeout")
+                logger.error(f"Query not executed: {e}")
+                return CursorError()
+            cursor = connection.cursor()
+            started = time.perf_counter()
+
+            retry = False
+            attempt = 0
+            while attempt < MAX_RETRIES:
+                # execute query
+                try:
+                    if params:
+                        if multiple:
+                            logger.debug("Executing multiple")
+                            cursor.executemany(query, params)
+                        else:
+                            logger.debug("Executing single")
+                            cursor.execute(query, tuple(params))
+                    else:
+                        logger.debug("Executing with no parameters")
+                        cursor.execute(query)
+
+                    if not query.strip().upper().startswith("SELECT"):
+                        if pool.transaction_depth:
+                            pool.transaction_statements += 1  # committed when the transaction ends
+                        logger.debug("Query executed successfully")
+                        query_stats.record(connection, query, params, multiple, time.perf_counter() - started)
+                        return cursor
+                    else:
+                        results = cursor.fetchall()  # Return results for SELECT statements
+                        logger.debug("Query executed successfully. Results: %s", results)
+                        query_stats.record(connection, query, params, multiple, time.perf_counter() - started)
+                        return results
+
+                # handle errors
+                except sqlite3.OperationalError as e:
+                    error_message = str(e)
+
+                    if "database is locked" in error_message:
+                        logger.warning(f"Database is locked, retrying... Attempt {attempt + 1}/{MAX_RETRIES}")
+                        metrics.LOCK_RETRIES.inc()
+                        time.sleep(INITIAL_DELAY * (2 ** attempt))
+                        attempt += 1
+                        retry = True
+                        continue
+
+                    elif "no such table" in error_message and not retrying:
+                        logger.warning(f"Table not found: {cls.table_name}. Attempting to create the table...")
+                        try:
+                            with cls.pinned(pool):
+                                cls.create_table()  # Attempt to create the table
+                            logger.info("Table created successfully. Retrying the original query...")
+                        except sqlite3.Error as create_e:
+                            logger.critical(f"Failed to create table: {create_e}", exc_info=True)
+                            return CursorError()
+
+                        # Retry the original query after creating the table
+                        return cls.execute_query(query, params, multiple, retrying=True, shard_key=shard_key)
 
-            except sqlite3.DatabaseError as e:
-                logger.critical(f"DatabaseError: {str(e)}", exc_info=True)
-                return CursorError()  # Handle other database errors
+                    else:
+                        metrics.QUERY_ERRORS.inc("OperationalError")
+                        logger.exception(f"OperationalError: {error_message}")
 
-            finally:
-                if not retry:
-                    cursor.close()
-                retry = False
+                except sqlite3.IntegrityError as e:
+                    metrics.QUERY_ERRORS.inc("IntegrityError")
+                    logger.warning(f"IntegrityError: {str(e)}")
+                    return CursorError()  # Handle duplicate entries and other integrity issues
+
+                except sqlite3.DatabaseError as e:
+                    metrics.QUERY_ERRORS.inc("DatabaseError")
+                    logger.critical(f"DatabaseError: {str(e)}", exc_info=True)
+                    return CursorError()  # Handle other database errors
 
-        logger.error(f"Max retries exceeded")
-        return CursorError()
+                finally:
+                    if not retry:
+                        cursor.close()
+                    retry = False
+
+            metrics.QUERY_ERRORS.inc("locked")
+            logger.error("Max retries exceeded")
+            return CursorError()
+
+    @classmethod
+    def iterate_query(cls, query: str, params: list or tuple = (), batch_size: int = FETCH_BATCH_SIZE,
+                      shard_key: int = None):
+        """
+        Executes a SELECT query and yields rows one by one, fetching them in batches, so that results
+        of any size are read with constant memory.
+        """
+        logger.debug("Iterating query: %s, params: %s", query, params)
+        with cls.pool(shard_key).lease() as connection:
+            cursor = connection.execute(query, tuple(params))
+            try:
+                while True:
+                    rows = cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield from rows
+            finally:
+                cursor.close()
 
     @classmethod
     def validate_columns(cls, conditions: dict or list or tuple) -> None:
-        invalid_columns = [col for col in conditions if col not in cls.columns]
+        invalid_columns = [col for col in conditions if col not in cls.column_set]
         if invalid_columns:
             logger.error(f"Table {cls.table_name} has no such columns: {invalid_columns}")
             raise ValueError(f"Invalid column(s): {', '.join(invalid_columns)}")
 
+    @classmethod
+    def _statement(cls, operation: str, *key) -> str:
+        """
+        Returns SQL of a generic query, compiled once per table, operation and columns.
+        Columns are validated when the statement is compiled, so cached statements need no validation.
+        """
+        cache_key = (cls, operation, *key)
+        statement = Database._statements.get(cache_key)
+        if statement is None:
+            statement = cls._compile_statement(operation, *key)
+            if len(Database._statements) >= STATEMENT_CACHE_SIZE:
+                Database._statements.clear()
+            Database._statements[cache_key] = statement
+        return statement
+
+    @classmethod
+    def _compile_statement(cls, operation: str, *key) -> str:
+        match operation:
+            case "insert":
+                columns, replace = key
+                cls.validate_columns(columns)
+                verb = "INSERT OR REPLACE" if replace else "INSERT"
+                return f"{verb} INTO {cls.table_name} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+            case "select":
+                columns, order_by, sort_direction, has_limit, has_offset, custom_select = key
+                query = custom_select if custom_select else f"SELECT * FROM {cls.table_name}"
+                if columns:
+                    cls.validate_columns(columns)
+                    # qualify columns, so that they stay unambiguous in joined custom selects
+                    query += " WHERE " + ' AND '.join(f"{cls.table_name}.{column} = ?" for column in columns)
+                if order_by:
+                    if order_by not in cls.column_set:
+                        raise ValueError(f"Invalid column for ordering: {order_by}")
+                    if sort_direction not in ('ASC', 'DESC'):
+                        raise ValueError("Sort direction must be either 'ASC' or 'DESC'")
+                    query += f" ORDER BY {cls.table_name}.{order_by} {sort_direction}"
+                if has_limit:
+                    query += " LIMIT ?"
+                if has_offset:
+                    query += " OFFSET ?"
+                return query
+
+            case "count":
+                columns, = key
+                cls.validate_columns(columns)
+                return f"SELECT COUNT(*) FROM {cls.table_name} WHERE {' AND '.join(f'{column} = ?' for column in columns)}"
+
+            case "update":
+                new_columns, columns = key
+                cls.validate_columns(new_columns)
+                cls.validate_columns(columns)
+                set_clause = ', '.join(f"{column} = ?" for column in new_columns)
+                where_clause = ' AND '.join(f"{column} = ?" for column in columns)
+                return f"UPDATE {cls.table_name} SET {set_clause} WHERE {where_clause}"
+
+            case "delete":
+                columns, = key
+                cls.validate_columns(columns)
+                return f"DELETE FROM {cls.table_name} WHERE {' AND '.join(f'{column} = ?' for column in columns)}"
+
+        raise ValueError(f"Unknown operation: {operation}")
+
     @classmethod
     def create_table(cls) -> None:
         """Create the table specified by class, and create indexes if defined."""
-        cls.execute_query(cls.create_table_query)
+        cls.execute_query(cls.schema(cls.create_table_query))
+
+    @classmethod
+    def migrate(cls) -> None:
+        """Brings the table of an existing database, or of every shard, up to date with the current schema."""
+        for _ in cls.each_shard():
+            cls.create_table()
 
     @classmethod
     def add(cls, data: dict, replace: bool = False) -> tuple[bool, int]:
@@ -164,17 +1080,9 @@ class Database:
         """
         if not data:
             raise ValueError("No data provided for insertion.")
-        cls.validate_columns(data)
 
-        columns = ', '.join(data.keys())
-        placeholders = ', '.join('?' * len(data))
-
-        if replace:
-            query = f"INSERT OR REPLACE INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-        else:
-            query = f"INSERT INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-
-        cursor = cls.execute_query(query, data.values())
+        cursor = cls.execute_query(cls._statement("insert", tuple(data), replace), tuple(data.values()),
+                                   shard_key=data.get("user_id"))
 
         return cursor.rowcount > 0, cursor.lastrowid
 
@@ -195,20 +1103,23 @@ class Database:
         if isinstance(data, dict):
             data = [data]  # Convert single dict to list for consistency
 
-        values = []
+        columns = tuple(data[0])
         for row in data:
-            cls.validate_columns(row)
-            values.append(tuple(row.values()))
-
-        columns = ', '.join(data[0].keys())  # assuming all rows have the same structure
-        placeholders = ', '.join('?' * len(data[0]))
-
-        if replace:
-            query = f"INSERT OR REPLACE INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-        else:
-            query = f"INSERT INTO {cls.table_name} ({columns}) VALUES ({placeholders})"
-
-        cursor = cls.execute_query(query, values, multiple=True)
+            if tuple(row) != columns:
+                raise ValueError("All rows must have the same columns in the same order.")
+
+        query = cls._statement("insert", columns, replace)
+        if not cls.routed():  # rows of several users, every shard gets its own statement
+            groups = {}
+            for row in data:
+                groups.setdefault(cls.pool(row.get("user_id")), []).append(tuple(row.values()))
+            inserted = 0
+            for pool, values in groups.items():
+                with cls.pinned(pool):
+                    inserted += max(cls.execute_query(query, values, multiple=True).rowcount, 0)
+            return inserted > 0
+
+        cursor = cls.execute_query(query, [tuple(row.values()) for row in data], multiple=True)
 
         return cursor.rowcount > 0
 
@@ -228,38 +1139,25 @@ class Database:
         :return: List of fetched records
         """
 
-        query = custom_select if custom_select else f"SELECT * FROM {cls.table_name}"
-        params = []
-
-        # Add WHERE conditions if provided
-        if conditions:
-            cls.validate_columns(conditions)
-
-            where_clause = ' AND '.join([f"{key} = ?" for key in conditions.keys()])
-            query += f" WHERE {where_clause}"
-            params.extend(conditions.values())
-
-        # Add ORDER BY if provided
-        if order_by:
-            if order_by not in cls.columns:
-                raise ValueError(f"Invalid column for ordering: {order_by}")
-            if sort_direction.upper() not in ['ASC', 'DESC']:
-                raise ValueError("Sort direction must be either 'ASC' or 'DESC'")
-            query += f" ORDER BY {order_by} {sort_direction.upper()}"
-
-        # Add LIMIT and OFFSET if provided
+        query = cls._statement("select", tuple(conditions) if conditions else (), order_by,
+                               sort_direction.upper() if order_by else None, bool(limit), bool(offset), custom_select)
+        params = list(conditions.values()) if conditions else []
         if limit:
-            query += " LIMIT ?"
             params.append(limit)
-
         if offset:
-            query += " OFFSET ?"
             params.append(offset)
 
-        rows = cls.execute_query(query, params)
+        shard_key = conditions.get("user_id") if conditions else None
+        if cls.routed(shard_key):
+            rows = cls.execute_query(query, params, shard_key=shard_key)
+        elif limit or offset or order_by:
+            raise ValueError(f"Table {cls.table_name} is sharded, rows of all users can't be ordered or paged.")
+        else:
+            rows = [row for _ in cls.each_shard() for row in cls.execute_query(query, params)]
 
         if include_column_names:
-            rows = [{cls.columns[i]: row[i] for i in range(len(row))} for row in rows]
+            columns = cls.columns
+            rows = [dict(zip(columns, row)) for row in rows]
 
             if not rows:
                 return {}
@@ -274,11 +1172,11 @@ class Database:
         """Counts the number of records that meet the given conditions."""
         if not conditions:
             raise ValueError("No conditions provided for count.")
-        cls.validate_columns(conditions)
+        if not cls.routed(conditions.get("user_id")):
+            return sum(cls.count_where(conditions) for _ in cls.each_shard())
 
-        where_clause = ' AND '.join([f"{key} = ?" for key in conditions])
-        query = f"SELECT COUNT(*) FROM {cls.table_name} WHERE {where_clause}"
-        result = cls.execute_query(query, conditions.values())
+        result = cls.execute_query(cls._statement("count", tuple(conditions)), tuple(conditions.values()),
+                                   shard_key=conditions.get("user_id"))
         return result[0][0] if result else 0
 
     @classmethod
@@ -288,14 +1186,12 @@ class Database:
             raise ValueError("No conditions provided for identifying the row(s).")
         if not new_values:
             raise ValueError("No new values provided for update.")
+        if not cls.routed(conditions.get("user_id")):
+            return any([cls.set(conditions, new_values) for _ in cls.each_shard()])
 
-        cls.validate_columns(conditions)
-        cls.validate_columns(new_values)
-
-        set_clause = ', '.join(f"{key} = ?" for key in new_values)
-        where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
-        query = f"UPDATE {cls.table_name} SET {set_clause} WHERE {where_clause}"
-        cursor = cls.execute_query(query, (*new_values.values(), *conditions.values()))
+        query = cls._statement("update", tuple(new_values), tuple(conditions))
+        cursor = cls.execute_query(query, (*new_values.values(), *conditions.values()),
+                                   shard_key=conditions.get("user_id"))
         return cursor.rowcount > 0
 
     @classmethod
@@ -303,11 +1199,11 @@ class Database:
         """Deletes records that meet the given conditions."""
         if not conditions:
             raise ValueError("No conditions provided for identifying the row(s) to delete.")
-        cls.validate_columns(conditions)
+        if not cls.routed(conditions.get("user_id")):
+            return any([cls.delete(conditions) for _ in cls.each_shard()])
 
-        where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
-        query = f"DELETE FROM {cls.table_name} WHERE {where_clause}"
-        cursor = cls.execute_query(query, tuple(conditions.values()))
+        cursor = cls.execute_query(cls._statement("delete", tuple(conditions)), tuple(conditions.values()),
+                                   shard_key=conditions.get("user_id"))
         return cursor.rowcount > 0
 
 
@@ -321,10 +1217,23 @@ class Users(Database):
     );
     '''
 
+    @classmethod
+    def get_ids_after(cls, user_id: int, limit: int) -> list[int]:
+        """Returns up to limit user ids greater than user_id in ascending order, to walk the table in batches."""
+        rows = cls.execute_query("SELECT user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?;",
+                                 (user_id, limit))
+        return [row[0] for row in rows]
+
 
 class Media(Database):
     table_name = "media"
-    columns = ("user_id", "media_type", "file_id", "caption", "media_id", "description")
+    sharded = True
+    columns = ("user_id", "media_type", "file_id", "caption", "media_id", "description", "inline_result")
+    joined_select = """
+        SELECT media.user_id, media.media_type, media.file_id, media.caption, media.media_id, media_fts.description
+        FROM media
+        LEFT JOIN media_fts ON media_fts.rowid = media.media_id
+        """
 
     @classmethod
     def create_table(cls) -> None:
@@ -335,18 +1244,21 @@ class Media(Database):
                 file_id TEXT NOT NULL,
                 caption TEXT,
                 media_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                inline_result TEXT,  -- serialized InlineQueryResult without id, see inline_results.py
                 FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE,
                 UNIQUE (user_id, file_id)
             );
         """
-        create_table_fts_query = """
-        CREATE VIRTUAL TABLE IF NOT EXISTS media_fts USING fts5(
-            media_id,
-            description
-        );
-        """
-        cls.execute_query(create_main_table_query)
+        # (user_id, media_id) order for seeking through the empty-query listing
+        create_user_index_query = "CREATE INDEX IF NOT EXISTS media_user_id_idx ON media (user_id);"
+        create_table_fts_query = FTS_SCHEMA.format(table_name="media_fts")
+        cls.execute_query(cls.schema(create_main_table_query))
+        cls.execute_query(create_user_index_query)
         cls.execute_query(create_table_fts_query)
+        if TRIGRAM_SEARCH:
+            cls.execute_query(TRIGRAM_SCHEMA.format(table_name="media_trigram"))
+        MediaStats.create_table()  # counters are maintained by triggers on media
+        MediaGenerations.create_table()
 
     @classmethod
     def add(cls, data: dict, replace: bool = False) -> tuple[bool, int]:
@@ -357,23 +1269,86 @@ class Media(Database):
             'caption': data.get("caption", None),
         }
         description = data["description"]
-
-        [status, media_id] = super().add(media_data)
-        if status:
-            cls.execute_query('INSERT INTO media_fts (media_id, description) VALUES (?, ?);', (media_id, description))
+        media_data["inline_result"] = build_fragment(media_data["media_type"], media_data["file_id"],
+                                                     media_data["caption"], description)
+
+        with cls.transaction(data["user_id"]):
+            [status, media_id] = super().add(media_data)
+            if status:
+                cls.execute_query('INSERT INTO media_fts (rowid, description, user_id) VALUES (?, ?, ?);',
+                                  (media_id, description, data["user_id"]))
+                if TRIGRAM_SEARCH:
+                    cls.execute_query('INSERT INTO media_trigram (rowid, description, user_id) VALUES (?, ?, ?);',
+                                      (media_id, description, data["user_id"]))
+                cls.on_commit(lambda: inline_cache.invalidate(data["user_id"]))
         return status, media_id
 
     @classmethod
     def get(cls, conditions: dict = None, limit: int = None, offset: int = None,
             order_by: str = None, sort_direction: str = 'ASC', include_column_names=False, custom_select=None) -> list or dict or tuple:
-        joined_select = """
-        SELECT m.user_id, m.media_type, m.file_id, m.caption, m.media_id, f.description 
-        FROM media m
-        LEFT JOIN media_fts f ON media.media_id = media_fts.media_id
-        """
-        custom_select = custom_select or joined_select
+        custom_select = custom_select or cls.joined_select
         return super().get(conditions, limit, offset, order_by, sort_direction, include_column_names, custom_select)
 
+    @classmethod
+    def set(cls, conditions: dict, new_values: dict):
+        """
+        Updates records that meet the given conditions, description is updated in media_fts.
+        Precomputed inline results of the updated records are rebuilt.
+        """
+        if not conditions:
+            raise ValueError("No conditions provided for identifying the row(s).")
+        if not new_values:
+            raise ValueError("No new values provided for update.")
+        if 'description' in conditions:
+            raise NotImplementedError("Updating by description is not supported.")
+        if not cls.routed(conditions.get("user_id")):
+            return any([cls.set(conditions, new_values) for _ in cls.each_shard()])
+
+        cls.validate_columns(conditions)
+        cls.validate_columns(new_values)
+
+        media_values = {key: value for key, value in new_values.items() if key not in ("description", "inline_result")}
+        where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
+
+        with cls.transaction(conditions.get("user_id")):
+            rows = cls.execute_query(f"SELECT media_id, user_id FROM media WHERE {where_clause};",
+                                     tuple(conditions.values()))
+            media_ids = [(media_id,) for media_id, _ in rows]
+            if not media_ids:
+                return False
+
+            if media_values:
+                set_clause = ', '.join(f"{key} = ?" for key in media_values)
+                cls.execute_query(f"UPDATE media SET {set_clause} WHERE media_id = ?;",
+                                  [(*media_values.values(), media_id) for media_id, in media_ids], multiple=True)
+            if "description" in new_values:
+                descriptions = [(new_values["description"], media_id) for media_id, in media_ids]
+                cls.execute_query("UPDATE media_fts SET description = ? WHERE rowid = ?;", descriptions, multiple=True)
+                if TRIGRAM_SEARCH:
+                    cls.execute_query("UPDATE media_trigram SET description = ? WHERE rowid = ?;", descriptions,
+                                      multiple=True)
+            cls.refresh_inline_results(media_ids)
+
+            for user in {user for _, user in rows}:
+                cls.on_commit(lambda user=user: inline_cache.invalidate(user))
+        return True
+
+    @classmethod
+    def refresh_inline_results(cls, media_ids: list[tuple]) -> None:
+        """Rebuilds precomputed inline results of the given media, media_ids is a list of 1-tuples."""
+        select_query = """
+            SELECT media.media_type, media.file_id, media.caption, media_fts.description
+            FROM media
+            LEFT JOIN media_fts ON media_fts.rowid = media.media_id
+            WHERE media.media_id = ?;
+        """
+        fragments = []
+        for media_id, in media_ids:
+            for row in cls.execute_query(select_query, (media_id,)):
+                fragments.append((build_fragment(*row), media_id))
+        if fragments:
+            cls.execute_query("UPDATE media SET inline_result = ? WHERE media_id = ?;", fragments, multiple=True)
+
     @classmethod
     def delete(cls, conditions: dict):
         """Deletes records that meet the given conditions from both media and media_fts tables."""
@@ -382,14 +1357,16 @@ class Media(Database):
 
         if 'description' in conditions:
             raise NotImplementedError("Deletion by description is not supported.")
+        if not cls.routed(conditions.get("user_id")):
+            return any([cls.delete(conditions) for _ in cls.each_shard()])
 
         cls.validate_columns(conditions)
 
         where_clause = ' AND '.join(f"{key} = ?" for key in conditions)
 
         delete_fts_query = f"""
-            DELETE FROM media_fts
-            WHERE media_id IN (
+            DELETE FROM {{table_name}}
+            WHERE rowid IN (
                 SELECT media_id FROM media 
                 WHERE {where_clause}
             );
@@ -401,13 +1378,60 @@ class Media(Database):
 
         params = tuple(conditions.values())
 
-        cls.execute_query(delete_fts_query, params)
-        cursor_media = cls.execute_query(delete_media_query, params)
+        with cls.transaction(conditions.get("user_id")):
+            cls.execute_query(delete_fts_query.format(table_name="media_fts"), params)
+            if TRIGRAM_SEARCH:
+                cls.execute_query(delete_fts_query.format(table_name="media_trigram"), params)
+            cursor_media = cls.execute_query(delete_media_query, params)
+
+            if cursor_media.rowcount > 0:  # without user_id any user might be affected
+                cls.on_commit(lambda: inline_cache.invalidate(conditions.get("user_id")))
 
         return cursor_media.rowcount > 0
 
     @classmethod
-    def search_by_description(cls, user_id: int, description: str, limit: int = None, offset: int = None) -> tuple[list, int]:
+    def find(cls, user_id: int, file_id: str) -> MediaRecord or None:
+        """
+        Looks up a single item of a user by file_id through the UNIQUE (user_id, file_id) index,
+        the description is fetched from media_fts by rowid.
+
+        :return: MediaRecord or None if the user has no such item
+        """
+        query = """
+            SELECT media_id, user_id, media_type, file_id, caption,
+                   (SELECT description FROM media_fts WHERE media_fts.rowid = media.media_id)
+            FROM media
+            WHERE user_id = ? AND file_id = ?;
+        """
+        rows = cls.execute_query(query, (user_id, file_id), shard_key=user_id)
+        return MediaRecord(*rows[0]) if rows else None
+
+    @classmethod
+    def delete_by_file_id(cls, user_id: int, file_id: str) -> bool:
+        """
+        Deletes a single item of a user by file_id through the UNIQUE (user_id, file_id) index,
+        its description is deleted from media_fts by rowid.
+
+        :return: bool whether the item existed
+        """
+        delete_fts_query = """
+            DELETE FROM {table_name}
+            WHERE rowid = (SELECT media_id FROM media WHERE user_id = ? AND file_id = ?);
+        """
+        params = (user_id, file_id)
+
+        with cls.transaction(user_id):
+            cls.execute_query(delete_fts_query.format(table_name="media_fts"), params)
+            if TRIGRAM_SEARCH:
+                cls.execute_query(delete_fts_query.format(table_name="media_trigram"), params)
+            cursor = cls.execute_query("DELETE FROM media WHERE user_id = ? AND file_id = ?;", params)
+            if cursor.rowcount > 0:
+                cls.on_commit(lambda: inline_cache.invalidate(user_id))
+        return cursor.rowcount > 0
+
+    @classmethod
+    def search_by_description(cls, user_id: int, description: str, limit: int = None, offset: int = None,
+                              has_more: bool = False) -> tuple[list, int or bool]:
         """
         Searches media by description using Full-Text Search (FTS).
 
@@ -415,59 +1439,63 @@ class Media(Database):
         :param description: The text to search in the description
         :param limit: Maximum number of records to retrieve (optional)
         :param offset: Number of records to skip (optional)
-        :return: A tuple containing the list of media entries and the total count of records
+        :param has_more: Instead of counting all matches, fetch one extra row to find out whether there is a next
+            page (requires limit)
+        :return: A tuple containing the list of media entries and the total count of records, or whether there
+            are more records if has_more is set
         """
+        if has_more and not limit:
+            raise ValueError("has_more requires a limit.")
+
         params = [user_id]
 
         if description:
-            terms = description.split()
-            search_terms = terms[:-1] + [f"{terms[-1]}*"]  # append * to the last term to enable prefix search for it
-            search_query = ' OR '.join(search_terms)
+            search_query = cls.match_expression(description)
 
             # Query to select media matching the search description
-            query = f"""
-                SELECT media.*, media_fts.description 
-                FROM media
-                JOIN media_fts ON media.media_id = media_fts.media_id
-                WHERE media_fts.description MATCH ? AND media.user_id = ?
-                ORDER BY rank
+            query = """
+                SELECT media.user_id, media.media_type, media.file_id, media.caption, media.media_id,
+                    media_fts.description
+                FROM media_fts
+                JOIN media ON media.media_id = media_fts.rowid
+                WHERE media_fts.description MATCH ? AND media_fts.user_id = ?
+                ORDER BY media_fts.rank
             """
             params.insert(0, search_query)
 
             # Count query to get total matching records including media_fts
-            count_query = f"""
-                SELECT COUNT(*) 
-                FROM media
-                JOIN media_fts ON media.media_id = media_fts.media_id
-                WHERE media_fts.description MATCH ? AND media.user_id = ?
+            count_query = """
+                SELECT COUNT(*)
+                FROM media_fts
+                WHERE media_fts.description MATCH ? AND media_fts.user_id = ?
             """
             total_count_params = [search_query, user_id]
 
         else:  # If description is empty, fetch all records for the user in reverse order of when they were added
             # Query to select all media for the specified user
-            query = f"""
-                SELECT media.*, media_fts.description 
+            query = """
+                SELECT media.user_id, media.media_type, media.file_id, media.caption, media.media_id,
+                    media_fts.description
                 FROM media
-                JOIN media_fts ON media.media_id = media_fts.media_id
+                JOIN media_fts ON media_fts.rowid = media.media_id
                 WHERE media.user_id = ?
                 ORDER BY media.media_id DESC
             """
 
-            # Count query for total records for the user
-            count_query = """
-                SELECT COUNT(*) 
-                FROM media
-                WHERE user_id = ?
-            """
-            total_count_params = [user_id]
+            count_query = None  # total records of the user are kept in media_stats
 
-        # Execute the count query to get total number of records
-        total_count = cls.execute_query(count_query, total_count_params)[0][0]
+        if has_more:
+            total_count = None
+        elif count_query:
+            # Execute the count query to get total number of records
+            total_count = cls.execute_query(count_query, total_count_params, shard_key=user_id)[0][0]
+        else:
+            total_count = MediaStats.total(user_id)
 
         if limit:
-            # Add LIMIT clause if a limit is specified
+            # Add LIMIT clause if a limit is specified, fetch one extra row to check for the next page
             query += " LIMIT ?"
-            params.append(limit)
+            params.append(limit + 1 if has_more else limit)
 
         if offset:
             if limit:
@@ -479,14 +1507,566 @@ class Media(Database):
                 raise ValueError("Offset cannot be specified without a limit.")
 
         # Execute the main query to fetch media records
-        records = cls.execute_query(query, params)
+        records = cls.execute_query(query, params, shard_key=user_id)
+
+        if has_more:
+            return records[:limit], len(records) > limit
 
         # Return both the fetched records and the total count of records
         return records, total_count
 
+    @classmethod
+    def search_page(cls, user_id: int, description: str, limit: int, page_token: str = "",
+                    mode: str = None) -> tuple[list, str]:
+        """
+        Searches media by description using keyset pagination. Instead of skipping rows with OFFSET,
+        the next page seeks past the last returned (rank, media_id), or past the last media_id when
+        listing all records.
+
+        :param user_id: The ID of the user whose media to search
+        :param description: The text to search in the description
+        :param limit: Maximum number of records to retrieve
+        :param page_token: Token returned by the previous call, "" for the first page. Plain integer
+            offsets are still accepted and served with OFFSET
+        :param mode: "token" matches whole words and a prefix of the last one, "trigram" matches substrings
+            of at least 3 characters, "auto" searches trigrams if whole words find nothing. Defaults to
+            SEARCH_MODE, next pages continue with the mode of the first one
+        :return: A tuple containing the list of media entries (user_id, media_type, file_id, caption, media_id,
+            description, inline_result) and the token of the next page ("" if there is none)
+        """
+        mode = mode or SEARCH_MODE
+        if mode not in ("token", "trigram", "auto"):
+            raise ValueError(f"Invalid search mode: {mode}")
+
+        offset = None
+        last_rank = last_media_id = None
+        if page_token.isdigit():
+            offset = int(page_token)  # legacy integer offset
+        elif page_token:
+            last_rank, last_media_id, token_mode = decode_page_token(page_token)
+            mode = token_mode or mode
+
+        if description:
+            if last_media_id is not None and last_rank is None:
+                raise ValueError("Listing page token can't be used with a search query.")
+
+            if mode == "auto":
+                mode = "token"
+                rows = cls._ranked_page(mode, user_id, description, limit, last_rank, last_media_id, offset)
+                if not rows and not page_token and cls.trigram_searchable(description):
+                    mode = "trigram"
+                    rows = cls._ranked_page(mode, user_id, description, limit, last_rank, last_media_id, offset)
+            else:
+                rows = cls._ranked_page(mode, user_id, description, limit, last_rank, last_media_id, offset)
+
+        else:
+            query = """
+                SELECT media.user_id, media.media_type, media.file_id, media.caption, media.media_id,
+                    media_fts.description, media.inline_result, NULL
+                FROM media
+                JOIN media_fts ON media_fts.rowid = media.media_id
+                WHERE media.user_id = ?
+            """
+            params = [user_id]
+            if last_media_id is not None:
+                query += " AND media.media_id < ?"
+                params.append(last_media_id)
+            query += " ORDER BY media.media_id DESC LIMIT ?"
+            params.append(limit + 1)  # the extra row only tells whether there is a next page
+            if offset:
+                query += " OFFSET ?"
+                params.append(offset)
+            rows = cls.execute_query(query, params, shard_key=user_id)
+
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        records = [row[:-1] for row in rows]
+
+        next_token = ""
+        if has_more:
+            last_media_id, last_rank = rows[-1][4], rows[-1][-1]
+            next_token = encode_page_token(last_media_id, last_rank, mode)
+
+        return records, next_token
+
+    @classmethod
+    def _ranked_page(cls, mode: str, user_id: int, description: str, limit: int, last_rank: float = None,
+                     last_media_id: int = None, offset: int = None) -> list:
+        """Fetches limit + 1 rows of a search in media_fts ("token" mode) or media_trigram ("trigram" mode)."""
+        if mode == "trigram":
+            if not TRIGRAM_SEARCH:
+                raise ValueError("Trigram search is disabled or not supported by this SQLite version.")
+            table_name, expression = "media_trigram", cls.trigram_expression(description)
+            if not expression:
+                return []  # no term is long enough to match a trigram
+        else:
+            table_name, expression = "media_fts", cls.match_expression(description)
+
+        query = f"""
+            SELECT media.user_id, media.media_type, media.file_id, media.caption, media.media_id,
+                {table_name}.description, media.inline_result, {table_name}.rank
+            FROM {table_name}
+            JOIN media ON media.media_id = {table_name}.rowid
+            WHERE {table_name}.description MATCH ? AND {table_name}.user_id = ?
+        """
+        params = [expression, user_id]
+        if last_media_id is not None:
+            query += f" AND ({table_name}.rank > ? OR ({table_name}.rank = ? AND {table_name}.rowid > ?))"
+            params.extend((last_rank, last_rank, last_media_id))
+        query += f" ORDER BY {table_name}.rank, {table_name}.rowid LIMIT ?"
+        params.append(limit + 1)  # the extra row only tells whether there is a next page
+        if offset:
+            query += " OFFSET ?"
+            params.append(offset)
+        return cls.execute_query(query, params, shard_key=user_id)
+
+    @classmethod
+    def migrate_fts(cls, batch_size: int = FTS_MIGRATION_BATCH_SIZE, pause: float = FTS_MIGRATION_PAUSE) -> int:
+        """
+        Rebuilds media_fts created with media_id as a regular FTS column into the rowid-keyed schema.
+        Rows are copied in short batches, so the bot keeps serving meanwhile, then the tables are swapped
+        in one final transaction, which also catches up with rows added or deleted during the copy. Deletes are
+        recorded by a trigger meanwhile, so the swap only replays them, and the old table is dropped afterwards.
+
+        :param batch_size: Number of rows copied per transaction
+        :param pause: Seconds to sleep between batches
+        :return: Number of copied rows, 0 if media_fts already has the current schema
+        """
+        if not cls.routed():
+            return sum(cls.migrate_fts(batch_size, pause) for _ in cls.each_shard())
+
+        columns = [row[0] for row in cls.execute_query("SELECT name FROM pragma_table_info('media_fts');")]
+        if "media_id" not in columns:
+            logger.info("media_fts already has the current schema")
+            return 0
+
+        logger.info("Migrating media_fts to the rowid-keyed schema...")
+        # leftovers of an interrupted migration
+        cls.execute_query("DROP TRIGGER IF EXISTS media_fts_migration_delete;")
+        for table_name in ("media_fts_new", "media_fts_old", "media_fts_deleted"):
+            cls.execute_query(f"DROP TABLE IF EXISTS {table_name};")
+        cls.execute_query(FTS_SCHEMA.format(table_name="media_fts_new"))
+        # media deleted during the copy, before the first batch so that none is missed
+        cls.execute_query("CREATE TABLE media_fts_deleted (media_id INTEGER PRIMARY KEY);")
+        cls.execute_query("""
+            CREATE TRIGGER media_fts_migration_delete AFTER DELETE ON media
+            BEGIN
+                INSERT OR IGNORE INTO media_fts_deleted (media_id) VALUES (OLD.media_id);
+            END;
+        """)
+
+        select_batch_query = """
+            SELECT rowid, media_id, description FROM media_fts
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?;
+        """
+        copy_query = """
+            INSERT OR REPLACE INTO media_fts_new (rowid, description, user_id)
+            SELECT media_id, ?, user_id FROM media WHERE media_id = ?;
+        """
+        last_rowid = 0
+        copied = 0
+        while True:
+            rows = cls.execute_query(select_batch_query, (last_rowid, batch_size))
+            if not rows:
+                break
+
+            cls.execute_query(copy_query, [(description, media_id) for _, media_id, description in rows], multiple=True)
+            last_rowid = rows[-1][0]
+            copied += len(rows)
+            logger.info(f"Copied {copied} rows of media_fts")
+            time.sleep(pause)
+
+        # copy rows added after last_rowid, drop rows deleted meanwhile and swap media_fts_new in
+        try:
+            with cls.transaction() as connection:
+                connection.execute("""
+                    INSERT OR REPLACE INTO media_fts_new (rowid, description, user_id)
+                    SELECT media.media_id, media_fts.description, media.user_id
+                    FROM media_fts
+                    JOIN media ON media.media_id = media_fts.media_id
+                    WHERE media_fts.rowid > ?;
+                """, (last_rowid,))
+                connection.execute("DELETE FROM media_fts_new WHERE rowid IN (SELECT media_id FROM media_fts_deleted);")
+                connection.execute("DROP TRIGGER media_fts_migration_delete;")
+                connection.execute("ALTER TABLE media_fts RENAME TO media_fts_old;")
+                connection.execute("ALTER TABLE media_fts_new RENAME TO media_fts;")
+        except sqlite3.Error as e:
+            logger.critical(f"Failed to swap media_fts tables: {e}", exc_info=True)
+            raise
+        cls.execute_query("DROP TABLE media_fts_old;")
+        cls.execute_query("DROP TABLE media_fts_deleted;")
+
+        logger.info(f"media_fts migrated, {copied} rows copied")
+        return copied
+
+    @classmethod
+    def migrate_inline_results(cls, batch_size: int = FTS_MIGRATION_BATCH_SIZE,
+                               pause: float = FTS_MIGRATION_PAUSE) -> int:
+        """
+        Adds the inline_result column to an existing media table and fills it in short batches.
+        Requires the rowid-keyed media_fts, run it after migrate_fts.
+
+        :param batch_size: Number of rows updated per transaction
+        :param pause: Seconds to sleep between batches
+        :return: Number of filled rows
+        """
+        if not cls.routed():
+            return sum(cls.migrate_inline_results(batch_size, pause) for _ in cls.each_shard())
+
+        columns = [row[0] for row in cls.execute_query("SELECT name FROM pragma_table_info('media');")]
+        if "inline_result" not in columns:
+            logger.info("Adding inline_result column to media...")
+            cls.execute_query("ALTER TABLE media ADD COLUMN inline_result TEXT;")
+
+        select_batch_query = """
+            SELECT media.media_id, media.media_type, media.file_id, media.caption, media_fts.description
+            FROM media
+            LEFT JOIN media_fts ON media_fts.rowid = media.media_id
+            WHERE media.media_id > ? AND media.inline_result IS NULL
+            ORDER BY media.media_id
+            LIMIT ?;
+        """
+        last_media_id = 0
+        filled = 0
+        while True:
+            rows = cls.execute_query(select_batch_query, (last_media_id, batch_size))
+            if not rows:
+                break
+
+            cls.execute_query("UPDATE media SET inline_result = ? WHERE media_id = ?;",
+                              [(build_fragment(*row[1:]), row[0]) for row in rows], multiple=True)
+            last_media_id = rows[-1][0]
+            filled += len(rows)
+            logger.info(f"Built inline results of {filled} rows")
+            time.sleep(pause)
+
+        if filled:
+            inline_cache.invalidate()
+        logger.info(f"inline_result migrated, {filled} rows filled")
+        return filled
+
+    @classmethod
+    def migrate_trigram(cls, batch_size: int = FTS_MIGRATION_BATCH_SIZE, pause: float = FTS_MIGRATION_PAUSE) -> int:
+        """
+        Creates media_trigram and copies descriptions of media_fts missing from it in short batches.
+        Rows of media deleted while trigram search was disabled are removed. Requires the rowid-keyed media_fts.
+
+        :param batch_size: Number of rows copied per transaction
+        :param pause: Seconds to sleep between batches
+        :return: Number of copied rows
+        """
+        if not TRIGRAM_SEARCH:
+            logger.info("Trigram search is disabled or not supported by this SQLite version")
+            return 0
+        if not cls.routed():
+            return sum(cls.migrate_trigram(batch_size, pause) for _ in cls.each_shard())
+
+        cls.execute_query(TRIGRAM_SCHEMA.format(table_name="media_trigram"))
+        removed = cls._remove_orphans("media_trigram", batch_size, pause)
+
+        select_batch_query = """
+            SELECT rowid, description, user_id FROM media_fts
+            WHERE rowid > ?
+            ORDER BY rowid
+            LIMIT ?;
+        """
+        copy_query = """
+            INSERT INTO media_trigram (rowid, description, user_id)
+            SELECT ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM media_trigram WHERE rowid = ?);
+        """
+        last_rowid = 0
+        copied = 0
+        while True:
+            rows = cls.execute_query(select_batch_query, (last_rowid, batch_size))
+            if not rows:
+                break
+
+            cursor = cls.execute_query(copy_query, [(*row, row[0]) for row in rows], multiple=True)
+            last_rowid = rows[-1][0]
+            if cursor.rowcount > 0:
+                copied += cursor.rowcount
+                logger.info(f"Copied {copied} rows to media_trigram")
+                time.sleep(pause)
+
+        if copied or removed:
+            inline_cache.invalidate()
+        logger.info(f"media_trigram migrated, {copied} rows copied, {removed} removed")
+        return copied
+
+    @classmethod
+    def _remove_orphans(cls, table_name: str, batch_size: int, pause: float) -> int:
+        """Deletes rows of a table keyed by media_id whose media no longer exist, in short batches."""
+        select_batch_query = f"SELECT rowid FROM {table_name} WHERE rowid > ? ORDER BY rowid LIMIT ?;"
+        delete_query = f"""
+            DELETE FROM {table_name} WHERE rowid = ? AND NOT EXISTS (SELECT 1 FROM media WHERE media_id = ?);
+        """
+        last_rowid = 0
+        removed = 0
+        while True:
+            rows = cls.execute_query(select_batch_query, (last_rowid, batch_size))
+            if not rows:
+                break
+
+            cursor = cls.execute_query(delete_query, [(rowid, rowid) for rowid, in rows], multiple=True)
+            last_rowid = rows[-1][0]
+            if cursor.rowcount > 0:
+                removed += cursor.rowcount
+                time.sleep(pause)
+        return removed
+
+    @classmethod
+    def export_user(cls, user_id: int, file) -> int:
+        """
+        Writes all media of the user to a text file as JSON lines, streaming rows from the database.
+
+        :param user_id: The ID of the user whose media to export
+        :param file: File object opened for writing text
+        :return: Number of exported records
+        """
+        query = """
+            SELECT media.user_id, media.media_type, media.file_id, media.caption, media_fts.description
+            FROM media
+            LEFT JOIN media_fts ON media_fts.rowid = media.media_id
+            WHERE media.user_id = ?
+            ORDER BY media.media_id;
+        """
+        keys = ("user_id", "media_type", "file_id", "caption", "description")
+        exported = 0
+        for row in cls.iterate_query(query, (user_id,), shard_key=user_id):
+            file.write(json.dumps(dict(zip(keys, row)), ensure_ascii=False) + "\n")
+            exported += 1
+        logger.info(f"Exported {exported} records of user {user_id}")
+        return exported
+
+    @classmethod
+    def import_rows(cls, rows, user_id: int = None, chunk_size: int = IMPORT_CHUNK_SIZE) -> dict:
+        """
+        Inserts media records in chunks, one transaction per chunk. Records already present in the vault
+        (same user_id and file_id) are skipped. Missing users are created with an empty username.
+
+        :param rows: Iterable of dicts as written by export_user
+        :param user_id: Import all records into the vault of this user instead of their original one
+        :param chunk_size: Number of records inserted per transaction
+        :return: Dict with number of read, inserted and skipped records and rows per second
+        """
+        insert_users_query = "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, '');"
+        insert_media_query = """
+            INSERT OR IGNORE INTO media (user_id, media_type, file_id, caption, inline_result) VALUES (?, ?, ?, ?, ?);
+        """
+        # uses UNIQUE (user_id, file_id) to find the new media_id, media inserted before already has its description
+        insert_fts_query = """
+            INSERT INTO {table_name} (rowid, description, user_id)
+            SELECT media.media_id, ?, media.user_id FROM media
+            WHERE media.user_id = ? AND media.file_id = ?
+            AND NOT EXISTS (SELECT 1 FROM {table_name} WHERE {table_name}.rowid = media.media_id);
+        """
+        fts_tables = ("media_fts", "media_trigram") if TRIGRAM_SEARCH else ("media_fts",)
+
+        started = time.perf_counter()
+        read = inserted = 0
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            if user_id is not None:
+                chunk = [dict(row, user_id=user_id) for row in chunk]
+
+            users = {row["user_id"] for row in chunk}
+            with Users.transaction():
+                Users.execute_query(insert_users_query, [(user,) for user in users], multiple=True)
+                for pool, shard_users in cls.shards_of(users).items():  # a transaction per shard file
+                    shard_users = set(shard_users)
+                    shard_rows = [row for row in chunk if row["user_id"] in shard_users]
+                    with cls.pinned(pool), cls.transaction():
+                        cursor = cls.execute_query(insert_media_query, [
+                            (row["user_id"], row["media_type"], row["file_id"], row.get("caption"),
+                             build_fragment(row["media_type"], row["file_id"], row.get("caption"), row["description"]))
+                            for row in shard_rows
+                        ], multiple=True)
+                        descriptions = [(row["description"], row["user_id"], row["file_id"]) for row in shard_rows]
+                        for table_name in fts_tables:
+                            cls.execute_query(insert_fts_query.format(table_name=table_name), descriptions,
+                                              multiple=True)
+                        for user in shard_users:
+                            cls.on_commit(lambda user=user: inline_cache.invalidate(user))
+                    inserted += max(cursor.rowcount, 0)
+
+            read += len(chunk)
+            logger.info(f"Imported {read} records, {inserted} new")
+
+        elapsed = time.perf_counter() - started
+        report = {
+            "read": read,
+            "inserted": inserted,
+            "skipped": read - inserted,
+            "seconds": elapsed,
+            "rows_per_second": read / elapsed if elapsed else 0.0,
+        }
+        logger.info(f"Import finished: {report}")
+        return report
+
+    @staticmethod
+    def match_expression(description: str) -> str:
+        """Builds FTS MATCH expression from normalized text, the last term is matched as a prefix."""
+        terms = description.split()
+        search_terms = terms[:-1] + [f"{terms[-1]}*"]  # append * to the last term to enable prefix search for it
+        return ' OR '.join(search_terms)
+
+    @staticmethod
+    def trigram_expression(description: str) -> str:
+        """Builds media_trigram MATCH expression matching any term as a substring, shorter terms are dropped."""
+        terms = [term for term in description.split() if len(term) >= TRIGRAM_MIN_LENGTH]
+        return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+    @staticmethod
+    def trigram_searchable(description: str) -> bool:
+        """Whether a trigram search can match the text, every term needs at least TRIGRAM_MIN_LENGTH characters."""
+        terms = description.split()
+        return TRIGRAM_SEARCH and bool(terms) and all(len(term) >= TRIGRAM_MIN_LENGTH for term in terms)
+
+
+class MediaStats(Database):
+    """Per-user item counts by media type, kept up to date by triggers on the media table."""
+    table_name = "media_stats"
+    sharded = True
+    columns = ("user_id", "media_type", "count")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS media_stats (
+        user_id INTEGER NOT NULL,
+        media_type TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, media_type)
+    ) WITHOUT ROWID;
+    """
+
+    @classmethod
+    def create_table(cls) -> None:
+        create_insert_trigger_query = """
+        CREATE TRIGGER IF NOT EXISTS media_stats_insert AFTER INSERT ON media
+        BEGIN
+            INSERT INTO media_stats (user_id, media_type, count) VALUES (NEW.user_id, NEW.media_type, 1)
+            ON CONFLICT (user_id, media_type) DO UPDATE SET count = count + 1;
+        END;
+        """
+        create_delete_trigger_query = """
+        CREATE TRIGGER IF NOT EXISTS media_stats_delete AFTER DELETE ON media
+        BEGIN
+            UPDATE media_stats SET count = count - 1
+            WHERE user_id = OLD.user_id AND media_type = OLD.media_type;
+            DELETE FROM media_stats
+            WHERE user_id = OLD.user_id AND media_type = OLD.media_type AND count <= 0;
+        END;
+        """
+        # an item moves between counters when its type or owner changes
+        create_update_trigger_query = """
+        CREATE TRIGGER IF NOT EXISTS media_stats_update AFTER UPDATE OF media_type, user_id ON media
+        WHEN OLD.media_type IS NOT NEW.media_type OR OLD.user_id IS NOT NEW.user_id
+        BEGIN
+            UPDATE media_stats SET count = count - 1
+            WHERE user_id = OLD.user_id AND media_type = OLD.media_type;
+            DELETE FROM media_stats
+            WHERE user_id = OLD.user_id AND media_type = OLD.media_type AND count <= 0;
+            INSERT INTO media_stats (user_id, media_type, count) VALUES (NEW.user_id, NEW.media_type, 1)
+            ON CONFLICT (user_id, media_type) DO UPDATE SET count = count + 1;
+        END;
+        """
+        # counts of media saved before the triggers existed
+        backfill_query = """
+        INSERT OR IGNORE INTO media_stats (user_id, media_type, count)
+        SELECT user_id, media_type, COUNT(*) FROM media GROUP BY user_id, media_type;
+        """
+        cls.execute_query(cls.create_table_query)
+
+        # triggers can't be created before media table, Media.create_table calls this again after creating it
+        if cls.execute_query("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'media';"):
+            with cls.transaction():  # no insert can slip between the backfill and the triggers
+                cls.execute_query(create_insert_trigger_query)
+                cls.execute_query(create_delete_trigger_query)
+                cls.execute_query(create_update_trigger_query)
+                cls.execute_query(backfill_query)
+
+    @classmethod
+    def get_counts(cls, user_id: int) -> dict:
+        """Returns number of user's items by media type."""
+        rows = cls.execute_query("SELECT media_type, count FROM media_stats WHERE user_id = ?;", (user_id,),
+                                 shard_key=user_id)
+        return dict(rows)
+
+    @classmethod
+    def total(cls, user_id: int) -> int:
+        """Returns total number of user's items."""
+        result = cls.execute_query("SELECT SUM(count) FROM media_stats WHERE user_id = ?;", (user_id,),
+                                   shard_key=user_id)
+        return (result[0][0] or 0) if result else 0
+
+
+class MediaGenerations(Database):
+    """
+    Per-user counters of changes to media, bumped by triggers on the media table in the transaction of the change.
+    Inline cache entries are tagged with the generation they were computed at, so every process can tell that
+    an entry is stale, even if the change was made by another process.
+    """
+    table_name = "media_generations"
+    sharded = True
+    columns = ("user_id", "generation")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS media_generations (
+        user_id INTEGER PRIMARY KEY,
+        generation INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID;
+    """
+
+    @classmethod
+    def create_table(cls) -> None:
+        bump_query = """
+        INSERT INTO media_generations (user_id, generation) VALUES ({row}.user_id, 1)
+        ON CONFLICT (user_id) DO UPDATE SET generation = generation + 1;
+        """
+        create_insert_trigger_query = f"""
+        CREATE TRIGGER IF NOT EXISTS media_generations_insert AFTER INSERT ON media
+        BEGIN
+            {bump_query.format(row="NEW")}
+        END;
+        """
+        create_delete_trigger_query = f"""
+        CREATE TRIGGER IF NOT EXISTS media_generations_delete AFTER DELETE ON media
+        BEGIN
+            {bump_query.format(row="OLD")}
+        END;
+        """
+        # any column, descriptions change inline_result too
+        create_update_trigger_query = f"""
+        CREATE TRIGGER IF NOT EXISTS media_generations_update AFTER UPDATE ON media
+        BEGIN
+            {bump_query.format(row="NEW")}
+            INSERT INTO media_generations (user_id, generation)
+            SELECT OLD.user_id, 1 WHERE OLD.user_id IS NOT NEW.user_id
+            ON CONFLICT (user_id) DO UPDATE SET generation = generation + 1;
+        END;
+        """
+        cls.execute_query(cls.create_table_query)
+
+        # same as MediaStats, Media.create_table calls this again after creating media table
+        if cls.execute_query("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'media';"):
+            with cls.transaction():
+                cls.execute_query(create_insert_trigger_query)
+                cls.execute_query(create_delete_trigger_query)
+                cls.execute_query(create_update_trigger_query)
+
+    @classmethod
+    def current(cls, user_id: int) -> int:
+        """Returns the current generation of user's media, 0 if it never changed."""
+        result = cls.execute_query("SELECT generation FROM media_generations WHERE user_id = ?;", (user_id,),
+                                   shard_key=user_id)
+        return result[0][0] if result else 0
+
 
 class Temp(Database):
     table_name = "temp"
+    sharded = True
     columns = ("user_id", "key", "value")
     create_table_query = """
     CREATE TABLE IF NOT EXISTS temp (
@@ -505,3 +2085,241 @@ class Temp(Database):
     @classmethod
     def add_bulk(cls, data: dict or list[dict], replace: bool = True) -> tuple[bool, int]:
         return super().add_bulk(data, replace=replace)
+
+
+class States(Database):
+    """Conversation state of users, one row per user with all keys serialized as a JSON object."""
+    table_name = "states"
+    sharded = True
+    columns = ("user_id", "data")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS states (
+        user_id INTEGER PRIMARY KEY,
+        data TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users(user_id) ON DELETE CASCADE
+    );
+    """
+
+    @classmethod
+    def create_table(cls) -> None:
+        super().create_table()
+        # carry over conversations that were in progress in the key-value temp table
+        if cls.execute_query("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'temp';"):
+            cls.execute_query("""
+                INSERT OR IGNORE INTO states (user_id, data)
+                SELECT user_id, json_group_object(key, value) FROM temp GROUP BY user_id;
+            """)
+
+    @classmethod
+    def load(cls, user_id: int) -> dict or None:
+        """Returns the state of the user, None if there is none."""
+        rows = cls.execute_query("SELECT data FROM states WHERE user_id = ?;", (user_id,), shard_key=user_id)
+        return json.loads(rows[0][0]) if rows else None
+
+    @classmethod
+    def save(cls, states: dict) -> bool:
+        """Saves states given as {user_id: state}, users with an empty state are removed."""
+        status = True
+        for pool, users in cls.shards_of(states).items():  # a transaction per shard file
+            upserts = [(user_id, json.dumps(states[user_id])) for user_id in users if states[user_id]]
+            removals = [(user_id,) for user_id in users if not states[user_id]]
+            with cls.pinned(pool), cls.transaction():
+                if upserts:
+                    cursor = cls.execute_query("INSERT OR REPLACE INTO states (user_id, data) VALUES (?, ?);", upserts,
+                                               multiple=True)
+                    status = status and cursor.rowcount > 0
+                if removals:
+                    cursor = cls.execute_query("DELETE FROM states WHERE user_id = ?;", removals, multiple=True)
+                    status = status and cursor.rowcount >= 0
+        return status
+
+
+class Broadcasts(Database):
+    table_name = "broadcasts"
+    columns = ("broadcast_id", "text", "reply_markup", "exceptions", "status", "last_user_id", "sent", "failed",
+               "created_at", "updated_at")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        broadcast_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        reply_markup TEXT,
+        exceptions TEXT,
+        status TEXT NOT NULL DEFAULT 'pending',
+        last_user_id INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        updated_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    """
+
+    @classmethod
+    def record_progress(cls, broadcast_id: int, last_user_id: int, sent: int, failed: int) -> bool:
+        """Moves the checkpoint of a broadcast past a finished batch of users."""
+        query = """
+            UPDATE broadcasts
+            SET last_user_id = ?, sent = sent + ?, failed = failed + ?, updated_at = CURRENT_TIMESTAMP
+            WHERE broadcast_id = ?;
+        """
+        cursor = cls.execute_query(query, (last_user_id, sent, failed, broadcast_id))
+        return cursor.rowcount > 0
+
+
+class BroadcastFailures(Database):
+    table_name = "broadcast_failures"
+    columns = ("broadcast_id", "user_id", "error")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS broadcast_failures (
+        broadcast_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        error TEXT,
+        PRIMARY KEY (broadcast_id, user_id),
+        FOREIGN KEY (broadcast_id) REFERENCES broadcasts(broadcast_id) ON DELETE CASCADE
+    );
+    """
+
+    @classmethod
+    def add_bulk(cls, data: dict or list[dict], replace: bool = True) -> tuple[bool, int]:
+        return super().add_bulk(data, replace=replace)
+
+
+def _tables(connection: sqlite3.Connection, table_name: str = None) -> set:
+    """Returns names of tables of a database file, or of columns of table_name."""
+    if table_name:
+        return {row[0] for row in connection.execute("SELECT name FROM pragma_table_info(?);", (table_name,))}
+    return {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+
+
+def reshard(shard_count: int) -> dict:
+    """
+    Moves rows of the per-user tables from the SHARD_COUNT files they are in now into shard_count files.
+    Runs offline: stop the bot first, and start it with SHARD_COUNT=shard_count afterwards. Media get new
+    media_ids in their new shard, as ids of different shards overlap. The old files are only removed once
+    all rows are copied, an interrupted run can be repeated.
+
+    :param shard_count: Number of shard files, 1 moves everything back into DATABASE_PATH
+    :return: Dict with number of media and states in each new shard
+    """
+    if shard_count < 1:
+        raise ValueError("Shard count must be at least 1.")
+    if shard_count == len(Database.shards):
+        raise ValueError(f"The database already has {shard_count} shard(s).")
+
+    global_file = database_file(DATABASE_PATH)
+    sources = [pool.db_path for pool in Database.shards]
+    targets = [database_file(shard_path(i, shard_count)) for i in range(shard_count)]
+    # a single shard is the global file, which is written in place, new shard files are swapped in at the end
+    work_files = targets if shard_count == 1 else [f"{target}.resharding" for target in targets]
+    for pool in {Database.connection, *Database.shards}:
+        pool.close()
+
+    source_tables = {}
+    for source in sources:
+        if not os.path.exists(source):
+            continue
+        connection = sqlite3.connect(source)
+        try:
+            tables = source_tables[source] = _tables(connection)
+            if "media" in tables and ("inline_result" not in _tables(connection, "media")
+                                      or "media_id" in _tables(connection, "media_fts")):
+                raise RuntimeError(f"{source} has an outdated schema, run manage.py migrate first")
+        finally:
+            connection.close()
+    has_temp = any("temp" in tables for tables in source_tables.values())
+
+    for work_file in work_files:
+        if work_file != global_file:
+            for leftover in (work_file, f"{work_file}-wal", f"{work_file}-shm"):  # of an interrupted run
+                if os.path.exists(leftover):
+                    os.remove(leftover)
+        pool = Database.connection if work_file == global_file else Connection(work_file, timeout=5)
+        with Database.pinned(pool):
+            Media.create_table()
+            States.create_table()
+            if has_temp:
+                Temp.create_table()
+        pool.close()
+
+    def in_shard(column: str) -> str:  # same as shard_index
+        return f"(({column} % {shard_count}) + {shard_count}) % {shard_count} = ?"
+
+    copy_media_query = f"""
+        INSERT OR IGNORE INTO target.media (user_id, media_type, file_id, caption, inline_result)
+        SELECT user_id, media_type, file_id, caption, inline_result FROM main.media
+        WHERE {in_shard("user_id")}
+        ORDER BY media_id;
+    """
+    # new media_ids are found through UNIQUE (user_id, file_id)
+    copy_fts_query = f"""
+        INSERT INTO target.{{table_name}} (rowid, description, user_id)
+        SELECT moved.media_id, media_fts.description, moved.user_id
+        FROM main.media
+        JOIN main.media_fts ON media_fts.rowid = media.media_id
+        JOIN target.media AS moved ON moved.user_id = media.user_id AND moved.file_id = media.file_id
+        WHERE {in_shard("media.user_id")}
+        AND NOT EXISTS (SELECT 1 FROM target.{{table_name}} AS copied WHERE copied.rowid = moved.media_id);
+    """
+    copy_states_queries = {
+        "states": f"INSERT OR REPLACE INTO target.states (user_id, data) "
+                  f"SELECT user_id, data FROM main.states WHERE {in_shard('user_id')};",
+        "temp": f"INSERT OR REPLACE INTO target.temp (user_id, key, value) "
+                f"SELECT user_id, key, value FROM main.temp WHERE {in_shard('user_id')};",
+    }
+    fts_tables = ("media_fts", "media_trigram") if TRIGRAM_SEARCH else ("media_fts",)
+
+    for source, tables in source_tables.items():
+        connection = sqlite3.connect(source, isolation_level=None)
+        try:
+            for index, work_file in enumerate(work_files):
+                connection.execute("ATTACH DATABASE ? AS target;", (work_file,))
+                try:
+                    connection.execute("BEGIN IMMEDIATE;")
+                    if "media" in tables:
+                        connection.execute(copy_media_query, (index,))
+                        for table_name in fts_tables:
+                            connection.execute(copy_fts_query.format(table_name=table_name), (index,))
+                    for table_name, query in copy_states_queries.items():
+                        if table_name in tables:
+                            connection.execute(query, (index,))
+                    connection.execute("COMMIT;")
+                except BaseException:
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK;")
+                    raise
+                finally:
+                    connection.execute("DETACH DATABASE target;")
+            logger.info(f"Copied rows of {source}")
+        finally:
+            connection.close()
+
+    report = {"media": [], "states": []}
+    for work_file in work_files:
+        connection = sqlite3.connect(work_file, isolation_level=None)
+        try:
+            for table_name in report:
+                report[table_name].append(connection.execute(f"SELECT COUNT(*) FROM {table_name};").fetchone()[0])
+            if work_file != global_file:
+                connection.execute("PRAGMA journal_mode=DELETE;")  # checkpoints the WAL, so the file can be renamed
+        finally:
+            connection.close()
+
+    # all rows are copied, remove them from the old files
+    if global_file in source_tables and shard_count > 1:
+        connection = sqlite3.connect(global_file, isolation_level=None)
+        try:
+            for table_name in ("media_trigram", "media_fts", "media_stats", "media_generations", "media", "states",
+                               "temp"):
+                connection.execute(f"DROP TABLE IF EXISTS {table_name};")
+        finally:
+            connection.close()
+    for source in sources:
+        if source != global_file:
+            for path in (source, f"{source}-wal", f"{source}-shm"):
+                if os.path.exists(path):
+                    os.remove(path)
+    if shard_count > 1:
+        for work_file, target in zip(work_files, targets):
+            os.replace(work_file, target)
+
+    logger.info(f"Resharded into {shard_count} file(s): {report}")
+    return report
@@ -1,10 +1,13 @@
-from flask import Flask, request
-from bot import Bot, telepot
+from flask import Flask, Response, jsonify, request
 import urllib3
 from urllib3.util.retry import Retry
-from logger import setup_logger, process_logs
+from logger import setup_logger, process_logs, log_stats
+from cache import inline_cache
+from state import state_store
+import database as db
+import metrics
 import os
-from dotenv import load_dotenv
+import atexit
 
 
 class LoggingRetry(Retry):  # overriding class to have logs when connection errors occur
@@ -19,38 +22,132 @@ class LoggingRetry(Retry):  # overriding class to have logs when connection erro
         return super().increment(*args, **kwargs)
 
 
-project_folder = os.path.expanduser('~/mysite')
-load_dotenv(os.path.join(project_folder, '.env'))
+PROJECT_FOLDER = os.path.expanduser('~/mysite')
 
-proxy_url = "http://proxy.server:3128"
-retry_strategy = Retry(
-    total=5,
-    backoff_factor=0.5,
-    status_forcelist=[429, 500, 502, 503, 504],
-    allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
-)
-telepot.api._pools = {
-    'default': urllib3.ProxyManager(proxy_url=proxy_url, num_pools=3, maxsize=10, retries=retry_strategy, timeout=30),
-}
-telepot.api._onetime_pool_spec = (urllib3.ProxyManager, dict(proxy_url=proxy_url, num_pools=1, maxsize=1, retries=retry_strategy, timeout=30))
 
-TOKEN = os.getenv("TELEGRAM_TOKEN")
-SECRET = os.getenv("SECRET")
-SITE = os.getenv("SITE_URL")
+def load_config() -> dict:
+    """Reads settings from ~/mysite/.env, variables already set in the environment take precedence."""
+    from dotenv import load_dotenv
 
-bot = Bot(TOKEN)
-bot.setWebhook(SITE + SECRET, max_connections=1)
+    load_dotenv(os.path.join(PROJECT_FOLDER, '.env'))
+    return {
+        "TELEGRAM_TOKEN": os.getenv("TELEGRAM_TOKEN"),
+        "SECRET": os.getenv("SECRET"),
+        "SITE_URL": os.getenv("SITE_URL"),
+        "PROXY_URL": os.getenv("PROXY_URL", "http://proxy.server:3128") or None,  # empty to connect directly
+        "WEBHOOK_MODE": os.getenv("WEBHOOK_MODE", "sync"),  # "async" acknowledges updates and processes them on workers
+        "WEBHOOK_WORKERS": int(os.getenv("WEBHOOK_WORKERS", 4)),
+        "WEBHOOK_MAX_CONNECTIONS": int(os.getenv("WEBHOOK_MAX_CONNECTIONS", 1)),
+    }
 
-app = Flask(__name__)
 
+def configure_telepot(proxy_url: str or None) -> None:
+    """
+    Sends telepot requests through the proxy. Pools connect on the first request, so they aren't shared with forks.
+    """
+    from bot import telepot
 
-@app.route('/{}'.format(SECRET), methods=["POST"])
-def telegram_webhook():
-    update = request.get_json()
-    bot.handle_update(update)
-    return "OK"
+    if not proxy_url:
+        return
+    retry_strategy = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=["HEAD", "GET", "OPTIONS", "POST"]
+    )
+    telepot.api._pools = {
+        'default': urllib3.ProxyManager(proxy_url=proxy_url, num_pools=3, maxsize=10, retries=retry_strategy,
+                                        timeout=30),
+    }
+    telepot.api._onetime_pool_spec = (urllib3.ProxyManager, dict(proxy_url=proxy_url, num_pools=1, maxsize=1,
+                                                                 retries=retry_strategy, timeout=30))
 
 
-@app.route(f'/{SECRET}/logs', methods=["GET"])
-def view_logs():
-    return process_logs()
+def create_bot(config: dict = None):
+    """Builds the bot without contacting Telegram, the API client starts with the first request."""
+    from bot import Bot
+
+    config = config or load_config()
+    configure_telepot(config["PROXY_URL"])
+    bot = Bot(config["TELEGRAM_TOKEN"], proxy=config["PROXY_URL"])
+    if bot.api is not None:
+        atexit.register(bot.api.close)
+    return bot
+
+
+def set_webhook(config: dict = None):
+    """Registers {SITE_URL}{SECRET} as the webhook, once per deployment rather than on every worker start."""
+    config = config or load_config()
+    bot = create_bot(config)
+    return bot.setWebhook(config["SITE_URL"] + config["SECRET"], max_connections=config["WEBHOOK_MAX_CONNECTIONS"])
+
+
+def create_app(config: dict = None) -> Flask:
+    """
+    Builds the web app. Nothing is opened here: database connections, HTTP pools and worker threads are
+    created by the first request that needs them, in the process that serves it.
+
+    :param config: settings as returned by load_config, read from the environment by default
+    """
+    from bot import UpdateDispatcher
+
+    config = config or load_config()
+    bot = create_bot(config)
+    secret = config["SECRET"]
+
+    dispatcher = None
+    if config["WEBHOOK_MODE"] == "async":
+        # workers are started by the first update
+        dispatcher = UpdateDispatcher(bot.handle_update, key=lambda update: bot.get_user(update)[0],
+                                      workers=config["WEBHOOK_WORKERS"])
+        atexit.register(dispatcher.stop)
+
+    metrics.register_collector("inline_cache", inline_cache.stats)
+    metrics.register_collector("state_store", state_store.stats)
+    metrics.register_collector("db_pool", db.Database.pool_stats)
+    metrics.register_collector("db_transactions", db.Database.transaction_stats)
+    metrics.register_collector("db_writer", db.Database.writer_stats)
+    metrics.register_collector("logging", log_stats)
+    if dispatcher is not None:
+        metrics.register_collector("dispatcher", dispatcher.stats)
+
+    app = Flask(__name__)
+    app.config.update(config)
+    app.extensions["bot"] = bot
+
+    @app.route('/{}'.format(secret), methods=["POST"])
+    def telegram_webhook():
+        update = request.get_json(silent=True)
+        if not isinstance(update, dict) or "update_id" not in update:
+            return jsonify({"ok": False, "error": "Bad Request"}), 400
+
+        if dispatcher is None:
+            bot.handle_update(update)
+        elif not dispatcher.submit(update):
+            # Telegram will redeliver the update later
+            return jsonify({"ok": False, "error": "Service Unavailable"}), 503
+        return "OK"
+
+    @app.route(f'/{secret}/logs', methods=["GET"])
+    def view_logs():
+        return process_logs(request.args)
+
+    @app.route(f'/{secret}/metrics', methods=["GET"])
+    def view_metrics():
+        return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+    @app.route(f'/{secret}/queries', methods=["GET"])
+    def view_query_stats():
+        # also written to the slow query log, ?reset=1 starts counting anew
+        return jsonify(db.query_stats.dump(reset=request.args.get("reset") == "1"))
+
+    return app
+
+
+def __getattr__(name):
+    """Builds flask_app.app when it's first used, e.g. by the WSGI file, so importing the module stays cheap."""
+    global app
+    if name == "app":
+        app = create_app()
+        return app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
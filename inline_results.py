@@ -0,0 +1,57 @@
+"""
+Serialized InlineQueryResult objects. A fragment is the JSON of the result without its id, computed once
+when the media is saved. Answers to inline queries are assembled by putting ids in front of stored fragments.
+"""
+import json
+
+# media_type -> (result type, file id field, fields filled from the description and caption)
+RESULT_TYPES = {
+    "gif": ("gif", "gif_file_id", ("title", "caption")),
+    "audio": ("audio", "audio_file_id", ("caption",)),
+    "document": ("document", "document_file_id", ("title", "caption")),
+    "photo": ("photo", "photo_file_id", ("title", "caption")),
+    "sticker": ("sticker", "sticker_file_id", ()),
+    "video": ("video", "video_file_id", ("title", "caption")),
+    "voice": ("voice", "voice_file_id", ("title", "caption")),
+}
+
+
+def build_fragment(media_type: str, file_id: str, caption: str = None, description: str = None) -> str or None:
+    """
+    Serializes the inline query result of a media record without its id.
+
+    :return: JSON object text, or None for unsupported media types
+    """
+    if media_type == "article":  # text is stored in file_id
+        result = {
+            "type": "article",
+            "title": "Text",
+            "input_message_content": {"message_text": file_id},
+            "description": description,
+        }
+    elif media_type in RESULT_TYPES:
+        result_type, file_id_field, fields = RESULT_TYPES[media_type]
+        values = {"title": description, "caption": caption}
+        result = {"type": result_type, file_id_field: file_id}
+        result.update((field, values[field]) for field in fields)
+    else:
+        return None
+
+    return json.dumps({key: value for key, value in result.items() if value is not None}, ensure_ascii=False,
+                      separators=(',', ':'))
+
+
+def assemble(media_id: int, fragment: str) -> str:
+    """Puts the id in front of the fields of a stored fragment."""
+    return '{"id":"' + str(media_id) + '",' + fragment[1:]
+
+
+def assemble_results(results) -> str:
+    """
+    Builds the results parameter of answerInlineQuery.
+
+    :param results: iterable of (media_id, fragment)
+    :return: JSON array text, "" if there are no results
+    """
+    items = [assemble(media_id, fragment) for media_id, fragment in results if fragment is not None]
+    return "[" + ",".join(items) + "]" if items else ""
@@ -1,13 +1,28 @@
+import atexit
+from collections import deque
+from contextlib import ExitStack
+import copy
+import html
 import logging
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import os
+import queue
+import re
 import threading
 
 
-LOG_PATH = os.path.join(os.path.expanduser("~"), 'mysite', 'logs')
-os.makedirs(LOG_PATH, exist_ok=True)
+LOG_PATH = os.path.join(os.path.expanduser("~"), 'mysite', 'logs')  # created by the first record written
 
 LOG_FILE = os.path.join(LOG_PATH, 'app.log')
+SLOW_QUERY_LOG_FILE = os.path.join(LOG_PATH, 'slow_queries.log')
+LOG_MAX_BYTES = 10_000_000
+LOG_BACKUP_COUNT = 3  # rotated files app.log.1 (newest) .. app.log.3 (oldest)
+LOG_PAGE_SIZE = 200  # entries per page of the log viewer
+LOG_READ_BLOCK = 64 * 1024  # bytes read at once when scanning a log file backwards
+DEBUG_BUFFER_SIZE = int(os.getenv("DEBUG_BUFFER_SIZE", 200))  # DEBUG records kept per update
+LOG_MODE = os.getenv("LOG_MODE", "sync")  # "queue" leaves formatting, rotation and I/O to a background thread
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", 10_000))  # records waiting for the background thread
+LOG_ERROR_WAIT = 1.0  # seconds an ERROR or CRITICAL record may wait for space in a full queue
 
 # Thread-local storage for per-update debug logs
 thread_local = threading.local()
@@ -19,155 +34,419 @@ def set_show_debug(value: bool):
     show_debug = value
 
 
+def begin_update():
+    """Starts capturing DEBUG records of a new update on the current thread, dropping the ones of the previous."""
+    buffer = getattr(thread_local, "debug_log_buffer", None)
+    if buffer is None:
+        thread_local.debug_log_buffer = deque(maxlen=DEBUG_BUFFER_SIZE)
+    else:
+        buffer.clear()
+
+
+def flush_debug_log():
+    """Writes DEBUG records captured for the current update to the log and empties the buffer."""
+    buffer = getattr(thread_local, "debug_log_buffer", None)
+    if not buffer:
+        return
+
+    logger = logging.getLogger("main_logger")
+    logger.debug(f"Last {len(buffer)} debug records before crash:", extra={"flushed": True})
+    while buffer:
+        record = buffer.popleft()
+        record.flushed = True  # let it through DebugLogFilter
+        logger.handle(record)
+
+
 class DebugLogFilter(logging.Filter):
-    """Custom filter to store DEBUG logs per Telegram update in thread-local storage."""
+    """
+    Keeps DEBUG records of the current Telegram update in a bounded thread-local ring buffer instead of logging them.
+    Records are stored as is, messages are formatted only if the buffer is flushed after an error.
+    """
     def filter(self, record):
         if record.levelno == logging.DEBUG:
             # Check if we should show debug logs
-            if show_debug:
+            if show_debug or getattr(record, "flushed", False):
                 return True  # Allow DEBUG logs to be logged to the output
 
             # Otherwise, store them in thread-local storage
-            if not hasattr(thread_local, "debug_log_stack"):
-                thread_local.debug_log_stack = []
-            log_entry = f"{record.getMessage()} [in {record.pathname}:{record.lineno}]"
-            thread_local.debug_log_stack.append(log_entry)  # Store formatted log
+            buffer = getattr(thread_local, "debug_log_buffer", None)
+            if buffer is None:
+                buffer = thread_local.debug_log_buffer = deque(maxlen=DEBUG_BUFFER_SIZE)
+            buffer.append(record)  # the oldest record is dropped once the buffer is full
             return False  # Prevent DEBUG log from being processed normally
         return True  # Allow all other log levels
 
 
+class LazyRotatingFileHandler(RotatingFileHandler):
+    """Creates the log directory and opens the file when the first record is written, not on import."""
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, delay=True, **kwargs)
+
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Puts records to a bounded queue without blocking the logging thread. When the queue is full, records
+    are dropped and counted. ERROR and CRITICAL records wait for a moment before they are given up.
+    """
+    def __init__(self, queue_: queue.Queue):
+        super().__init__(queue_)
+        self.dropped = 0
+        self.exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        """
+        Merges args into the message and formats the traceback in the logging thread, the objects they refer to
+        may change before the listener gets to the record. Layout of the line is still left to the listener.
+        """
+        record = copy.copy(record)  # other handlers of the logger get the original
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.exception_formatter.formatException(record.exc_info)  # appended by formatters
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            if record.levelno >= logging.ERROR:
+                self.queue.put(record, timeout=LOG_ERROR_WAIT)
+            else:
+                self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogQueueListener(QueueListener):
+    """Passes queued records to the real handlers and logs how many records were dropped since the last time."""
+    def __init__(self, queue_: queue.Queue, queue_handler: DroppingQueueHandler, *handlers):
+        super().__init__(queue_, *handlers, respect_handler_level=True)
+        self.queue_handler = queue_handler
+        self.reported = 0
+
+    def handle(self, record):
+        dropped = self.queue_handler.dropped
+        if dropped > self.reported:
+            warning = logging.makeLogRecord({
+                "name": record.name, "levelno": logging.WARNING, "levelname": "WARNING",
+                "msg": f"Log queue was full, dropped {dropped - self.reported} records", "pathname": __file__,
+            })
+            self.reported = dropped
+            super().handle(warning)
+        super().handle(record)
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)  # waits for space instead of failing on a full queue
+
+
+queue_listener = None
+
+
+def stop_queue_listener():
+    """Writes out records left in the queue and stops the background thread."""
+    global queue_listener
+    listener, queue_listener = queue_listener, None
+    if listener is None:
+        return
+    listener.stop()
+    for handler in listener.handlers:
+        handler.flush()
+
+
+def log_stats() -> dict:
+    """Returns the logging mode and, in queue mode, the number of queued and dropped records."""
+    if queue_listener is None:
+        return {"mode": "sync"}
+    return {
+        "mode": "queue",
+        "queued": queue_listener.queue.qsize(),
+        "maxsize": queue_listener.queue.maxsize,
+        "dropped": queue_listener.queue_handler.dropped,
+    }
+
+
 def setup_logger(name):
+    global queue_listener
     logger = logging.getLogger("main_logger")  # Use a single global name
     if logger.hasHandlers():
         return logger  # Prevent duplicate handlers
 
-    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=10_000_000, backupCount=3, encoding='utf-8')
+    file_handler = LazyRotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                           encoding='utf-8')
     formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]',
                                   datefmt='%Y-%m-%d %H:%M:%S')
     file_handler.setFormatter(formatter)
     file_handler.setLevel(logging.DEBUG)
 
-    # Add debug log filter
-    debug_filter = DebugLogFilter()
-    file_handler.addFilter(debug_filter)
-
     console_handler = logging.StreamHandler()
     console_formatter = logging.Formatter('%(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]')
     console_handler.setFormatter(console_formatter)
     console_handler.setLevel(logging.DEBUG)
 
     logger.setLevel(logging.DEBUG)
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
+    # on the logger rather than a handler, so a record is buffered once and no handler formats it.
+    # It also has to run on the logging thread, the debug buffer is thread-local
+    logger.addFilter(DebugLogFilter())
+    if LOG_MODE == "queue":
+        records = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        queue_handler = DroppingQueueHandler(records)
+        queue_listener = LogQueueListener(records, queue_handler, file_handler, console_handler)
+        queue_listener.start()
+        atexit.register(stop_queue_listener)
+        logger.addHandler(queue_handler)
+    else:
+        logger.addHandler(file_handler)
+        logger.addHandler(console_handler)
     logger.propagate = False
 
     return logger
 
 
+def setup_slow_query_logger():
+    """Returns the logger writing statements over the slow query threshold to their own file."""
+    logger = logging.getLogger("slow_queries")
+    if logger.hasHandlers():
+        return logger
+
+    # the file is created by the first slow query
+    file_handler = LazyRotatingFileHandler(SLOW_QUERY_LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=1,
+                                           encoding='utf-8')
+    file_handler.setFormatter(logging.Formatter('%(asctime)s %(message)s', datefmt='%Y-%m-%d %H:%M:%S'))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    logger.propagate = False
+    return logger
+
+
 def clean_line(line):
     return ''.join(char for char in line if char.isprintable())
 
 
-def process_logs():
-    from flask import Response, render_template_string
-    import re
-    log_file_path = os.path.join(os.path.expanduser("~"), 'mysite', 'logs', 'app.log')
-    level_colors = {
-        "DEBUG": "lightblue",
-        "INFO": "lightgreen",
-        "WARNING": "orange",
-        "ERROR": "red",
-        "CRITICAL": "magenta",
-    }
-
+TIMESTAMP_PATTERN = re.compile(rb'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}')
+LEVEL_COLORS = {
+    "DEBUG": "lightblue",
+    "INFO": "lightgreen",
+    "WARNING": "orange",
+    "ERROR": "red",
+    "CRITICAL": "magenta",
+}
+
+
+def log_files() -> list:
+    """Returns paths of the log file and its rotated backups, from the newest to the oldest."""
+    return [LOG_FILE] + [f"{LOG_FILE}.{i}" for i in range(1, LOG_BACKUP_COUNT + 1)]
+
+
+def _read_lines_backwards(file, end: int):
+    """Yields (offset, line) of non-empty lines located before the end offset, from the last one to the first."""
+    position = end
+    remainder = b""
+    while position > 0:
+        size = min(LOG_READ_BLOCK, position)
+        position -= size
+        file.seek(position)
+        block = file.read(size) + remainder
+        lines = block.split(b"\n")
+        remainder = lines.pop(0)  # might continue in the previous block
+
+        line_end = position + len(block)
+        for line in reversed(lines):
+            line_start = line_end - len(line)
+            if line:
+                yield line_start, line
+            line_end = line_start - 1
+    if remainder:
+        yield 0, remainder
+
+
+def _read_entries_backwards(file, end: int):
+    """Yields (offset, lines) of log entries located before the end offset, from the newest to the oldest."""
+    lines = []
+    for offset, line in _read_lines_backwards(file, end):
+        lines.append(line)
+        if TIMESTAMP_PATTERN.match(line):  # first line of an entry, the rest are tracebacks and multiline messages
+            lines.reverse()
+            yield offset, lines
+            lines = []
+    if lines:  # continuation of an entry from the previous file
+        lines.reverse()
+        yield 0, lines
+
+
+def _first_entry_at(file, position: int):
+    """Returns (offset, timestamp) of the first entry starting at or after the position, or (None, None)."""
+    file.seek(max(position - 1, 0))
+    if position > 0:
+        file.readline()  # skip to the start of the next line unless the position is one
+    while True:
+        offset = file.tell()
+        line = file.readline()
+        if not line:
+            return None, None
+        if TIMESTAMP_PATTERN.match(line):
+            return offset, line[:19].decode()
+
+
+def _entries_end(file, size: int, until: str) -> int:
+    """Binary searches the offset of the first entry logged after until, entries are in chronological order."""
+    low, high = 0, size
+    while low < high:
+        middle = (low + high) // 2
+        offset, timestamp = _first_entry_at(file, middle)
+        if offset is None or timestamp[:len(until)] > until:
+            high = middle
+        else:
+            low = middle + 1
+    offset, _ = _first_entry_at(file, low)
+    return size if offset is None else offset
+
+
+def read_log_entries(before: str = None, level: str = None, text: str = None, since: str = None,
+                     until: str = None):
+    """
+    Reads log entries from the newest to the oldest across the log file and its rotated backups.
+    Only the part of the files being returned is read, so the cost depends on the page, not on the file size.
+
+    :param before: cursor returned with a previous entry, only older entries are returned. It names the file
+        by its inode, so it still points to the same entry after the file was rotated; a cursor of a file
+        that no longer exists starts over from the newest entry
+    :param level: minimal level name, e.g. WARNING
+    :param text: case-insensitive substring the entry must contain
+    :param since: earliest timestamp or its prefix, e.g. "2025-01-31 12"
+    :param until: latest timestamp or its prefix
+    :return: generator of (cursor, level, lines)
+    :raise ValueError: if the cursor or the level is invalid
+    """
+    before_inode, before_offset = None, None
+    if before:
+        before_inode, before_offset = (int(part) for part in before.split(":", 1))
+    min_level = logging.getLevelName(level.upper()) if level else 0
+    if not isinstance(min_level, int):
+        raise ValueError(f"Unknown log level: {level}")
+    text = text.lower().encode() if text else None
+    return _iter_log_entries(before_inode, before_offset, min_level, text, since, until)
+
+
+def _iter_log_entries(before_inode: int, before_offset: int, min_level: int, text: bytes, since: str, until: str):
+    with ExitStack() as stack:
+        files = []  # all opened at once, a rotation meanwhile doesn't move them
+        for path in log_files():
+            try:
+                files.append(stack.enter_context(open(path, "rb")))
+            except FileNotFoundError:
+                continue
+        inodes = [os.fstat(file.fileno()).st_ino for file in files]
+        if before_inode in inodes:
+            first_file = inodes.index(before_inode)
+        else:
+            first_file, before_offset = 0, None  # no cursor, or its file was rotated away: start over
+
+        for index, file in enumerate(files[first_file:], first_file):
+            end = os.fstat(file.fileno()).st_size
+            if index == first_file and before_offset is not None:
+                end = min(end, before_offset)
+            if until:
+                end = min(end, _entries_end(file, end, until))
+
+            for offset, lines in _read_entries_backwards(file, end):
+                first_line = lines[0]
+                timestamp = first_line[:19].decode(errors="replace")
+                if since and TIMESTAMP_PATTERN.match(first_line) and timestamp[:len(since)] < since:
+                    return  # everything further is older
+
+                parts = first_line.split(maxsplit=3)
+                entry_level = parts[2].strip(b":").decode(errors="replace") if len(parts) >= 3 else ""
+                level_number = logging.getLevelName(entry_level)
+                if min_level and (not isinstance(level_number, int) or level_number < min_level):
+                    continue
+                if text and not any(text in line.lower() for line in lines):
+                    continue
+
+                lines = [line.decode("utf-8", errors="replace") for line in lines]
+                yield f"{inodes[index]}:{offset}", entry_level, lines
+
+
+LOG_VIEWER_HEADER = '''<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>Log Viewer</title>
+    <style>
+        body {{ margin: 0; padding: 10px; background-color: #000; color: #fff; font-family: monospace; }}
+        pre {{ white-space: pre-wrap; word-wrap: break-word; }}
+        a {{ color: #8cf; }}
+    </style>
+</head>
+<body>
+<form method="get">
+    <select name="level">{level_options}</select>
+    <input name="q" placeholder="text" value="{q}">
+    <input name="since" placeholder="since YYYY-MM-DD HH:MM:SS" value="{since}">
+    <input name="until" placeholder="until YYYY-MM-DD HH:MM:SS" value="{until}">
+    <button type="submit">Filter</button>
+</form>
+<pre>'''
+
+LOG_VIEWER_FOOTER = '''</pre>
+{older}
+</body>
+</html>'''
+
+
+def process_logs(args: dict = None):
+    """
+    Streams a page of log entries as HTML, the newest first.
+
+    :param args: query parameters: level, q (text), since, until, before (cursor of the "Older" link), limit
+    """
+    from flask import Response
+    from urllib.parse import urlencode
+
+    args = dict(args or {})
     try:
-        with open(log_file_path, 'r', encoding='utf-8', errors='replace') as log_file:
-            log_content = log_file.readlines()  # Read the log file line by line
-
-        colored_logs = []
-        entry_lines = []
-        timestamp_pattern = r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}'
-
-        for line in log_content:
-            line = clean_line(line).rstrip()  # Clean line and remove trailing whitespace
-
-            # Detect the start of a new log entry by timestamp format
-            if re.match(timestamp_pattern, line) and entry_lines:
-                # Process the accumulated entry
-                entry_text = "\n".join(entry_lines)
-
-                # Determine the color based on log level in the first line of the entry
-                current_color = "white"
-                parts = entry_lines[0].split(maxsplit=3)
-                if len(parts) >= 3:
-                    level = parts[2].strip(":")
-                    current_color = level_colors.get(level, "white")
-
-                # Append the entry with the determined color
-                colored_logs.append(
-                    f'<span style="color: {current_color};">{entry_text}</span><br>'
-                )
-
-                # Reset for the next entry
-                entry_lines = []
-
-            # Accumulate lines for the current entry
-            entry_lines.append(line)
-
-        # Process the last entry if there are remaining lines
-        if entry_lines:
-            entry_text = "\n".join(entry_lines)
-            current_color = "white"
-            parts = entry_lines[0].split(maxsplit=3)
-            if len(parts) >= 3:
-                level = parts[2].strip(":")
-                current_color = level_colors.get(level, "white")
-
-            colored_logs.append(
-                f'<span style="color: {current_color};">{entry_text}</span><br>'
-            )
-
-        # Join the logs for rendering and wrap in the HTML template
-        return render_template_string('''
-            <!DOCTYPE html>
-            <html lang="en">
-            <head>
-                <meta charset="UTF-8">
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <title>Log Viewer</title>
-                <style>
-                    body {
-                        display: flex;
-                        flex-direction: column;
-                        height: 100vh;
-                        margin: 0;
-                        background-color: #000;  /* Set the background to black */
-                        color: #fff;              /* Set the text color to white */
-                    }
-                    .log-content {
-                        flex: 1;
-                        overflow-y: auto;
-                        padding: 10px;
-                        border: 1px solid #ccc;
-                        background-color: #000;  /* Keep log content background black */
-                    }
-                    pre {
-                        white-space: pre-wrap;   /* Ensure long lines wrap */
-                        word-wrap: break-word;   /* Break words to fit the container */
-                    }
-                </style>
-            </head>
-            <body>
-                <div class="log-content">
-                    <pre>{{ colored_logs|safe }}</pre>  <!-- Render the colored logs safely -->
-                </div>
-                <script>
-                    // Scroll to the bottom of the log content
-                    document.querySelector('.log-content').scrollTop = document.querySelector('.log-content').scrollHeight;
-                </script>
-            </body>
-            </html>
-        ''', colored_logs=''.join(colored_logs))  # Join the colored logs for rendering
-
-    except Exception as e:
-        return Response(f"Error reading log file: {str(e)}", status=500)
+        limit = min(max(int(args.get("limit", LOG_PAGE_SIZE)), 1), 1000)
+        entries = read_log_entries(before=args.get("before"), level=args.get("level"), text=args.get("q"),
+                                   since=args.get("since"), until=args.get("until"))
+    except ValueError as e:
+        return Response(f"Bad Request: {e}", status=400)
+
+    def generate():
+        selected = args.get("level", "").upper()
+        level_options = "".join(
+            f'<option value="{name}"{" selected" if selected == name else ""}>{name or "ALL"}</option>'
+            for name in ("", *LEVEL_COLORS)
+        )
+        yield LOG_VIEWER_HEADER.format(level_options=level_options, q=html.escape(args.get("q", "")),
+                                       since=html.escape(args.get("since", "")),
+                                       until=html.escape(args.get("until", "")))
+
+        chunk, count, cursor = [], 0, None
+        try:
+            for cursor, level, lines in entries:
+                entry_text = html.escape("\n".join(clean_line(line).rstrip() for line in lines))
+                chunk.append(f'<span style="color: {LEVEL_COLORS.get(level, "white")};">{entry_text}</span><br>')
+                count += 1
+                if len(chunk) >= 50:
+                    yield "".join(chunk)
+                    chunk = []
+                if count >= limit:
+                    break
+            else:
+                cursor = None  # nothing older
+        except Exception as e:
+            chunk.append(html.escape(f"Error reading log file: {e}"))
+            cursor = None
+        yield "".join(chunk)
+
+        older = ""
+        if cursor is not None:
+            query = {key: value for key, value in args.items() if value and key != "before"}
+            query["before"] = cursor
+            older = f'<a href="?{html.escape(urlencode(query))}">Older</a>'
+        yield LOG_VIEWER_FOOTER.format(older=older)
+
+    return Response(generate(), mimetype="text/html")
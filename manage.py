@@ -0,0 +1,144 @@
+import argparse
+import json
+import sys
+
+import database as db
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def migrate(args):
+    for table in (db.Users, db.Media, db.States):
+        logger.info(f"Migrating table {table.table_name}...")
+        table.migrate()
+    db.Media.migrate_fts(batch_size=args.batch_size, pause=args.pause)
+    db.Media.migrate_inline_results(batch_size=args.batch_size, pause=args.pause)
+    db.Media.migrate_trigram(batch_size=args.batch_size, pause=args.pause)
+
+
+def export_vault(args):
+    if args.output == "-":
+        db.Media.export_user(args.user_id, sys.stdout)
+    else:
+        with open(args.output, "w", encoding="utf-8") as file:
+            db.Media.export_user(args.user_id, file)
+
+
+def import_vault(args):
+    with open(args.input, "r", encoding="utf-8") as file:
+        rows = (json.loads(line) for line in file if line.strip())
+        report = db.Media.import_rows(rows, user_id=args.user, chunk_size=args.chunk_size)
+    print(f"Read {report['read']}, inserted {report['inserted']}, skipped {report['skipped']} duplicates "
+          f"at {report['rows_per_second']:.0f} rows/s")
+
+
+def check_translations(args):
+    from translations import catalog
+
+    failed = False
+    for language, keys in catalog.missing_keys().items():
+        failed = True
+        for key in keys:
+            print(f"{language}: missing: {key}")
+    for language, issues in catalog.placeholder_problems().items():
+        failed = True
+        for issue in issues:
+            print(f"{language}: {issue}")
+    if failed:
+        sys.exit(1)
+    print(f"All {len(set(catalog.languages.values()))} languages are complete, their placeholders match")
+
+
+def reshard(args):
+    report = db.reshard(args.shards)
+    for index, (media, states) in enumerate(zip(report["media"], report["states"])):
+        print(f"shard {index}: {media} media, {states} states")
+    print(f"Start the bot with SHARD_COUNT={args.shards}")
+
+
+def set_webhook(args):
+    from flask_app import load_config, set_webhook as register_webhook
+
+    config = load_config()
+    if args.max_connections is not None:
+        config["WEBHOOK_MAX_CONNECTIONS"] = args.max_connections
+    register_webhook(config)
+    print(f"Webhook set to {config['SITE_URL']}<SECRET>")
+
+
+def broadcast(args):
+    from flask_app import create_bot
+
+    bot = create_bot()
+    if args.resume:
+        report = bot.resume_broadcast(args.resume)
+    else:
+        report = bot.broadcast(args.text, exceptions=args.exceptions)
+    print(report)
+
+
+def broadcast_status(args):
+    from bot import BroadcastEngine
+
+    print(BroadcastEngine.report(args.broadcast_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inline Vault Bot maintenance commands")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    migrate_parser = subparsers.add_parser("migrate", help="bring an existing database up to date with the current schema")
+    migrate_parser.add_argument("--batch-size", type=int, default=db.FTS_MIGRATION_BATCH_SIZE,
+                                help="rows copied per transaction when rebuilding tables")
+    migrate_parser.add_argument("--pause", type=float, default=db.FTS_MIGRATION_PAUSE,
+                                help="seconds to sleep between batches")
+    migrate_parser.set_defaults(handler=migrate)
+
+    export_parser = subparsers.add_parser("export", help="write a user's vault as JSON lines")
+    export_parser.add_argument("user_id", type=int)
+    export_parser.add_argument("-o", "--output", default="-", help="output file, stdout by default")
+    export_parser.set_defaults(handler=export_vault)
+
+    import_parser = subparsers.add_parser("import", help="load a vault exported with the export command")
+    import_parser.add_argument("input", help="JSON lines file")
+    import_parser.add_argument("--user", type=int, help="import into the vault of this user instead")
+    import_parser.add_argument("--chunk-size", type=int, default=db.IMPORT_CHUNK_SIZE,
+                               help="records inserted per transaction")
+    import_parser.set_defaults(handler=import_vault)
+
+    webhook_parser = subparsers.add_parser("set-webhook", help="register {SITE_URL}{SECRET} as the webhook, "
+                                                               "once after deploying or changing them")
+    webhook_parser.add_argument("--max-connections", type=int,
+                                help="concurrent webhook requests Telegram may make, "
+                                     "WEBHOOK_MAX_CONNECTIONS by default")
+    webhook_parser.set_defaults(handler=set_webhook)
+
+    broadcast_parser = subparsers.add_parser("broadcast", help="send a message to all users")
+    broadcast_group = broadcast_parser.add_mutually_exclusive_group(required=True)
+    broadcast_group.add_argument("text", nargs="?", help="message text")
+    broadcast_group.add_argument("--resume", type=int, metavar="BROADCAST_ID", help="resume an interrupted broadcast")
+    broadcast_parser.add_argument("--exceptions", type=int, nargs="*", default=[], help="user ids to skip")
+    broadcast_parser.set_defaults(handler=broadcast)
+
+    status_parser = subparsers.add_parser("broadcast-status", help="show progress of a broadcast")
+    status_parser.add_argument("broadcast_id", type=int)
+    status_parser.set_defaults(handler=broadcast_status)
+
+    reshard_parser = subparsers.add_parser("reshard", help="spread per-user tables over a different number of "
+                                                           "database files, while the bot is stopped")
+    reshard_parser.add_argument("shards", type=int, help="number of shard files, SHARD_COUNT of the current layout "
+                                                         "is read from the environment")
+    reshard_parser.set_defaults(handler=reshard)
+
+    translations_parser = subparsers.add_parser("check-translations",
+                                                help="check that every language has every text of the default one, "
+                                                     "with the same placeholders")
+    translations_parser.set_defaults(handler=check_translations)
+
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+In-process metrics: counters and latency histograms with labels, rendered in the Prometheus text format.
+
+Recording a value is a dict lookup and a few additions under a lock, cheap enough to stay on in production.
+Stats already kept by other components (caches, pools, queues) are exported through collectors, callables
+returning a dict of numbers that are read only when the metrics are rendered.
+"""
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+import os
+import threading
+import time
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+PREFIX = "inline_vault_"
+# seconds, from a cached inline answer to a slow Telegram round-trip
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}  # label values -> count
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                  for labels, value in values]
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [count per bucket (last is +Inf), sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        if not METRICS_ENABLED:
+            return
+        index = bisect_left(self.buckets, value)  # buckets are upper bounds, inclusive
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observes the time spent in the with block, also when it raises."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels) -> int:
+        with self._lock:
+            series = self._values.get(labels)
+            return sum(series[0]) if series else 0
+
+    def snapshot(self) -> dict:
+        """Returns {label values: (count, sum)} of all series."""
+        with self._lock:
+            return {labels: (sum(counts), total) for labels, (counts, total) in self._values.items()}
+
+    def render(self) -> list[str]:
+        with self._lock:
+            values = sorted((labels, (list(counts), total)) for labels, (counts, total) in self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+_metrics = []
+_collectors = {}  # name -> callable returning a dict of numbers
+
+
+def counter(name: str, documentation: str, labelnames: tuple = ()) -> Counter:
+    metric = Counter(name, documentation, labelnames)
+    _metrics.append(metric)
+    return metric
+
+
+def histogram(name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    metric = Histogram(name, documentation, labelnames, buckets)
+    _metrics.append(metric)
+    return metric
+
+
+def register_collector(name: str, collect) -> None:
+    """
+    Exports stats of a component as gauges named <name>_<key>. Lists of numbers are exported with an index label,
+    values that aren't numbers are skipped.
+
+    :param name: prefix of the gauges, e.g. "inline_cache"
+    :param collect: callable returning a dict, called on every render
+    """
+    _collectors[name] = collect
+
+
+def timed(metric: Histogram, *labels):
+    """Decorator observing the duration of every call, labels default to the function name."""
+    def decorator(function):
+        label_values = labels or (function.__name__,)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                metric.observe(time.perf_counter() - started, *label_values)
+        return wrapper
+    return decorator
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_template(query: str) -> str:
+    """Returns the query with whitespace collapsed, parameters are placeholders so it identifies the statement."""
+    return " ".join(query.split())
+
+
+def _render_collector(name: str, collect) -> list[str]:
+    try:
+        stats = collect()
+    except Exception as e:
+        return [f"# collector {name} failed: {_escape(e)}"]
+
+    lines = []
+    for key, value in stats.items():
+        metric_name = f"{PREFIX}{name}_{key}"
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, (int, float)):
+            lines += [f"# TYPE {metric_name} gauge", f"{metric_name} {_format_value(value)}"]
+        elif isinstance(value, (list, tuple)) and all(isinstance(v, (int, float)) for v in value):
+            lines.append(f"# TYPE {metric_name} gauge")
+            lines += [f'{metric_name}{{index="{i}"}} {_format_value(v)}' for i, v in enumerate(value)]
+    return lines
+
+
+def render() -> str:
+    """Returns all metrics and collected stats in the Prometheus text exposition format."""
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    for name, collect in list(_collectors.items()):
+        lines += _render_collector(name, collect)
+    return "\n".join(lines) + "\n"
+
+
+UPDATE_DURATION = histogram("update_duration_seconds", "Time to process a Telegram update", ("type",))
+UPDATE_FAILURES = counter("update_failures_total", "Updates that raised an exception", ("type",))
+HANDLER_DURATION = histogram("handler_duration_seconds", "Time spent in a bot handler, including nested handlers",
+                             ("handler",))
+QUERY_DURATION = histogram("db_query_duration_seconds", "Time to execute a database statement", ("statement",))
+QUERY_ERRORS = counter("db_query_errors_total", "Database statements that failed", ("error",))
+LOCK_RETRIES = counter("db_lock_retries_total", "Statements retried because the database was locked")
+TELEGRAM_DURATION = histogram("telegram_request_duration_seconds", "Time of a Telegram Bot API request",
+                              ("method",))
+TELEGRAM_ERRORS = counter("telegram_request_errors_total", "Telegram Bot API requests that failed", ("method",))
+TELEGRAM_RETRIES = counter("telegram_request_retries_total", "Telegram Bot API requests retried after 429",
+                           ("method",))
@@ -0,0 +1,173 @@
+from collections import OrderedDict
+import atexit
+import os
+import threading
+import time
+
+import database as db
+from logger import setup_logger
+
+logger = setup_logger(__name__)
+
+STATE_WRITE_MODE = os.getenv("STATE_WRITE_MODE", "through")  # "behind" saves changes in the background
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", 1.0))  # seconds between write-behind flushes
+STATE_CACHE_SIZE = 10000
+# seconds a cached state is read without a query, only safe where a single process serves the bot
+STATE_CACHE_TTL = float(os.getenv("STATE_CACHE_TTL", 0))
+
+
+class StateStore:
+    """
+    Conversation state of users, cached in memory and persisted as one row per user in the states table.
+
+    By default every read loads the state from the database, so all processes see the same state. The cache
+    is per process, so reading cached states for ttl seconds, and the write-behind mode, where a background
+    thread saves changes together every flush interval, are only for deployments where one process serves
+    the bot. Unsaved changes of the process are always read from the cache.
+    """
+    def __init__(self, write_mode: str = STATE_WRITE_MODE, flush_interval: float = STATE_FLUSH_INTERVAL,
+                 maxsize: int = STATE_CACHE_SIZE, ttl: float = STATE_CACHE_TTL):
+        if write_mode not in ("through", "behind"):
+            raise ValueError(f"Unsupported write mode: {write_mode}")
+        self.write_mode = write_mode
+        self.flush_interval = flush_interval
+        self.maxsize = maxsize
+        self.ttl = ttl
+
+        self._cache = OrderedDict()  # user_id -> (expires_at, state), an empty dict means the user has no state
+        self._dirty = set()
+        self._flushing = set()  # saved by the running flush, kept in the cache until it's done
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # held for a whole flush
+        self._flusher = None
+        self._stopped = threading.Event()
+
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.flush_failures = 0
+
+    def get(self, user_id: int) -> dict:
+        """Returns a copy of the user's state, empty if there is none."""
+        with self._lock:
+            entry = self._cache.get(user_id)
+            if entry is not None and (entry[0] >= time.monotonic() or self._unsaved(user_id)):
+                self._cache.move_to_end(user_id)
+                self.hits += 1
+                return dict(entry[1])
+            self.misses += 1
+
+        state = db.States.load(user_id) or {}
+        with self._lock:
+            if self._cache.get(user_id) is entry:  # a concurrent write wins over the loaded state
+                self._store(user_id, state)
+            entry = self._cache.get(user_id)  # None if the user was forgotten meanwhile
+            return dict(entry[1] if entry is not None else state)
+
+    def update(self, user_id: int, values: dict) -> None:
+        """Sets the given keys, other keys of the state are kept."""
+        state = self.get(user_id)
+        state.update(values)
+        self._write(user_id, state)
+
+    def replace(self, user_id: int, values: dict) -> None:
+        """Replaces the whole state of the user."""
+        self._write(user_id, dict(values))
+
+    def clear(self, user_id: int) -> None:
+        self._write(user_id, {})
+
+    def forget(self, user_id: int) -> None:
+        """
+        Drops the user from the cache without saving, e.g. before their rows are deleted.
+        Waits for a running flush, which may be saving the user's state.
+        """
+        with self._flush_lock, self._lock:
+            self._cache.pop(user_id, None)
+            self._dirty.discard(user_id)
+
+    def flush(self) -> None:
+        """Saves all pending write-behind changes, they stay pending for the next flush if saving fails."""
+        with self._flush_lock:
+            with self._lock:
+                pending = {user_id: dict(self._cache[user_id][1]) for user_id in self._dirty}
+                self._dirty.clear()
+                self._flushing = set(pending)
+            if not pending:
+                return
+
+            saved = False
+            try:
+                saved = db.States.save(pending)
+            finally:
+                with self._lock:
+                    self._flushing = set()
+                    if not saved:
+                        self._dirty.update(pending)
+                        self.flush_failures += 1
+            if not saved:
+                logger.error(f"Couldn't save conversation state of {len(pending)} users, retrying with the next flush")
+                return
+            self.writes += 1
+            logger.debug(f"Flushed conversation state of {len(pending)} users")
+
+    def stop(self) -> None:
+        self._stopped.set()
+        self.flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "dirty": len(self._dirty),
+                "flush_failures": self.flush_failures,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+            }
+
+    def _write(self, user_id: int, state: dict) -> None:
+        with self._lock:
+            self._store(user_id, state)
+            if self.write_mode == "behind":
+                self._dirty.add(user_id)
+                self._start_flusher()
+                return
+
+        if not db.States.save({user_id: state}):
+            with self._lock:  # the next read loads what the database has
+                self._cache.pop(user_id, None)
+            return
+        self.writes += 1
+
+    def _store(self, user_id: int, state: dict) -> None:
+        """Puts state to the cache, evicting the least recently used saved states. Must be called with the lock held."""
+        self._cache[user_id] = (time.monotonic() + self.ttl, state)
+        self._cache.move_to_end(user_id)
+        for key in list(self._cache):
+            if len(self._cache) <= self.maxsize:
+                break
+            if not self._unsaved(key):
+                del self._cache[key]
+
+    def _unsaved(self, user_id: int) -> bool:
+        """Whether the cached state isn't in the database yet. Must be called with the lock held."""
+        return user_id in self._dirty or user_id in self._flushing
+
+    def _start_flusher(self) -> None:
+        """Starts the write-behind thread. Must be called with the lock held."""
+        if self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_periodically, name="state-flusher", daemon=True)
+        self._flusher.start()
+        atexit.register(self.stop)
+
+    def _flush_periodically(self) -> None:
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Couldn't flush conversation state: {e}", exc_info=True)
+
+
+state_store = StateStore()
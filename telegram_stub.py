@@ -0,0 +1,125 @@
+"""
+Local stand-in for the Telegram Bot API, for offline throughput tests and benchmarks.
+
+Point the bot to it with TELEGRAM_CLIENT=async and TELEGRAM_API_URL=http://127.0.0.1:<port>, or run it
+from code with TelegramStub().start().
+"""
+import argparse
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl
+
+
+class _StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep connections alive between requests
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = dict(parse_qsl(body.decode("utf-8")))
+
+        method = self.path.rsplit("/", 1)[-1]
+        status, response = stub.respond(method, params)
+
+        payload = json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # keep benchmark output clean
+
+
+class TelegramStub:
+    """
+    Answers Bot API requests with canned successful results and records them.
+
+    :param latency: seconds to sleep before answering, simulates the network round-trip
+    :param rate_limit_every: answer every n-th request with 429 Too Many Requests (0 disables)
+    :param retry_after: retry_after sent with 429 responses
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, rate_limit_every: int = 0,
+                 retry_after: int = 1):
+        self.latency = latency
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.calls = []  # (method, params)
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self._request_count = 0
+
+        self.server = ThreadingHTTPServer((host, port), _StubRequestHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> str:
+        self._thread = threading.Thread(target=self.server.serve_forever, name="telegram-stub", daemon=True)
+        self._thread.start()
+        return self.url
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, method: str, params: dict) -> tuple[int, dict]:
+        with self._lock:
+            self._request_count += 1
+            rate_limited = self.rate_limit_every and self._request_count % self.rate_limit_every == 0
+            if not rate_limited:
+                self.calls.append((method, params))
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if rate_limited:
+            return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after "
+                         f"{self.retry_after}", "parameters": {"retry_after": self.retry_after}}
+
+        if method == "sendMessage":
+            result = {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+                "text": params.get("text", ""),
+            }
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def count(self, method: str = None) -> int:
+        with self._lock:
+            return sum(1 for called, _ in self.calls if method is None or called == method)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the Telegram Bot API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="answer every n-th request with 429")
+    args = parser.parse_args()
+
+    stub = TelegramStub(args.host, args.port, latency=args.latency, rate_limit_every=args.rate_limit_every)
+    print(f"Telegram stub listening on {stub.url}")
+    stub.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import tempfile
+
+# set before the test modules import database, which reads the database path on import
+home = tempfile.mkdtemp(prefix="inline-vault-test-")
+os.makedirs(os.path.join(home, "mysite"))
+os.environ["HOME"] = home
+os.environ["DATABASE_PATH"] = os.path.join(home, "test.db")
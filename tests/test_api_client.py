@@ -0,0 +1,47 @@
+import pytest
+from telepot import exception
+
+from bot._api import AsyncTelegramClient
+from telegram_stub import TelegramStub
+
+
+@pytest.fixture
+def stub():
+    stub = TelegramStub(rate_limit_every=3, retry_after=0)
+    stub.start()
+    yield stub
+    stub.stop()
+
+
+@pytest.fixture
+def client(stub):
+    client = AsyncTelegramClient("123:test", api_url=stub.url, max_connections=4, timeout=5)
+    yield client
+    client.close()
+
+
+def test_requests_are_sent_and_rate_limited_ones_retried(stub, client):
+    for number in range(4):
+        message = client.call("sendMessage", chat_id=42, text=f"message {number}")
+        assert message["chat"]["id"] == 42
+        assert message["text"] == f"message {number}"
+
+    assert stub.count("sendMessage") == 4  # the 3rd request got 429 and was sent again
+    stats = client.stats()["sendMessage"]
+    assert stats["count"] == 5
+    assert stats["retries"] == stats["errors"] == 1
+
+
+def test_requests_with_the_same_order_key_arrive_in_order(stub, client):
+    stub.latency = 0.01
+    futures = [client.request("sendMessage", order_key=7, chat_id=7, text=str(number)) for number in range(10)]
+    assert [future.result(5)["text"] for future in futures] == [str(number) for number in range(10)]
+    assert [params["text"] for _, params in stub.calls] == [str(number) for number in range(10)]
+
+
+def test_unsuccessful_response_raises_the_telepot_error(stub, client, monkeypatch):
+    monkeypatch.setattr(stub, "respond", lambda method, params: (400, {
+        "ok": False, "error_code": 400, "description": "Bad Request: chat not found"}))
+    with pytest.raises(exception.TelegramError) as error:
+        client.call("sendMessage", chat_id=1, text="lost")
+    assert error.value.error_code == 400
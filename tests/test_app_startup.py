@@ -0,0 +1,40 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a fresh process, the test process has opened the database already
+STARTUP = """
+import json
+import os
+import threading
+
+threads = threading.active_count()
+import flask_app
+
+lazy = "app" not in vars(flask_app)
+app = flask_app.app
+print(json.dumps({
+    "lazy": lazy,
+    "cached": flask_app.app is app,
+    "threads": threading.active_count() - threads,
+    "files": sorted(os.listdir(os.path.expanduser("~/mysite"))),
+    "routes": sorted(rule.rule for rule in app.url_map.iter_rules()),
+}))
+"""
+
+
+def test_app_is_built_on_first_use_without_opening_anything(tmp_path):
+    (tmp_path / "mysite").mkdir()
+    env = dict(os.environ, HOME=str(tmp_path), DATABASE_PATH="data.db", TELEGRAM_TOKEN="123:test", SECRET="secret",
+               SITE_URL="https://test.invalid/", PROXY_URL="", WEBHOOK_MODE="async")
+    result = subprocess.run([sys.executable, "-c", STARTUP], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+    startup = json.loads(result.stdout.strip().splitlines()[-1])
+    assert startup["lazy"] and startup["cached"]
+    assert startup["threads"] == 0  # dispatcher workers, writers and the API client start with the first update
+    assert [name for name in startup["files"] if name.startswith("data.db")] == []  # opened by the first query
+    assert {"/secret", "/secret/metrics"} <= set(startup["routes"])
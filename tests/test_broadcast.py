@@ -0,0 +1,49 @@
+import pytest
+from telepot import exception
+
+import database as db
+from bot._broadcast import BroadcastEngine
+
+USER_IDS = range(6, 11)
+
+
+class Crash(BaseException):
+    """Stops the broadcast the way a killed process would, without a checkpoint of the current batch."""
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Broadcasts.migrate()
+    db.BroadcastFailures.migrate()
+    for user_id in USER_IDS:
+        db.Users.add({"user_id": user_id, "username": f"test{user_id}"})
+
+
+def test_interrupted_broadcast_resumes_after_its_checkpoint():
+    users = db.Users.get_ids_after(0, 1000)
+    blocked, excluded, crash_at = users[1], users[-1], users[2]
+    delivered = []
+
+    def send(user_id, text, reply_markup):
+        if user_id == crash_at and crash_at not in delivered:
+            delivered.append(user_id)
+            raise Crash()
+        if user_id == blocked:
+            raise exception.TelegramError("Forbidden: bot was blocked by the user", 403, {})
+        delivered.append(user_id)
+
+    engine = BroadcastEngine(send, rate=1000, senders=1, batch_size=2)
+    broadcast_id = engine.create("News", exceptions=[excluded])
+    with pytest.raises(Crash):
+        engine.run(broadcast_id)
+    report = engine.report(broadcast_id)
+    assert (report["status"], report["last_user_id"], report["sent"], report["failed"]) == ("running", users[1], 1, 1)
+
+    report = engine.run(broadcast_id)  # the batch in flight is sent again, earlier ones aren't
+    assert delivered == [users[0], *users[2:4]] + [user for user in users[2:] if user != excluded]
+    assert report["status"] == "done"
+    assert (report["last_user_id"], report["sent"], report["failed"]) == (users[-1], len(users) - 2, 1)
+    assert db.BroadcastFailures.get({"broadcast_id": broadcast_id}, include_column_names=True)["user_id"] == blocked
+
+    assert engine.run(broadcast_id) == report  # a finished broadcast isn't sent again
+    assert delivered.count(users[0]) == 1
@@ -0,0 +1,93 @@
+import os
+import threading
+
+import pytest
+
+import database as db
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = db.Connection(str(tmp_path / "pool.db"), timeout=5, pool_size=2)
+    yield pool
+    pool.close()
+
+
+def test_connections_are_opened_in_wal_mode_with_the_pragmas(pool):
+    with pool.lease() as connection:
+        assert connection.execute("PRAGMA journal_mode;").fetchone()[0] == "wal"
+        assert connection.execute("PRAGMA foreign_keys;").fetchone()[0] == 1
+        assert connection.execute("PRAGMA busy_timeout;").fetchone()[0] == 5000
+
+
+def test_nested_leases_of_a_thread_reuse_its_connection(pool):
+    with pool.lease() as outer, pool.lease() as inner:
+        assert inner is outer
+        assert pool.stats()["in_use"] == 1
+    assert pool.stats()["in_use"] == 0
+    assert pool.stats()["idle"] == 1
+
+
+def test_pool_size_limits_connections_and_waits_for_a_free_one(pool):
+    leased, release = threading.Barrier(3), threading.Event()
+
+    def hold():
+        with pool.lease():
+            leased.wait()
+            release.wait()
+
+    holders = [threading.Thread(target=hold) for _ in range(2)]
+    for thread in holders:
+        thread.start()
+    leased.wait()
+    assert pool.stats()["opened"] == 2
+
+    threading.Timer(0.1, release.set).start()
+    with pool.lease():  # waits until a holder returns its connection
+        assert pool.stats()["opened"] == 2
+    for thread in holders:
+        thread.join()
+    assert pool.stats()["waits"] == 1
+
+
+def test_exhausted_pool_fails_the_query_instead_of_raising(monkeypatch):
+    monkeypatch.setattr(db, "SQLITE_POOL_TIMEOUT", 0.1)
+    monkeypatch.setattr(db, "WRITE_MODE", "direct")
+    db.Users.migrate()
+    pool = db.Users.pool()
+    monkeypatch.setattr(pool, "pool_size", 1)
+    leased, release = threading.Event(), threading.Event()
+
+    def hold():
+        with pool.lease():
+            leased.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    leased.wait()
+    try:
+        assert isinstance(db.Users.execute_query("SELECT 1;"), db.CursorError)
+    finally:
+        release.set()
+        holder.join()
+    assert db.Users.execute_query("SELECT 1;") == [(1,)]
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_forked_process_opens_its_own_connections(pool):
+    with pool.lease() as connection:
+        connection.execute("CREATE TABLE items (name TEXT);")
+
+    pid = os.fork()
+    if pid == 0:  # the child must not use connections of the parent
+        try:
+            with pool.lease() as connection:
+                connection.execute("INSERT INTO items VALUES ('child');")
+            os._exit(0 if pool.stats()["opened"] == 1 else 1)
+        except BaseException:
+            os._exit(2)
+    _, status = os.waitpid(pid, 0)
+    assert os.waitstatus_to_exitcode(status) == 0
+    with pool.lease() as connection:
+        assert connection.execute("SELECT name FROM items;").fetchall() == [("child",)]
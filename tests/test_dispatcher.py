@@ -0,0 +1,51 @@
+import threading
+
+from bot import UpdateDispatcher
+
+
+def test_updates_of_a_user_are_processed_in_submission_order():
+    processed = {}
+
+    def handler(update):
+        processed.setdefault(update["user"], []).append(update["update_id"])
+
+    dispatcher = UpdateDispatcher(handler, key=lambda update: update["user"], workers=4)
+    for update_id in range(400):
+        assert dispatcher.submit({"update_id": update_id, "user": update_id % 7})
+    dispatcher.stop()
+
+    assert sorted(processed) == list(range(7))
+    for user, update_ids in processed.items():
+        assert update_ids == list(range(user, 400, 7))
+
+
+def test_counters_add_up_under_concurrent_workers():
+    def handler(update):
+        if update["update_id"] % 3 == 0:
+            raise ValueError("failed update")
+
+    dispatcher = UpdateDispatcher(handler, key=lambda update: update["update_id"], workers=8, queue_size=10000)
+    submitters = [threading.Thread(target=lambda first=first: [dispatcher.submit({"update_id": update_id})
+                                                              for update_id in range(first, 3000, 4)])
+                  for first in range(4)]
+    for thread in submitters:
+        thread.start()
+    for thread in submitters:
+        thread.join()
+    dispatcher.stop()
+
+    stats = dispatcher.stats()
+    assert stats["failed"] == 1000
+    assert stats["processed"] == 2000
+    assert stats["rejected"] == 0
+
+
+def test_full_queue_rejects_updates():
+    release = threading.Event()
+    dispatcher = UpdateDispatcher(lambda update: release.wait(), key=lambda update: 1, workers=1, queue_size=2)
+    results = [dispatcher.submit({"update_id": update_id}) for update_id in range(10)]
+    release.set()
+    dispatcher.stop()
+
+    assert not all(results)
+    assert dispatcher.stats()["rejected"] == results.count(False)
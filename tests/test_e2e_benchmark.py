@@ -0,0 +1,26 @@
+import argparse
+import os
+
+import pytest
+
+from benchmarks import e2e
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_summary_uses_nearest_rank_percentiles():
+    summary = e2e.summarize([i / 1000 for i in range(100, 0, -1)], elapsed=2.0)
+    assert (summary["count"], summary["p50_ms"], summary["p95_ms"], summary["p99_ms"]) == (100, 50, 95, 99)
+    assert summary["max_ms"] == 100
+    assert summary["mean_ms"] == pytest.approx(50.5)
+    assert summary["per_second"] == 50
+    assert e2e.summarize([])["per_second"] == 0.0
+
+
+def test_small_run_reports_every_kind_of_update(monkeypatch):
+    monkeypatch.chdir(ROOT)  # the worker is started as python -m benchmarks.e2e
+    report = e2e.run_size(50, argparse.Namespace(operations=200, seed=1, latency=0.0, search_samples=5))
+    assert report["vault_size"] == 50
+    assert report["all_updates"]["count"] == 200
+    assert {"inline_query", "save_media", "db.search_page"} <= set(report["latency"])
+    assert report["slowest_statements"]
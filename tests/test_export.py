@@ -0,0 +1,41 @@
+import io
+import json
+
+import database as db
+
+USER_ID, IMPORTED_USER_ID = 13, 14
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test13"})
+    for i in range(5):
+        db.Media.add({"user_id": USER_ID, "media_type": "photo" if i % 2 else "video", "file_id": f"export{i}",
+                      "caption": f"caption {i}" if i % 2 else None, "description": f"exported item {i}"})
+
+
+def export(user_id: int) -> list[dict]:
+    file = io.StringIO()
+    exported = db.Media.export_user(user_id, file)
+    rows = [json.loads(line) for line in file.getvalue().splitlines()]
+    assert len(rows) == exported
+    return rows
+
+
+def test_exported_vault_is_imported_into_another_user_once():
+    rows = export(USER_ID)
+    assert [row["file_id"] for row in rows] == [f"export{i}" for i in range(5)]
+    assert rows[1] == {"user_id": USER_ID, "media_type": "photo", "file_id": "export1", "caption": "caption 1",
+                       "description": "exported item 1"}
+
+    report = db.Media.import_rows(iter(rows), user_id=IMPORTED_USER_ID, chunk_size=2)
+    assert (report["read"], report["inserted"], report["skipped"]) == (5, 5, 0)
+    assert db.Users.get({"user_id": IMPORTED_USER_ID})  # created by the import
+    assert export(IMPORTED_USER_ID) == [dict(row, user_id=IMPORTED_USER_ID) for row in rows]
+
+    records, _ = db.Media.search_page(IMPORTED_USER_ID, "item 3", limit=1)
+    assert records[0][2] == "export3"
+
+    report = db.Media.import_rows(rows[3:] + [dict(rows[0], file_id="export5")], user_id=IMPORTED_USER_ID)
+    assert (report["read"], report["inserted"], report["skipped"]) == (3, 1, 2)
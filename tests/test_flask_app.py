@@ -0,0 +1,27 @@
+import bot
+import flask_app
+
+CONFIG = {
+    "TELEGRAM_TOKEN": "123:test",
+    "SECRET": "secret",
+    "SITE_URL": "https://test.invalid/",
+    "PROXY_URL": None,
+    "WEBHOOK_MODE": "sync",
+    "WEBHOOK_WORKERS": 1,
+    "WEBHOOK_MAX_CONNECTIONS": 1,
+}
+
+
+def test_malformed_update_is_answered_with_a_json_error():
+    client = flask_app.create_app(dict(CONFIG)).test_client()
+    response = client.post("/secret", data="not json", content_type="application/json")
+    assert response.status_code == 400
+    assert response.get_json() == {"ok": False, "error": "Bad Request"}
+
+
+def test_rejected_update_is_answered_with_a_json_error(monkeypatch):
+    monkeypatch.setattr(bot.UpdateDispatcher, "submit", lambda self, update: False)  # every queue is full
+    client = flask_app.create_app(dict(CONFIG, WEBHOOK_MODE="async")).test_client()
+    response = client.post("/secret", json={"update_id": 1})
+    assert response.status_code == 503
+    assert response.get_json() == {"ok": False, "error": "Service Unavailable"}
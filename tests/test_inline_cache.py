@@ -0,0 +1,84 @@
+import sqlite3
+
+import database as db
+from cache import InlineQueryCache
+
+USER_ID = 2
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test2"})
+
+
+def add_media(file_id: str) -> None:
+    added, _ = db.Media.add({"user_id": USER_ID, "media_type": "photo", "file_id": file_id, "caption": None,
+                             "description": f"test {file_id}"})
+    assert added
+
+
+def test_changes_of_another_process_make_entries_stale():
+    cache = InlineQueryCache()  # not invalidated by this process, like the cache of another worker
+    add_media("a")
+    generation = db.MediaGenerations.current(USER_ID)
+    cache.set(USER_ID, "test", "", "answer", generation)
+    assert cache.get(USER_ID, "test", "", db.MediaGenerations.current(USER_ID)) == "answer"
+
+    add_media("b")
+    assert db.MediaGenerations.current(USER_ID) > generation
+    assert cache.get(USER_ID, "test", "", db.MediaGenerations.current(USER_ID)) is None
+    assert cache.stats()["stale"] == 1
+
+
+def test_answers_computed_during_a_change_are_not_served():
+    cache = InlineQueryCache()
+    generation = db.MediaGenerations.current(USER_ID)  # read before the search
+    assert db.Media.set({"user_id": USER_ID, "file_id": "a"}, {"description": "renamed"})
+    cache.set(USER_ID, "test", "", "answer computed before the change", generation)
+    assert cache.get(USER_ID, "test", "", db.MediaGenerations.current(USER_ID)) is None
+
+
+def test_caption_edit_and_delete_of_another_connection_make_entries_stale():
+    cache = InlineQueryCache(generation_ttl=0)
+    add_media("edited")
+    other = sqlite3.connect(db.Database.connection.db_path, isolation_level=None)  # another process
+    try:
+        generation = cache.current_generation(USER_ID, db.MediaGenerations.current)
+        cache.set(USER_ID, "test", "", "answer", generation)
+        other.execute("UPDATE media SET caption = 'new caption' WHERE user_id = ? AND file_id = 'edited';",
+                      (USER_ID,))
+        assert cache.get(USER_ID, "test", "", cache.current_generation(USER_ID, db.MediaGenerations.current)) is None
+
+        generation = cache.current_generation(USER_ID, db.MediaGenerations.current)
+        cache.set(USER_ID, "test", "", "answer", generation)
+        media_id, = other.execute("SELECT media_id FROM media WHERE user_id = ? AND file_id = 'edited';",
+                                  (USER_ID,)).fetchone()
+        other.execute("BEGIN;")  # as Media.delete does
+        other.execute("DELETE FROM media WHERE media_id = ?;", (media_id,))
+        other.execute("DELETE FROM media_fts WHERE rowid = ?;", (media_id,))
+        if db.TRIGRAM_SEARCH:
+            other.execute("DELETE FROM media_trigram WHERE rowid = ?;", (media_id,))
+        other.execute("COMMIT;")
+        assert cache.get(USER_ID, "test", "", cache.current_generation(USER_ID, db.MediaGenerations.current)) is None
+    finally:
+        other.close()
+
+
+def test_generation_is_read_once_for_repeated_queries():
+    cache = InlineQueryCache(generation_ttl=60)
+    reads = []
+
+    def load(user_id):
+        reads.append(user_id)
+        return db.MediaGenerations.current(user_id)
+
+    generation = cache.current_generation(USER_ID, load)
+    cache.set(USER_ID, "test", "", "answer", generation)
+    for _ in range(5):
+        assert cache.get(USER_ID, "test", "", cache.current_generation(USER_ID, load)) == "answer"
+    assert len(reads) == 1
+
+    cache.invalidate(USER_ID)  # a change made by this process is seen right away
+    cache.current_generation(USER_ID, load)
+    assert len(reads) == 2
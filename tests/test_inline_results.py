@@ -0,0 +1,49 @@
+import json
+
+import database as db
+from inline_results import assemble_results, build_fragment
+
+USER_ID = 15
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test15"})
+
+
+def stored_result(media_id: int) -> dict:
+    return json.loads(db.Media.execute_query("SELECT inline_result FROM media WHERE media_id = ?;", (media_id,),
+                                             shard_key=USER_ID)[0][0])
+
+
+def test_inline_result_is_stored_with_the_media_and_rebuilt_on_change():
+    _, media_id = db.Media.add({"user_id": USER_ID, "media_type": "photo", "file_id": "fragment-photo",
+                                "caption": "old caption", "description": "stored result"})
+    assert stored_result(media_id) == {"type": "photo", "photo_file_id": "fragment-photo", "title": "stored result",
+                                       "caption": "old caption"}
+
+    assert db.Media.set({"user_id": USER_ID, "media_id": media_id}, {"caption": "new caption",
+                                                                      "description": "changed result"})
+    assert stored_result(media_id) == {"type": "photo", "photo_file_id": "fragment-photo", "title": "changed result",
+                                       "caption": "new caption"}
+
+
+def test_answer_is_assembled_from_the_stored_results():
+    _, media_id = db.Media.add({"user_id": USER_ID, "media_type": "article", "file_id": "Some text",
+                                "caption": None, "description": "assembled article"})
+    records, _ = db.Media.search_page(USER_ID, "assembled", limit=5)
+    results = json.loads(assemble_results((record[4], record[6]) for record in records))
+    assert results == [{"id": str(media_id), "type": "article", "title": "Text",
+                        "input_message_content": {"message_text": "Some text"}, "description": "assembled article"}]
+    assert build_fragment("unknown", "file") is None
+    assert assemble_results([(1, None)]) == ""
+
+
+def test_migration_fills_missing_inline_results():
+    _, media_id = db.Media.add({"user_id": USER_ID, "media_type": "sticker", "file_id": "fragment-sticker",
+                                "caption": None, "description": "migrated"})
+    db.Media.execute_query("UPDATE media SET inline_result = NULL WHERE media_id = ?;", (media_id,),
+                           shard_key=USER_ID)
+    assert db.Media.migrate_inline_results(pause=0) >= 1
+    assert stored_result(media_id) == {"type": "sticker", "sticker_file_id": "fragment-sticker"}
@@ -0,0 +1,105 @@
+import itertools
+import logging
+import os
+import queue
+import threading
+
+import logger
+from logger import DroppingQueueHandler
+
+
+def queued_logger(name: str) -> tuple[logging.Logger, queue.Queue]:
+    records = queue.Queue()
+    log = logging.getLogger(name)
+    log.propagate = False
+    log.setLevel(logging.DEBUG)
+    log.addHandler(DroppingQueueHandler(records))
+    return log, records
+
+
+def test_queued_record_keeps_the_message_of_when_it_was_logged():
+    log, records = queued_logger("test_queued_message")
+    state = {"status": "delete"}
+    log.info("State is %s", state)
+    state["status"] = "changed before the listener formats the record"
+
+    record = records.get_nowait()
+    assert record.getMessage() == "State is {'status': 'delete'}"
+    assert record.args is None
+
+
+def test_queued_record_carries_the_formatted_traceback():
+    log, records = queued_logger("test_queued_traceback")
+    try:
+        raise ValueError("broken update")
+    except ValueError:
+        log.exception("Handler failed")
+
+    record = records.get_nowait()
+    assert record.exc_info is None
+    assert "ValueError: broken update" in record.exc_text
+    assert "ValueError: broken update" in logging.Formatter("%(message)s").format(record)
+
+
+class Capture(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_debug_records_of_the_update_are_logged_only_when_flushed(monkeypatch):
+    monkeypatch.setattr(logger, "DEBUG_BUFFER_SIZE", 3)
+    log, capture = logging.getLogger("main_logger"), Capture()
+    monkeypatch.setattr(log, "filters", [logger.DebugLogFilter()])  # as setup_logger configures it
+    level = log.level
+    log.setLevel(logging.DEBUG)
+    log.addHandler(capture)
+
+    def handle_updates():  # on a thread of its own, the buffer is thread-local
+        logger.begin_update()
+        log.debug("previous update")
+        logger.begin_update()
+        for step in range(5):
+            log.debug("step %s", step)
+        log.info("handled")
+        logger.flush_debug_log()
+
+    try:
+        thread = threading.Thread(target=handle_updates)
+        thread.start()
+        thread.join()
+    finally:
+        log.removeHandler(capture)
+        log.setLevel(level)
+    assert capture.messages == ["handled", "Last 3 debug records before crash:", "step 2", "step 3", "step 4"]
+
+
+def write_entries(path, first: int, count: int) -> None:
+    with open(path, "a") as file:
+        for number in range(first, first + count):
+            file.write(f"2025-01-01 00:00:{number:02} INFO: entry {number} [in test.py:1]\n")
+
+
+def page(before: str = None, limit: int = 3) -> tuple[list, str]:
+    numbers, cursor = [], None
+    for cursor, _, lines in itertools.islice(logger.read_log_entries(before=before), limit):
+        numbers.append(int(lines[0].split("entry ")[1].split()[0]))
+    return numbers, cursor
+
+
+def test_log_cursor_follows_its_file_after_rotation(tmp_path, monkeypatch):
+    log_file = tmp_path / "app.log"
+    monkeypatch.setattr(logger, "LOG_FILE", str(log_file))
+    write_entries(log_file, 1, 6)
+    numbers, cursor = page()
+    assert numbers == [6, 5, 4]
+
+    os.rename(log_file, f"{log_file}.1")  # rotated while the viewer is open
+    write_entries(log_file, 7, 2)
+    assert page(cursor)[0] == [3, 2, 1]
+
+    os.remove(f"{log_file}.1")  # rotated away, the cursor starts over
+    assert page(cursor)[0] == [8, 7]
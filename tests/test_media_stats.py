@@ -0,0 +1,33 @@
+import database as db
+
+USER_ID = 1
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test1"})
+
+
+def add_media(file_id: str, media_type: str) -> None:
+    added, _ = db.Media.add({"user_id": USER_ID, "media_type": media_type, "file_id": file_id, "caption": None,
+                             "description": f"test {file_id}"})
+    assert added
+
+
+def test_counts_follow_media_type_changes():
+    add_media("a", "photo")
+    add_media("b", "photo")
+    assert db.MediaStats.get_counts(USER_ID) == {"photo": 2}
+
+    assert db.Media.set({"user_id": USER_ID, "file_id": "a"}, {"media_type": "video"})
+    assert db.MediaStats.get_counts(USER_ID) == {"photo": 1, "video": 1}
+
+    # the last item of a type removes its counter
+    assert db.Media.set({"user_id": USER_ID, "file_id": "b"}, {"media_type": "video"})
+    assert db.MediaStats.get_counts(USER_ID) == {"video": 2}
+    assert db.MediaStats.total(USER_ID) == 2
+
+    # updates that keep the type don't count the item again
+    assert db.Media.set({"user_id": USER_ID, "file_id": "a"}, {"media_type": "video", "caption": "cat"})
+    assert db.MediaStats.get_counts(USER_ID) == {"video": 2}
@@ -0,0 +1,49 @@
+import metrics
+
+
+def test_histogram_renders_cumulative_buckets_per_label():
+    histogram = metrics.Histogram("test_seconds", "Test latency", ("method",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.1, 0.5, 3.0):
+        histogram.observe(value, "send")
+    with histogram.time("edit"):
+        pass
+
+    lines = histogram.render()
+    assert lines.pop(5).startswith('inline_vault_test_seconds_sum{method="edit"} ')  # the time of the block
+    assert lines == [
+        "# HELP inline_vault_test_seconds Test latency",
+        "# TYPE inline_vault_test_seconds histogram",
+        'inline_vault_test_seconds_bucket{method="edit",le="0.1"} 1',
+        'inline_vault_test_seconds_bucket{method="edit",le="1.0"} 1',
+        'inline_vault_test_seconds_bucket{method="edit",le="+Inf"} 1',
+        'inline_vault_test_seconds_count{method="edit"} 1',
+        'inline_vault_test_seconds_bucket{method="send",le="0.1"} 2',  # upper bounds are inclusive
+        'inline_vault_test_seconds_bucket{method="send",le="1.0"} 3',
+        'inline_vault_test_seconds_bucket{method="send",le="+Inf"} 4',
+        'inline_vault_test_seconds_sum{method="send"} 3.65',
+        'inline_vault_test_seconds_count{method="send"} 4',
+    ]
+    assert histogram.snapshot()[("send",)] == (4, 3.65)
+
+
+def test_counter_escapes_label_values():
+    counter = metrics.Counter("test_total", "Test counter", ("error",))
+    counter.inc('"locked"\n')
+    counter.inc('"locked"\n', amount=2)
+    assert counter.value('"locked"\n') == 3
+    assert counter.render()[2] == 'inline_vault_test_total{error="\\"locked\\"\\n"} 3'
+
+
+def test_collectors_are_rendered_as_gauges(monkeypatch):
+    monkeypatch.setitem(metrics._collectors, "test_cache", lambda: {
+        "hits": 3, "ratio": 0.5, "enabled": True, "sizes": [1, 2], "name": "skipped"})
+    monkeypatch.setitem(metrics._collectors, "test_broken", lambda: 1 / 0)
+
+    rendered = metrics.render()
+    assert ("# TYPE inline_vault_test_cache_hits gauge\ninline_vault_test_cache_hits 3\n"
+            "# TYPE inline_vault_test_cache_ratio gauge\ninline_vault_test_cache_ratio 0.5\n"
+            "# TYPE inline_vault_test_cache_enabled gauge\ninline_vault_test_cache_enabled 1\n"
+            "# TYPE inline_vault_test_cache_sizes gauge\ninline_vault_test_cache_sizes{index=\"0\"} 1\n"
+            "inline_vault_test_cache_sizes{index=\"1\"} 2\n") in rendered
+    assert "inline_vault_test_cache_name" not in rendered
+    assert "# collector test_broken failed: division by zero\n" in rendered
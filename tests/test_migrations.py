@@ -0,0 +1,85 @@
+import sqlite3
+
+import pytest
+
+import database as db
+
+USER_ID = 4
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test4"})
+
+
+@pytest.fixture
+def pool(tmp_path):
+    """A database file of its own, the queries of media run on it within the test."""
+    pool = db.Connection(str(tmp_path / "migrations.db"), timeout=5)
+    with db.Database.pinned(pool):
+        db.Media.create_table()
+        yield pool
+    pool.close()
+
+
+def create_old_fts(pool: db.Connection, descriptions: list) -> None:
+    """Replaces media_fts with the schema that had media_id as a column, rowids differ from media_ids."""
+    with pool.lease() as connection:
+        connection.execute("DROP TABLE media_fts;")
+        connection.execute("CREATE VIRTUAL TABLE media_fts USING fts5(media_id, description, user_id UNINDEXED);")
+        for description in descriptions:
+            media_id = connection.execute("INSERT INTO media (user_id, media_type, file_id) VALUES (?, 'photo', ?);",
+                                          (USER_ID, description)).lastrowid
+            connection.execute("INSERT INTO media_fts (rowid, media_id, description, user_id) VALUES (?, ?, ?, ?);",
+                               (media_id + 100, media_id, description, USER_ID))
+
+
+def tables(pool: db.Connection) -> set:
+    with pool.lease() as connection:
+        return {name for name, in connection.execute("SELECT name FROM sqlite_master;")}
+
+
+def test_migrate_fts_replays_changes_made_during_the_copy(pool, monkeypatch):
+    create_old_fts(pool, [f"cat {i}" for i in range(1, 6)])
+    other = sqlite3.connect(pool.db_path, isolation_level=None)  # another process serving the bot
+
+    def between_batches(seconds):
+        if between_batches.calls == 0:  # media 1 and 2 are copied
+            other.execute("DELETE FROM media WHERE media_id = 1;")
+            other.execute("INSERT INTO media (user_id, media_type, file_id) VALUES (?, 'photo', 'dog');", (USER_ID,))
+            other.execute("INSERT INTO media_fts (rowid, media_id, description, user_id) VALUES (200, 6, 'dog', ?);",
+                          (USER_ID,))
+        between_batches.calls += 1
+    between_batches.calls = 0
+    monkeypatch.setattr(db.time, "sleep", between_batches)
+
+    with db.Database.pinned(pool):
+        assert db.Media.migrate_fts(batch_size=2) == 6  # the row added meanwhile is reached by the batches
+    other.close()
+
+    with pool.lease() as connection:
+        rows = connection.execute("SELECT rowid, description FROM media_fts ORDER BY rowid;").fetchall()
+    assert rows == [(2, "cat 2"), (3, "cat 3"), (4, "cat 4"), (5, "cat 5"), (6, "dog")]
+    assert not tables(pool) & {"media_fts_new", "media_fts_old", "media_fts_deleted"}
+    with db.Database.pinned(pool):
+        assert db.Media.migrate_fts() == 0  # already migrated
+
+
+@pytest.mark.skipif(not db.TRIGRAM_SEARCH, reason="trigram search isn't supported by this SQLite version")
+def test_migrate_trigram_removes_rows_of_deleted_media():
+    media_ids = []
+    for i in range(5):
+        added, media_id = db.Media.add({"user_id": USER_ID, "media_type": "photo", "file_id": f"trigram{i}",
+                                        "caption": None, "description": f"kitten {i}"})
+        media_ids.append(media_id)
+    with db.Database.connection.lease() as connection:  # changes made while trigram search was disabled
+        connection.execute("DELETE FROM media WHERE media_id IN (?, ?);", (media_ids[0], media_ids[3]))
+        connection.execute("DELETE FROM media_fts WHERE rowid IN (?, ?);", (media_ids[0], media_ids[3]))
+        connection.execute("DELETE FROM media_trigram WHERE rowid = ?;", (media_ids[1],))
+
+    assert db.Media.migrate_trigram(batch_size=2, pause=0) == 1
+    with db.Database.connection.lease() as connection:
+        trigram = connection.execute("SELECT rowid FROM media_trigram ORDER BY rowid;").fetchall()
+        media = connection.execute("SELECT media_id FROM media ORDER BY media_id;").fetchall()
+    assert trigram == media
@@ -0,0 +1,37 @@
+import database as db
+
+USER_ID, OTHER_USER_ID = 17, 18
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    for user_id in (USER_ID, OTHER_USER_ID):
+        db.Users.add({"user_id": user_id, "username": f"test{user_id}"})
+        db.Media.add({"user_id": user_id, "media_type": "gif", "file_id": "shared-file", "caption": f"of {user_id}",
+                      "description": f"looked up {user_id}"})
+
+
+def test_item_is_found_by_file_id_within_the_vault_of_its_user():
+    record = db.Media.find(USER_ID, "shared-file")
+    assert (record.user_id, record.media_type, record.file_id, record.caption, record.description) == \
+        (USER_ID, "gif", "shared-file", f"of {USER_ID}", f"looked up {USER_ID}")
+    assert db.Media.find(OTHER_USER_ID, "shared-file").description == f"looked up {OTHER_USER_ID}"
+    assert db.Media.find(USER_ID, "missing-file") is None
+
+    with db.Media.pool(USER_ID).lease() as connection:
+        plan = db.QueryStats.explain(connection, "SELECT media_id FROM media WHERE user_id = ? AND file_id = ?;",
+                                     (USER_ID, "shared-file"), False)
+    assert "SEARCH media USING COVERING INDEX" in plan
+
+
+def test_item_is_deleted_by_file_id_with_its_descriptions():
+    media_id = db.Media.find(USER_ID, "shared-file").media_id
+    assert db.Media.delete_by_file_id(USER_ID, "shared-file")
+    assert not db.Media.delete_by_file_id(USER_ID, "shared-file")
+
+    assert db.Media.find(USER_ID, "shared-file") is None
+    assert db.Media.find(OTHER_USER_ID, "shared-file") is not None
+    for table_name in ("media_fts", "media_trigram"):
+        assert db.Media.execute_query(f"SELECT COUNT(*) FROM {table_name} WHERE rowid = ?;", (media_id,),
+                                      shard_key=USER_ID) == [(0,)]
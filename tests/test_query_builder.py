@@ -0,0 +1,52 @@
+import pytest
+
+import database as db
+
+USER_ID = 16
+
+
+def setup_module():
+    db.Users.migrate()
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    statements = {}
+    monkeypatch.setattr(db.Database, "_statements", statements)
+    return statements
+
+
+def test_statements_are_compiled_once_per_table_operation_and_columns(statements, monkeypatch):
+    compiled = []
+    compile_statement = db.Users._compile_statement.__func__
+    monkeypatch.setattr(db.Users, "_compile_statement",
+                        classmethod(lambda cls, *key: compiled.append(key) or compile_statement(cls, *key)))
+
+    for username in ("first", "second"):
+        db.Users.add({"user_id": USER_ID, "username": username}, replace=True)
+        assert db.Users.get({"user_id": USER_ID}) == (USER_ID, username)
+    assert db.Users.set({"username": "second", "user_id": USER_ID}, {"username": "third"})
+    assert db.Users.count_where({"user_id": USER_ID}) == 1
+    assert db.Users.delete({"user_id": USER_ID})
+
+    assert [operation for operation, *_ in compiled] == ["insert", "select", "update", "count", "delete"]
+    assert statements[(db.Users, "update", ("username",), ("username", "user_id"))] == \
+        "UPDATE users SET username = ? WHERE username = ? AND user_id = ?"
+
+
+def test_invalid_columns_raise_and_are_not_cached(statements):
+    with pytest.raises(ValueError, match="Invalid column"):
+        db.Users.get({"user_id": USER_ID, "name; DROP TABLE users": 1})
+    with pytest.raises(ValueError, match="Invalid column for ordering"):
+        db.Users.get({"user_id": USER_ID}, order_by="1; DROP TABLE users")
+    with pytest.raises(ValueError, match="Sort direction"):
+        db.Users.get({"user_id": USER_ID}, order_by="username", sort_direction="sideways")
+    assert statements == {}
+
+
+def test_full_cache_starts_over(statements, monkeypatch):
+    monkeypatch.setattr(db, "STATEMENT_CACHE_SIZE", 2)
+    db.Users.count_where({"user_id": USER_ID})
+    db.Users.count_where({"username": "nobody"})
+    db.Users.count_where({"user_id": USER_ID, "username": "nobody"})
+    assert list(statements) == [(db.Users, "count", ("user_id", "username"))]
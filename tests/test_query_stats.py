@@ -0,0 +1,36 @@
+import sqlite3
+
+import database as db
+
+
+def test_slow_statements_are_logged_with_their_plan_once(monkeypatch):
+    logged = []
+    monkeypatch.setattr(db.slow_query_logger, "info", logged.append)
+    connection = sqlite3.connect(":memory:")
+    connection.execute("CREATE TABLE items (item_id INTEGER PRIMARY KEY, name TEXT);")
+    stats = db.QueryStats(threshold=0.1)
+    query = """
+        SELECT name FROM items
+        WHERE item_id = ?;
+    """
+
+    stats.record(connection, query, (1,), False, 0.01)
+    assert logged == []
+    stats.record(connection, query, (1,), False, 0.2)
+    stats.record(connection, query, (2,), False, 0.3)
+    assert logged[0].startswith("200.0ms SELECT name FROM items WHERE item_id = ?;\n")
+    assert "SEARCH items USING INTEGER PRIMARY KEY (rowid=?)" in logged[0]
+    assert logged[1] == "300.0ms SELECT name FROM items WHERE item_id = ?;"  # explained only the first time
+
+    stats.record(connection, "INSERT INTO items (name) VALUES (?);", [("a",), ("b",)], True, 0.05)
+    snapshot = stats.dump(reset=True)
+    assert [(row["statement"], row["count"], row["slow"]) for row in snapshot] == [
+        ("SELECT name FROM items WHERE item_id = ?;", 3, 2), ("INSERT INTO items (name) VALUES (?);", 1, 0)]
+    assert snapshot[0]["max"] == 0.3
+    assert logged[2].startswith("Statement stats:\n")
+    assert stats.snapshot() == []
+
+
+def test_plan_of_a_broken_statement_is_reported_instead_of_raising():
+    connection = sqlite3.connect(":memory:")
+    assert db.QueryStats.explain(connection, "SELECT * FROM missing;", (), False).startswith("    plan unavailable")
@@ -0,0 +1,85 @@
+import pytest
+
+import database as db
+
+USER_ID = 5
+
+
+def setup_module():
+    db.Users.migrate()
+    db.Media.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test5"})
+    for i in range(25):
+        add_media(f"search{i:02}", f"funny cat {i}" if i % 2 else f"serious dog {i}")
+
+
+def add_media(file_id: str, description: str) -> int:
+    added, media_id = db.Media.add({"user_id": USER_ID, "media_type": "photo", "file_id": file_id, "caption": None,
+                                    "description": description})
+    assert added
+    return media_id
+
+
+def walk(description: str, limit: int, **kwargs) -> list[list]:
+    """Returns file_ids of every page, following the page tokens."""
+    pages, token = [], ""
+    while True:
+        records, token = db.Media.search_page(USER_ID, description, limit=limit, page_token=token, **kwargs)
+        pages.append([record[2] for record in records])
+        if not token:
+            return pages
+
+
+def test_listing_pages_cover_every_item_once_newest_first():
+    pages = walk("", limit=10)
+    assert [len(page) for page in pages] == [10, 10, 5]
+    file_ids = [file_id for page in pages for file_id in page]
+    assert file_ids == [f"search{i:02}" for i in reversed(range(25))]
+
+
+def test_search_pages_follow_the_rank_without_gaps_or_repeats():
+    pages = walk("cat", limit=5, mode="token")
+    file_ids = [file_id for page in pages for file_id in page]
+    assert sorted(file_ids) == sorted(f"search{i:02}" for i in range(1, 25, 2))
+    assert len(file_ids) == len(set(file_ids))
+
+    first_page, _ = db.Media.search_page(USER_ID, "cat", limit=12, mode="token")
+    assert [record[2] for record in first_page] == file_ids  # same order as one big page
+
+
+def test_items_added_while_paging_dont_shift_the_next_page():
+    first, token = db.Media.search_page(USER_ID, "", limit=10)
+    media_id = add_media("search-new", "added meanwhile")
+    try:
+        second, _ = db.Media.search_page(USER_ID, "", limit=10, page_token=token)
+        assert [record[2] for record in second] == [f"search{i:02}" for i in range(14, 4, -1)]
+    finally:
+        assert db.Media.delete({"user_id": USER_ID, "media_id": media_id})
+
+
+def test_legacy_integer_offsets_are_still_served():
+    records, _ = db.Media.search_page(USER_ID, "", limit=5, page_token="20")
+    assert [record[2] for record in records] == [f"search{i:02}" for i in range(4, -1, -1)]
+
+
+def test_trigram_mode_matches_substrings_across_pages():
+    assert walk("unn", limit=5, mode="token") == [[]]
+    pages = walk("unn", limit=5, mode="trigram")
+    assert [len(page) for page in pages] == [5, 5, 2]
+    assert sorted(file_id for page in pages for file_id in page) == sorted(f"search{i:02}" for i in range(1, 25, 2))
+    assert walk("un", limit=5, mode="trigram") == [[]]  # too short for a trigram
+
+
+def test_auto_mode_falls_back_to_trigrams_and_keeps_the_mode_on_next_pages():
+    records, token = db.Media.search_page(USER_ID, "eriou", limit=10, mode="auto")
+    assert {record[2] for record in records} <= {f"search{i:02}" for i in range(0, 25, 2)}
+    rest, _ = db.Media.search_page(USER_ID, "eriou", limit=10, page_token=token, mode="token")  # the token's mode wins
+    assert len(records) + len(rest) == 13
+
+    whole_words, _ = db.Media.search_page(USER_ID, "dog", limit=20, mode="auto")
+    assert len(whole_words) == 13
+
+
+def test_unknown_search_mode_is_rejected():
+    with pytest.raises(ValueError, match="Invalid search mode"):
+        db.Media.search_page(USER_ID, "cat", limit=5, mode="fuzzy")
@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_IDS = range(1, 8)
+
+# shards are chosen when database is imported, every layout runs in a process of its own
+SEED = """
+import database as db
+from state import StateStore
+
+for table in (db.Users, db.Media, db.States):
+    table.migrate()
+for user_id in USER_IDS:
+    db.Users.add({"user_id": user_id, "username": f"user{user_id}"})
+    for i in range(user_id):
+        db.Media.add({"user_id": user_id, "media_type": "photo", "file_id": f"file{i}", "caption": None,
+                      "description": f"sharded item {i} of {user_id}"})
+    StateStore().replace(user_id, {"status": f"state of {user_id}"})
+"""
+READ = """
+import json
+import database as db
+from state import StateStore
+
+vaults = {}
+for user_id in USER_IDS:
+    records, _ = db.Media.search_page(user_id, "sharded", limit=100)
+    vaults[user_id] = {
+        "files": sorted(record[2] for record in records),
+        "found": db.Media.find(user_id, "file0").description,
+        "state": StateStore().get(user_id)["status"],
+        "shard": db.Media.pool(user_id).db_path,
+    }
+print(json.dumps(vaults))
+"""
+
+
+def run(home, shard_count: int, *args) -> str:
+    env = dict(os.environ, HOME=str(home), DATABASE_PATH="data.db", SHARD_COUNT=str(shard_count))
+    result = subprocess.run([sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def script(code: str) -> tuple:
+    return "-c", f"USER_IDS = {list(USER_IDS)}\n{code}"
+
+
+def read(home, shard_count: int) -> dict:
+    return {int(user_id): vault for user_id, vault in json.loads(run(home, shard_count, *script(READ))).items()}
+
+
+def test_reshard_moves_every_vault_and_back(tmp_path):
+    (tmp_path / "mysite").mkdir()
+    run(tmp_path, 1, *script(SEED))
+    before = read(tmp_path, 1)
+
+    report = run(tmp_path, 1, "manage.py", "reshard", "3")
+    assert report.startswith("shard 0: 9 media, 2 states\nshard 1: 12 media, 3 states\nshard 2: 7 media, 2 states\n")
+    sharded = read(tmp_path, 3)
+    for user_id in USER_IDS:
+        assert sharded[user_id]["shard"] == str(tmp_path / "mysite" / f"data.shard{user_id % 3}.db")
+        assert {key: sharded[user_id][key] for key in ("files", "found", "state")} == \
+            {key: before[user_id][key] for key in ("files", "found", "state")}
+    assert sharded[7]["files"] == [f"file{i}" for i in range(7)]
+
+    run(tmp_path, 3, "manage.py", "reshard", "1")
+    assert read(tmp_path, 1) == before
+    assert sorted(os.listdir(tmp_path / "mysite"))[0] == "data.db"
+    assert not [name for name in os.listdir(tmp_path / "mysite") if ".shard" in name]
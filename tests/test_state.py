@@ -0,0 +1,58 @@
+import time
+
+import pytest
+
+import database as db
+from state import StateStore
+
+USER_ID = 3
+
+
+def setup_module():
+    db.Users.migrate()
+    db.States.migrate()
+    db.Users.add({"user_id": USER_ID, "username": "test3"})
+
+
+def test_changes_of_another_process_are_read_right_away():
+    writer, reader = StateStore(), StateStore()
+    writer.replace(USER_ID, {"status": "delete"})
+    assert reader.get(USER_ID) == {"status": "delete"}
+
+    writer.update(USER_ID, {"status": "check description"})
+    assert reader.get(USER_ID) == {"status": "check description"}
+    writer.clear(USER_ID)
+    assert reader.get(USER_ID) == {}
+
+
+def test_changes_of_another_process_are_read_after_ttl():
+    writer, reader = StateStore(), StateStore(ttl=0.05)  # two processes serving the same user
+    writer.replace(USER_ID, {"status": "delete"})
+    assert reader.get(USER_ID) == {"status": "delete"}
+
+    writer.clear(USER_ID)
+    time.sleep(0.1)
+    assert reader.get(USER_ID) == {}
+
+
+def test_failed_flush_keeps_changes_pending(monkeypatch):
+    store = StateStore(write_mode="behind", flush_interval=3600)
+    store.replace(USER_ID, {"status": "check description"})
+
+    monkeypatch.setattr(db.States, "save", classmethod(lambda cls, states: False))  # a swallowed query error
+    store.flush()
+    assert store.stats()["dirty"] == 1
+    assert store.stats()["flush_failures"] == 1
+
+    def fail(cls, states):
+        raise RuntimeError("database is gone")
+    monkeypatch.setattr(db.States, "save", classmethod(fail))
+    with pytest.raises(RuntimeError):
+        store.flush()
+    assert store.stats()["dirty"] == 1
+
+    monkeypatch.undo()
+    store.flush()
+    assert store.stats()["dirty"] == 0
+    assert db.States.load(USER_ID) == {"status": "check description"}
+    store.stop()
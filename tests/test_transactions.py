@@ -0,0 +1,51 @@
+import pytest
+
+import database as db
+
+USER_IDS = (11, 12)
+
+
+def setup_module():
+    db.Users.migrate()
+
+
+@pytest.fixture(params=["direct", "queue"])
+def write_mode(request, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_MODE", request.param)
+    yield request.param
+    for user_id in USER_IDS:
+        db.Users.delete({"user_id": user_id})
+
+
+def usernames() -> list:
+    return [db.Users.get({"user_id": user_id}, include_column_names=True).get("username") for user_id in USER_IDS]
+
+
+def test_failed_savepoint_is_rolled_back_alone_with_its_callbacks(write_mode):
+    committed = []
+    with db.Database.transaction():
+        db.Users.add({"user_id": USER_IDS[0], "username": "kept"})
+        db.Database.on_commit(lambda: committed.append("outer"))
+        with pytest.raises(ValueError):
+            with db.Database.transaction():
+                db.Users.add({"user_id": USER_IDS[1], "username": "rolled back"})
+                db.Database.on_commit(lambda: committed.append("inner"))
+                raise ValueError("inner block failed")
+        assert committed == []  # not before the outer block commits
+
+    assert usernames() == ["kept", None]
+    assert committed == ["outer"]
+
+
+def test_failed_transaction_is_rolled_back_without_callbacks(write_mode):
+    committed = []
+    with pytest.raises(ValueError):
+        with db.Database.transaction():
+            db.Users.add({"user_id": USER_IDS[0], "username": "rolled back"})
+            db.Database.on_commit(lambda: committed.append("outer"))
+            raise ValueError("block failed")
+
+    assert usernames() == [None, None]
+    assert committed == []
+    db.Database.on_commit(lambda: committed.append("outside"))  # no transaction, runs right away
+    assert committed == ["outside"]
@@ -0,0 +1,42 @@
+import json
+import os
+import subprocess
+import sys
+
+from translations import Catalog
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TRANSLATIONS = {
+    "en": {"added": "Added", "described by": "Find it by searching:\n {description}"},
+    "uk": {"added": "Додано", "described by": "Шукай:\n {description}"},
+}
+
+
+def test_translations_are_rendered_with_fallbacks():
+    catalog = Catalog(TRANSLATIONS, fallbacks={"ru": "uk"})
+    assert catalog.translate("uk", "described by", {"description": "cat"}) == "Шукай:\n cat"
+    assert catalog.translate("ru", "added") == "Додано"
+    assert catalog.translate("de", "added") == "Added"
+
+
+def test_placeholder_problems_are_reported_per_language(tmp_path):
+    (tmp_path / "pl.json").write_text(json.dumps({"added": "Dodano {count", "described by": "Szukaj: {desc}"}))
+    (tmp_path / "de.json").write_text(json.dumps({"added": "{0} hinzugefügt", "described by": "{description.x}"}))
+    catalog = Catalog(TRANSLATIONS, directory=str(tmp_path))
+
+    problems = catalog.placeholder_problems()
+    assert sorted(problems) == ["de", "pl"]
+    assert problems["pl"][0].startswith("added: malformed template")
+    assert problems["pl"][1] == "described by: placeholders differ, expected {description}, found {desc}"
+    assert problems["de"][0] == "added: positional placeholders can't be filled by name"
+    assert problems["de"][1].startswith("described by: can't be rendered")
+    assert catalog.missing_keys() == {}
+
+
+def test_check_translations_fails_on_mismatched_placeholders(tmp_path):
+    (tmp_path / "uk.json").write_text(json.dumps({"described by": "Шукай: {опис}"}))
+    result = subprocess.run([sys.executable, "manage.py", "check-translations"], cwd=ROOT, capture_output=True,
+                            text=True, env=dict(os.environ, TRANSLATIONS_DIR=str(tmp_path)))
+    assert result.returncode == 1
+    assert "uk: described by: placeholders differ, expected {description}, found {опис}" in result.stdout
@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+import database as db
+
+
+@pytest.fixture
+def pool(tmp_path):
+    pool = db.Connection(str(tmp_path / "writer.db"), timeout=0.05)
+    with pool.lease() as connection:
+        connection.execute("CREATE TABLE items (name TEXT);")
+    yield pool
+    pool.close()
+
+
+def insert(pool: db.Connection, name: str):
+    def work():
+        pool.writer.connection.execute("INSERT INTO items (name) VALUES (?);", (name,))
+    return pool.writer.submit(work)
+
+
+def names(pool: db.Connection) -> list:
+    with pool.lease() as connection:
+        return [name for name, in connection.execute("SELECT name FROM items ORDER BY name;")]
+
+
+def test_queued_writes_are_committed_together(pool):
+    futures = [insert(pool, f"item{i:02}") for i in range(50)]
+    for future in futures:
+        pool.writer.wait(future)
+    assert names(pool) == [f"item{i:02}" for i in range(50)]
+    assert pool.writer.stats()["commits"] <= 50
+
+
+def test_failed_write_is_rolled_back_alone_with_its_callbacks(pool):
+    called = []
+
+    def failing():
+        pool.writer.connection.execute("INSERT INTO items (name) VALUES ('failed');")
+        pool.commit_callbacks.append(lambda: called.append("failed"))
+        raise ValueError("rolled back")
+
+    failed = pool.writer.submit(failing)
+    pool.writer.wait(insert(pool, "kept"))
+    with pytest.raises(ValueError):
+        pool.writer.wait(failed)
+    assert names(pool) == ["kept"]
+    assert called == []
+
+
+def test_write_gives_up_while_another_process_holds_the_lock(pool, monkeypatch):
+    monkeypatch.setattr(db, "WRITE_TIMEOUT", 0.3)
+    holder = sqlite3.connect(pool.db_path, isolation_level=None)
+    holder.execute("BEGIN IMMEDIATE;")
+    try:
+        started = time.monotonic()
+        with pytest.raises(sqlite3.OperationalError, match="database is locked"):
+            pool.writer.wait(insert(pool, "late"))
+        assert time.monotonic() - started < 3
+    finally:
+        holder.execute("COMMIT;")
+        holder.close()
+
+    pool.writer.wait(insert(pool, "after"))
+    assert names(pool) == ["after"]  # the write that gave up is never executed
+
+
+def test_queued_write_that_timed_out_returns_cursor_error(monkeypatch):
+    monkeypatch.setattr(db, "WRITE_MODE", "queue")
+    monkeypatch.setattr(db, "WRITE_TIMEOUT", 0.3)
+    db.Users.migrate()
+    holder = sqlite3.connect(db.Database.connection.db_path, isolation_level=None, timeout=0.05)
+    holder.execute("BEGIN IMMEDIATE;")
+    try:
+        result = db.Users.add({"user_id": os.getpid(), "username": "locked"})
+    finally:
+        holder.execute("ROLLBACK;")
+        holder.close()
+    assert result == (False, 0)
@@ -1,75 +1,225 @@
-def translate(lang: str, key: str, values: dict = None):
-    translations = {
-        'en': {
-            'start': 'Hi. I will be the one keeping your media safe and always available\n\nYou can send media via me '
-                     'simply by writing @inlinevaultbot inside your text field.\nTo add new media firstly, '
-                     'just send it to me, then send me description/tags you want to use to find that media. If you '
-                     'want to delete something, send /delete and then send everything you want to delete',
-            'delete': 'Now send me all the media you want to delete. Send /cancel to cancel',
-            'cancelled': 'Successfully canceled',
-            'finish deleting': 'Done deleting',
-            'not recognized': 'Sorry, I don\'t recognize that media.',
-            'added': 'Successfully added',
-            'duplicate': 'You already have that in your collection',
-            'deleted': 'Successfully deleted. Send next or /done to stop',
-            'not found': 'That media was not found in your collection',
-            'describe': 'Please provide a description for this media. Type /cancel to cancel',
-            'empty': 'No matches. Tap to add your own media',
-            'open': 'Click here to open bot\'s chat',
-            'try': 'Try it out!',
-            'error': 'Something went wrong',
-            'no records': 'Start your collection: add, then search here!',
-            'check description': 'Send me a media which description you want to check. Type /cancel to cancel',
-            'described by': 'You can find that media by searching:\n {description}'
-        },
-        'uk': {
-            'start': 'Привіт. Я буду зберігати твої медіа в безпеці і під рукою\n\nТи можеш висилати медіа просто '
-                     'вписуючи @inlinevaultbot в текстовому полі.\nЩоб додати нове медіа, спершу просто вишли мені '
-                     'його, а потім вишли опис/теги за допомогою яких ти хочеш знаходити конкретну річ. Якщо хочеш '
-                     'видалити щось, вишли /delete і потім все, що хочеш видалити',
-            'delete': 'Тепер надішли мені всі медіа, які ти хочеш видалити. Надішли /cancel, щоб відмінити',
-            'cancelled': 'Успішно скасовано.',
-            'finish deleting': 'Видалення завершено',
-            'not recognized': 'Вибач, я не можу розпінати дане медіа',
-            'added': 'Успішно додано',
-            'duplicate': 'Ти вже маєш це в своїй колекції',
-            'deleted': 'Успішно видалено. Надішли /done, щоб завершити',
-            'not found': 'Це медіа не знайдено в твоїй колекції',
-            'describe': 'Надай опис цьому медіа. Надішли /cancel, щоб скасувати',
-            'empty': 'Немає збігів. Натисніть, щоб додати нові медіа',
-            'open': 'Натисни тут, щоб відкрити чат з ботом',
-            'try': 'Спробуй!',
-            'error': 'Щось пішло не плану',
-            'no records': 'Розпочни свою колекцію: додай, потім шукай тут!',
-            'check description': 'Надішли мені медіа, опис якого ти хочеш перевірити. Надішли /cancel, щоб скасувати',
-            'described by': 'Ти можеш знайти це медіа шукаючи:\n {description}'
-        },
-        'pl': {
-            'start': 'Cześć. Będę czuwać nad bezpieczeństwem twoich mediów i ich ciągłą dostępnością\n\nMożesz wysłać '
-                     'media przez po prostu pisząc @inlinevaultbot w polu tekstowym.\nAby dodać nowe media, '
-                     'po prostu wyślij je do mnie, a następnie wyślij mi opis/tagi, których chcesz użyć, aby znaleźć '
-                     'te media. eśli chcesz coś usunąć, wyślij /delete, a następnie wyślij wszystko, co chcesz usunąć',
-            'delete': 'Teraz wyślij mi wszystkie media, które chcesz usunąć. Wyślij /cancel, żeby anulować',
-            'cancelled': 'Pomyślnie anulowano',
-            'finish deleting': 'Usuwanie zakończono',
-            'not recognized': 'Przepraszam, nie rozpoznaję tego media',
-            'added': 'Pomyślnie dodano',
-            'duplicate': 'Masz to już w swojej kolekcji',
-            'deleted': 'Pomyślnie usunięto. Wyślij kolejne albo /done, żeby zatrzymać',
-            'not found': 'Tego media nie znaleziono w twojej kolekcji',
-            'describe': 'Podaj opis tego nośnika. Wyślij /cancel, żeby anulować',
-            'empty': 'Brak wyników. Kliknij, aby dodać nowe media',
-            'open': 'Kliknij tutaj, aby otworzyć czat bota',
-            'try': 'Spróbuj!',
-            'error': 'Coś poszło nie tak',
-            'no records': 'Zacznij własną kolekcję: dodaj, potem wyszukaj tu!',
-            'check description': 'Wyślij mi media, którego opis chcesz sprawdzić. Wyślij /cancel, żeby anulować',
-            'described by': 'Możesz znaleźć to media, wyszukując:\n {description}'
-        }
+"""
+Translation catalog. Texts are compiled once: language fallbacks are resolved through a precomputed map and
+templates are parsed beforehand, so translate() is a couple of dict lookups.
+
+Languages can also be loaded from <TRANSLATIONS_DIR>/<lang>.json files (key -> template), read on first use.
+They add new languages or override built-in texts. Keys missing in a language fall back to English.
+"""
+import json
+import os
+import string
+import threading
+
+DEFAULT_LANGUAGE = "en"
+LANGUAGE_FALLBACKS = {"ru": "uk"}  # change russian to ukrainian
+TRANSLATIONS_DIR = os.getenv("TRANSLATIONS_DIR")
+
+TRANSLATIONS = {
+    'en': {
+        'start': 'Hi. I will be the one keeping your media safe and always available\n\nYou can send media via me '
+                 'simply by writing @inlinevaultbot inside your text field.\nTo add new media firstly, '
+                 'just send it to me, then send me description/tags you want to use to find that media. If you '
+                 'want to delete something, send /delete and then send everything you want to delete',
+        'delete': 'Now send me all the media you want to delete. Send /cancel to cancel',
+        'cancelled': 'Successfully canceled',
+        'finish deleting': 'Done deleting',
+        'not recognized': 'Sorry, I don\'t recognize that media.',
+        'added': 'Successfully added',
+        'duplicate': 'You already have that in your collection',
+        'deleted': 'Successfully deleted. Send next or /done to stop',
+        'not found': 'That media was not found in your collection',
+        'describe': 'Please provide a description for this media. Type /cancel to cancel',
+        'empty': 'No matches. Tap to add your own media',
+        'open': 'Click here to open bot\'s chat',
+        'try': 'Try it out!',
+        'error': 'Something went wrong',
+        'no records': 'Start your collection: add, then search here!',
+        'check description': 'Send me a media which description you want to check. Type /cancel to cancel',
+        'described by': 'You can find that media by searching:\n {description}'
+    },
+    'uk': {
+        'start': 'Привіт. Я буду зберігати твої медіа в безпеці і під рукою\n\nТи можеш висилати медіа просто '
+                 'вписуючи @inlinevaultbot в текстовому полі.\nЩоб додати нове медіа, спершу просто вишли мені '
+                 'його, а потім вишли опис/теги за допомогою яких ти хочеш знаходити конкретну річ. Якщо хочеш '
+                 'видалити щось, вишли /delete і потім все, що хочеш видалити',
+        'delete': 'Тепер надішли мені всі медіа, які ти хочеш видалити. Надішли /cancel, щоб відмінити',
+        'cancelled': 'Успішно скасовано.',
+        'finish deleting': 'Видалення завершено',
+        'not recognized': 'Вибач, я не можу розпінати дане медіа',
+        'added': 'Успішно додано',
+        'duplicate': 'Ти вже маєш це в своїй колекції',
+        'deleted': 'Успішно видалено. Надішли /done, щоб завершити',
+        'not found': 'Це медіа не знайдено в твоїй колекції',
+        'describe': 'Надай опис цьому медіа. Надішли /cancel, щоб скасувати',
+        'empty': 'Немає збігів. Натисніть, щоб додати нові медіа',
+        'open': 'Натисни тут, щоб відкрити чат з ботом',
+        'try': 'Спробуй!',
+        'error': 'Щось пішло не плану',
+        'no records': 'Розпочни свою колекцію: додай, потім шукай тут!',
+        'check description': 'Надішли мені медіа, опис якого ти хочеш перевірити. Надішли /cancel, щоб скасувати',
+        'described by': 'Ти можеш знайти це медіа шукаючи:\n {description}'
+    },
+    'pl': {
+        'start': 'Cześć. Będę czuwać nad bezpieczeństwem twoich mediów i ich ciągłą dostępnością\n\nMożesz wysłać '
+                 'media przez po prostu pisząc @inlinevaultbot w polu tekstowym.\nAby dodać nowe media, '
+                 'po prostu wyślij je do mnie, a następnie wyślij mi opis/tagi, których chcesz użyć, aby znaleźć '
+                 'te media. eśli chcesz coś usunąć, wyślij /delete, a następnie wyślij wszystko, co chcesz usunąć',
+        'delete': 'Teraz wyślij mi wszystkie media, które chcesz usunąć. Wyślij /cancel, żeby anulować',
+        'cancelled': 'Pomyślnie anulowano',
+        'finish deleting': 'Usuwanie zakończono',
+        'not recognized': 'Przepraszam, nie rozpoznaję tego media',
+        'added': 'Pomyślnie dodano',
+        'duplicate': 'Masz to już w swojej kolekcji',
+        'deleted': 'Pomyślnie usunięto. Wyślij kolejne albo /done, żeby zatrzymać',
+        'not found': 'Tego media nie znaleziono w twojej kolekcji',
+        'describe': 'Podaj opis tego nośnika. Wyślij /cancel, żeby anulować',
+        'empty': 'Brak wyników. Kliknij, aby dodać nowe media',
+        'open': 'Kliknij tutaj, aby otworzyć czat bota',
+        'try': 'Spróbuj!',
+        'error': 'Coś poszło nie tak',
+        'no records': 'Zacznij własną kolekcję: dodaj, potem wyszukaj tu!',
+        'check description': 'Wyślij mi media, którego opis chcesz sprawdzić. Wyślij /cancel, żeby anulować',
+        'described by': 'Możesz znaleźć to media, wyszukując:\n {description}'
     }
-    lang = "uk" if lang == "ru" else lang  # change russian to ukrainian
-    lang = lang if lang in ("en", "uk", "pl") else "en"  # default lang is english
-    translation = translations[lang][key]
-    if values:
-        return translation.format(**values)
-    return translation
+}
+
+
+class Template:
+    """Template parsed once: its placeholder names are known upfront and formatting is pre-bound."""
+    __slots__ = ("text", "fields", "render")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.fields = frozenset(field for _, field, _, _ in string.Formatter().parse(text) if field is not None)
+        self.render = text.format_map  # render(values)
+
+
+class Catalog:
+    def __init__(self, translations: dict, fallbacks: dict = None, default: str = DEFAULT_LANGUAGE,
+                 directory: str = None):
+        """
+        :param translations: built-in texts, language -> key -> template
+        :param fallbacks: language -> language used instead of it
+        :param default: language used for unknown languages and missing keys
+        :param directory: optional directory with <lang>.json files loaded on first use
+        """
+        self.default = default
+        self.directory = directory
+        self._sources = dict(translations)
+        self._compiled = {}  # language -> key -> str (no placeholders) or Template
+        self._lock = threading.RLock()  # compiling a language compiles the default one first
+
+        languages = set(self._sources)
+        if directory and os.path.isdir(directory):
+            languages.update(name[:-5] for name in os.listdir(directory) if name.endswith(".json"))
+        self.languages = {language: language for language in languages}  # every code maps to a loaded language
+        for language, fallback in (fallbacks or {}).items():
+            if language not in languages and fallback in languages:
+                self.languages[language] = fallback
+
+    def resolve(self, lang: str) -> str:
+        """Returns the language texts for lang are taken from."""
+        return self.languages.get(lang, self.default)
+
+    def texts(self, language: str) -> dict:
+        """Returns compiled texts of a language, loading and compiling them on first use."""
+        compiled = self._compiled.get(language)
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled.get(language)
+                if compiled is None:
+                    compiled = self._compiled[language] = self._compile(language)
+        return compiled
+
+    def source(self, language: str) -> dict:
+        """Returns templates defined for the language itself, without fallbacks."""
+        templates = dict(self._sources.get(language, {}))
+        path = os.path.join(self.directory, f"{language}.json") if self.directory else None
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as file:
+                templates.update(json.load(file))
+        return templates
+
+    def _compile(self, language: str) -> dict:
+        compiled = {} if language == self.default else dict(self.texts(self.default))
+        for key, text in self.source(language).items():
+            template = Template(text)
+            compiled[key] = template if template.fields else template.text
+        return compiled
+
+    def translate(self, lang: str, key: str, values: dict = None) -> str:
+        text = self.texts(self.languages.get(lang, self.default))[key]
+        if text.__class__ is str:
+            return text
+        return text.render(values) if values else text.text
+
+    def missing_keys(self) -> dict:
+        """
+        Compares keys of every language with the default one.
+
+        :return: language -> sorted list of keys the language lacks
+        """
+        reference = self.source(self.default)
+        problems = {}
+        for language in sorted(set(self.languages.values())):
+            if language == self.default:
+                continue
+            templates = self.source(language)
+            missing = sorted(key for key in reference if key not in templates)
+            if missing:
+                problems[language] = missing
+        return problems
+
+    def placeholder_problems(self) -> dict:
+        """
+        Checks that every template can be rendered and has the placeholders of the default language's one,
+        so formatting errors are found before a user gets the text.
+
+        :return: language -> sorted list of problems, the default language is checked for malformed templates
+        """
+        reference = {}
+        problems = {}
+        for language in [self.default] + sorted(set(self.languages.values()) - {self.default}):
+            issues = []
+            for key, text in self.source(language).items():
+                fields, error = _inspect_template(text)
+                if error:
+                    issues.append(f"{key}: {error}")
+                elif language == self.default:
+                    reference[key] = fields
+                elif key in reference and fields != reference[key]:
+                    expected = ", ".join(f"{{{field}}}" for field in sorted(reference[key])) or "none"
+                    found = ", ".join(f"{{{field}}}" for field in sorted(fields)) or "none"
+                    issues.append(f"{key}: placeholders differ, expected {expected}, found {found}")
+            if issues:
+                problems[language] = sorted(issues)
+        return problems
+
+
+class _BlankValues(dict):
+    """Values of a trial render, every placeholder gets an empty string."""
+    def __missing__(self, key):
+        return ""
+
+
+def _inspect_template(text: str) -> tuple[frozenset, str or None]:
+    """Returns placeholder names of a template and a description of what makes it unusable, if anything."""
+    try:
+        fields = Template(text).fields
+    except ValueError as e:
+        return frozenset(), f"malformed template ({e})"
+    positional = sorted(field for field in fields if not field or field.isdigit())
+    if positional:
+        return fields, "positional placeholders can't be filled by name"
+    try:
+        text.format_map(_BlankValues())
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError) as e:
+        return fields, f"can't be rendered ({type(e).__name__}: {e})"
+    return fields, None
+
+
+catalog = Catalog(TRANSLATIONS, LANGUAGE_FALLBACKS, DEFAULT_LANGUAGE, TRANSLATIONS_DIR)
+
+
+def translate(lang: str, key: str, values: dict = None):
+    return catalog.translate(lang, key, values)